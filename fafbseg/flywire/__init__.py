@@ -23,4 +23,5 @@ from .meshes import *
 from .synapses import *
 from .utils import *
 from .l2 import *
+from .snapshots import *
 from .annotations import *
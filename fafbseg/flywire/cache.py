@@ -0,0 +1,637 @@
+#    A collection of tools to interface with manually traced and autosegmented
+#    data in FAFB.
+#
+#    Copyright (C) 2019 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Local on-disk caches for (immutable) chunkedgraph data."""
+
+import contextlib
+import hashlib
+import navis
+import os
+import re
+import threading
+import time
+
+import datetime as dt
+import numpy as np
+
+from diskcache import Cache
+from pathlib import Path
+
+from .utils import FLYWIRE_URLS, retry
+
+__all__ = []
+
+# Root directory for the on-disk lookup tables
+CACHE_ROOT = '~/.fafbseg/'
+
+# Supervoxel -> root lookup tables live here
+SV2ROOT_CACHE_DIR = CACHE_ROOT + 'sv2root_cache/'
+
+# L2 attributes (from the L2 cache) live here
+L2_CACHE_DIR = CACHE_ROOT + 'l2_cache/'
+
+# Data type and shape of L2 attributes. Everything is stored as float such
+# that attributes missing for a given L2 chunk can be recorded as NaN
+L2_ATTRIBUTES = {'rep_coord_nm': (np.float64, (3, )),
+                 'pca': (np.float32, (3, 3)),
+                 'pca_val': (np.float32, (3, )),
+                 'size_nm3': (np.float64, ()),
+                 'area_nm2': (np.float64, ()),
+                 'max_dt_nm': (np.float32, ()),
+                 'mean_dt_nm': (np.float32, ())}
+
+# Root -> supervoxels cache (least-recently-used entries are evicted once the
+# cache grows beyond the size limit)
+SVOXEL_CACHE_DIR = CACHE_ROOT + 'svoxel_cache/'
+SVOXEL_CACHE_SIZE_LIMIT = 4 * 1024 ** 3
+
+# Root -> L2 IDs cache (one per dataset)
+L2_LEAVES_CACHE_DIR = CACHE_ROOT + 'l2_leaves_cache/'
+L2_LEAVES_CACHE_SIZE_LIMIT = 1024 ** 3
+
+# L2 ID -> mesh (vertices + faces) cache (one per dataset)
+L2_MESH_CACHE_DIR = CACHE_ROOT + 'l2_mesh_cache/'
+L2_MESH_CACHE_SIZE_LIMIT = 4 * 1024 ** 3
+
+# L2 ID -> mesh centroid/area lookup tables live here
+L2_MESH_STATS_DIR = CACHE_ROOT + 'l2_mesh_stats/'
+L2_MESH_STATS = {'centroid': (np.float64, (3, )),
+                 'area': (np.float64, ())}
+
+# Keep track of the stores we have already initialized
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class SortedIdStore:
+    """On-disk lookup table mapping uint64 IDs to one or more value columns.
+
+    The table is made up of one or more "segments". Each segment holds a
+    sorted uint64 array of IDs and, for each value column, a separate array
+    of the same length. All arrays are stored as plain `.npy` files and are
+    memory-mapped when loaded, i.e. a lookup is a `searchsorted` against the
+    local files (newest segment first) and never requires loading the full
+    table into memory.
+
+    Updates are written as a new (small) segment. To keep the number of
+    segments low, the newest segments are merged whenever the older of two
+    is not much bigger than the newer one. Consequently, large segments are
+    rewritten only rarely and the total cost of `N` inserted IDs grows with
+    `N log N` rather than quadratically.
+
+    The list of current segments is kept in a small pointer file which is
+    replaced atomically. This way, readers (including other processes) never
+    see a half-written table. Writers hold an inter-process lock and only
+    remove old segments after the pointer has been replaced; readers that
+    find a segment gone simply re-read the pointer.
+
+    Parameters
+    ----------
+    path :      str | pathlib.Path
+                Directory for this table. Will be created if it doesn't exist.
+    columns :   dict
+                Maps column names to `(dtype, shape)` tuples where `shape` is
+                the shape of a single value - e.g. `{'root': (np.int64, ())}`
+                or `{'rep_coord_nm': (np.float32, (3, ))}`.
+
+    """
+
+    # Two segments are merged if the older one is at most this many times
+    # bigger than the newer one
+    merge_factor = 2
+
+    def __init__(self, path, columns):
+        self.path = Path(path).expanduser().absolute()
+        self.columns = {k: (np.dtype(v[0]), tuple(v[1])) for k, v in columns.items()}
+        self._lock = threading.RLock()
+        self._segs = None
+        self._arrays = None
+
+    def __len__(self):
+        segments = self._load()
+        if len(segments) <= 1:
+            return len(segments[0]['id']) if segments else 0
+        # IDs can show up in multiple segments
+        return len(self._merge(segments)['id'])
+
+    def __repr__(self):
+        return f'<{type(self).__name__}(path={self.path}, columns={list(self.columns)})>'
+
+    @property
+    def _pointer(self):
+        return self.path / 'CURRENT'
+
+    def _current_segments(self):
+        """Numbers of the current segments (oldest first)."""
+        try:
+            return [int(s) for s in self._pointer.read_text().split()]
+        except (FileNotFoundError, ValueError):
+            return []
+
+    def _empty(self):
+        arrays = {'id': np.zeros(0, dtype=np.uint64)}
+        for col, (dtype, shape) in self.columns.items():
+            arrays[col] = np.zeros((0, ) + shape, dtype=dtype)
+        return arrays
+
+    def _load(self):
+        """Load (memory-map) the current segments (oldest first)."""
+        with self._lock:
+            segs = self._current_segments()
+            while segs != self._segs:
+                try:
+                    arrays = [{c: np.load(self.path / f'{c}.{s}.npy', mmap_mode='r')
+                               for c in ['id'] + list(self.columns)}
+                              for s in segs]
+                except FileNotFoundError:
+                    # Writers replace the pointer before removing segments,
+                    # so if it has changed we just have to try again
+                    current = self._current_segments()
+                    if current != segs:
+                        segs = current
+                        continue
+                    navis.config.logger.warning(f'{self} is missing segment '
+                                                'files - treating as empty.')
+                    arrays = []
+                self._segs, self._arrays = segs, arrays
+            return self._arrays
+
+    @contextlib.contextmanager
+    def _write_lock(self):
+        """Lock this table for writing (across threads and processes)."""
+        with self._lock:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(self.path / 'LOCK', 'a+') as f:
+                _lock_file(f)
+                try:
+                    yield
+                finally:
+                    _unlock_file(f)
+
+    def lookup(self, ids):
+        """Look up given IDs.
+
+        Parameters
+        ----------
+        ids :       (N, ) array-like
+                    IDs to look up.
+
+        Returns
+        -------
+        found :     (N, ) bool array
+                    Whether a given ID was found in the table.
+        values :    dict
+                    Maps column name to an array of values for the IDs that
+                    were found, i.e. `values[col][i]` belongs to
+                    `ids[found][i]`.
+
+        """
+        ids = np.asarray(ids).astype(np.uint64, copy=False)
+        segments = self._load()
+
+        found = np.zeros(len(ids), dtype=bool)
+        values = {col: np.zeros((len(ids), ) + shape, dtype=dtype)
+                  for col, (dtype, shape) in self.columns.items()}
+
+        # Newer segments take precedence
+        todo = np.arange(len(ids))
+        for arrays in segments[::-1]:
+            keys = arrays['id']
+            if not len(keys) or not len(todo):
+                continue
+
+            ix = np.searchsorted(keys, ids[todo])
+            ix[ix >= len(keys)] = len(keys) - 1
+            hit = keys[ix] == ids[todo]
+
+            for col in self.columns:
+                values[col][todo[hit]] = arrays[col][ix[hit]]
+            found[todo[hit]] = True
+            todo = todo[~hit]
+
+        return found, {c: values[c][found] for c in self.columns}
+
+    def update(self, ids, **values):
+        """Add or overwrite entries.
+
+        Parameters
+        ----------
+        ids :       (N, ) array-like
+                    IDs to add.
+        **values
+                    One (N, ...) array for each column of this table.
+
+        """
+        ids = np.asarray(ids).astype(np.uint64, copy=False)
+        missing = set(self.columns) - set(values)
+        if missing:
+            raise ValueError(f'Missing values for column(s): {", ".join(missing)}')
+
+        if not len(ids):
+            return
+
+        new = {'id': ids}
+        for col, (dtype, shape) in self.columns.items():
+            new[col] = np.asarray(values[col], dtype=dtype).reshape((len(ids), ) + shape)
+        # Sort and de-duplicate (first occurrence wins)
+        new = self._merge([new])
+
+        with self._write_lock():
+            segments = list(self._load())
+            segs = list(self._segs)
+
+            # Merge with the newest segments while those are not much bigger
+            while segments and len(segments[-1]['id']) <= self.merge_factor * len(new['id']):
+                new = self._merge([segments.pop(), new])
+                segs.pop()
+
+            self._write(segs, new)
+
+    def _merge(self, segments):
+        """Merge segments (oldest first) into a single sorted segment."""
+        # Newest go first so that they take precedence when we de-duplicate
+        ids = np.concatenate([s['id'] for s in segments[::-1]])
+
+        # `np.unique` returns the index of the first occurrence
+        ids, ix = np.unique(ids, return_index=True)
+        merged = {'id': ids}
+        for col in self.columns:
+            merged[col] = np.concatenate([s[col] for s in segments[::-1]])[ix]
+        return merged
+
+    def _write(self, keep, new=None):
+        """Write new segment and make `keep` + new segment current.
+
+        Must be called while holding the write lock.
+        """
+        old = self._current_segments()
+
+        segs = list(keep)
+        if new is not None:
+            n = max(old + segs, default=0) + 1
+            # Skip over any leftovers (e.g. from a crashed writer)
+            while (self.path / f'id.{n}.npy').exists():
+                n += 1
+
+            for col, arr in new.items():
+                np.save(self.path / f'{col}.{n}.npy', arr)
+            segs.append(n)
+
+        tmp = self.path / f'CURRENT.{os.getpid()}.{threading.get_ident()}'
+        tmp.write_text(' '.join(str(s) for s in segs))
+        os.replace(tmp, self._pointer)
+
+        # Drop our reference to the old memory-maps before removing files
+        self._segs, self._arrays = None, None
+        for s in set(old) - set(segs):
+            for col in ['id'] + list(self.columns):
+                try:
+                    (self.path / f'{col}.{s}.npy').unlink()
+                except OSError:
+                    # On Windows memory-mapped files can't be removed
+                    pass
+
+    def compact(self):
+        """Merge all segments into one."""
+        with self._write_lock():
+            segments = self._load()
+            if len(segments) > 1:
+                self._write([], self._merge(segments))
+
+    def clear(self):
+        """Remove all entries from this table."""
+        with self._write_lock():
+            self._write([])
+
+
+def _lock_file(f):
+    """Acquire an exclusive lock on given (open) file. Blocks until acquired."""
+    if os.name == 'nt':
+        import msvcrt
+        f.seek(0)
+        while True:
+            try:
+                # This retries for ~10s before giving up
+                msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                return
+            except OSError:
+                time.sleep(.1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def _unlock_file(f):
+    """Release lock acquired with :func:`_lock_file`."""
+    if os.name == 'nt':
+        import msvcrt
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def get_store(path, columns):
+    """Get (cached) store for given path."""
+    path = Path(path).expanduser().absolute()
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = SortedIdStore(path, columns)
+        return _stores[path]
+
+
+def dataset_key(dataset):
+    """Turn dataset (name, URL or CloudVolume) into a name usable as directory.
+
+    Returns ``None`` if no such key can be generated.
+    """
+    if "CloudVolume" in str(type(dataset)):
+        dataset = getattr(dataset, 'path', None)
+
+    if not isinstance(dataset, str):
+        return None
+
+    # Map URLs back onto the dataset names (e.g. "production")
+    for k, v in FLYWIRE_URLS.items():
+        if dataset == v:
+            return k
+
+    # Anything that isn't already a simple name gets hashed
+    if not re.fullmatch(r'[\w\-.]+', dataset):
+        return hashlib.md5(dataset.encode()).hexdigest()
+
+    return dataset
+
+
+def timestamp_key(timestamp):
+    """Turn a timestamp into a cache key.
+
+    Parameters
+    ----------
+    timestamp :     None | int | float | str | datetime.datetime
+                    The (already parsed) timestamp. `None` is interpreted
+                    as "live". Int or float must be unix timestamp, strings
+                    must be ISO 8601.
+
+    Returns
+    -------
+    key :           str
+                    "live" or e.g. "ts1658349852000" (milliseconds since epoch).
+                    Returns ``None`` if the timestamp is in the future (i.e.
+                    the data is not yet frozen and hence not cacheable).
+
+    """
+    if timestamp is None:
+        return 'live'
+
+    if isinstance(timestamp, np.datetime64):
+        timestamp = str(timestamp)
+
+    if isinstance(timestamp, str):
+        timestamp = dt.datetime.fromisoformat(timestamp)
+
+    if isinstance(timestamp, dt.datetime):
+        if timestamp.tzinfo is None:
+            timestamp = timestamp.replace(tzinfo=dt.timezone.utc)
+        timestamp = timestamp.timestamp()
+
+    if not isinstance(timestamp, (int, float, np.integer, np.floating)):
+        raise TypeError(f'Unable to parse timestamp of type "{type(timestamp)}"')
+
+    # Timestamps in the future are effectively "live" and hence not frozen
+    if timestamp >= dt.datetime.now(tz=dt.timezone.utc).timestamp():
+        return None
+
+    return f'ts{int(round(timestamp * 1000))}'
+
+
+def get_sv2root_cache(dataset, timestamp, stop_layer=10):
+    """Get supervoxel -> root lookup table for given dataset and timestamp.
+
+    Parameters
+    ----------
+    dataset :       str | CloudVolume
+    timestamp :     None | int | float | str | datetime.datetime
+                    See :func:`timestamp_key`.
+    stop_layer :    int
+
+    Returns
+    -------
+    SortedIdStore
+                    Returns ``None`` if no cache can be used for this
+                    combination of dataset and timestamp.
+
+    """
+    ds = dataset_key(dataset)
+    ts = timestamp_key(timestamp)
+
+    if ds is None or ts is None:
+        return None
+
+    return get_store(Path(SV2ROOT_CACHE_DIR) / ds / f'layer{stop_layer}' / ts,
+                     columns={'root': (np.int64, ())})
+
+
+def get_l2_attribute_cache(dataset, attribute):
+    """Get L2 ID -> attribute lookup table.
+
+    L2 IDs are immutable and so are their attributes in the L2 cache. Hence,
+    these tables never need invalidating.
+
+    Parameters
+    ----------
+    dataset :       str | CloudVolume
+    attribute :     str
+                    Name of the attribute - see ``L2_ATTRIBUTES``.
+
+    Returns
+    -------
+    SortedIdStore
+                    With a single ``value`` column. Returns ``None`` if no
+                    cache can be used for this dataset or attribute.
+
+    """
+    ds = dataset_key(dataset)
+    if ds is None or attribute not in L2_ATTRIBUTES:
+        return None
+
+    return get_store(Path(L2_CACHE_DIR) / ds / attribute,
+                     columns={'value': L2_ATTRIBUTES[attribute]})
+
+
+def get_svoxel_cache():
+    """Get the root -> supervoxels cache.
+
+    Supervoxels are stored as raw uint64 bytes. Use :func:`get_cached_ids`
+    and :func:`cache_ids` to read/write entries.
+
+    Returns
+    -------
+    diskcache.Cache
+
+    """
+    return Cache(directory=SVOXEL_CACHE_DIR,
+                 size_limit=SVOXEL_CACHE_SIZE_LIMIT,
+                 eviction_policy='least-recently-used')
+
+
+def get_l2_leaves_cache(dataset):
+    """Get the root -> L2 IDs cache for given dataset.
+
+    L2 IDs are stored as raw uint64 bytes. Use :func:`get_cached_ids` and
+    :func:`cache_ids` to read/write entries.
+
+    Returns
+    -------
+    diskcache.Cache
+                    Returns ``None`` if no cache can be used for this dataset.
+
+    """
+    ds = dataset_key(dataset)
+    if ds is None:
+        return None
+
+    return Cache(directory=L2_LEAVES_CACHE_DIR + ds,
+                 size_limit=L2_LEAVES_CACHE_SIZE_LIMIT,
+                 eviction_policy='least-recently-used')
+
+
+def get_cached_ids(cache, root):
+    """Get IDs (supervoxels or L2 IDs) for given root from cache.
+
+    Returns ``None`` if root is not in the cache.
+    """
+    ids = cache.get(np.int64(root), default=None)
+    if ids is None:
+        return None
+    if isinstance(ids, bytes):
+        return np.frombuffer(ids, dtype=np.uint64).copy()
+    # Older versions of fafbseg pickled the arrays
+    return np.asarray(ids, dtype=np.uint64)
+
+
+def cache_ids(cache, root, ids):
+    """Write IDs (supervoxels or L2 IDs) for given root to cache."""
+    cache.set(np.int64(root), np.asarray(ids, dtype=np.uint64).tobytes())
+
+
+def find_cached_ancestors(root_ids, cache, client, batch_size=1000):
+    """Find roots that have at least one ancestor in the cache.
+
+    Deriving IDs from the lineage only pays off if some ancestor is already
+    cached. Checking this takes one (batched) ``get_past_ids`` query instead
+    of a full lineage walk per root.
+
+    Parameters
+    ----------
+    root_ids :      iterable of int
+                    Root IDs to check.
+    cache :         diskcache.Cache
+                    Root -> IDs cache (see e.g. :func:`get_svoxel_cache`).
+    client :        CAVEclient
+    batch_size :    int
+                    Number of roots per query.
+
+    Returns
+    -------
+    set
+                    Those of `root_ids` with at least one cached ancestor.
+
+    """
+    root_ids = np.asarray(list(root_ids), dtype=np.int64)
+    get_past_ids = retry(client.chunkedgraph.get_past_ids)
+
+    has_ancestor = set()
+    for i in range(0, len(root_ids), batch_size):
+        batch = root_ids[i:i + batch_size]
+        try:
+            past = get_past_ids(batch)['past_id_map']
+        except Exception as e:
+            # Not being able to check just means we fetch from scratch
+            navis.config.logger.debug(f'Failed to fetch past IDs: {e}')
+            continue
+        for r, ids in past.items():
+            r = int(r)
+            if any(int(p) != r and np.int64(p) in cache for p in ids):
+                has_ancestor.add(r)
+
+    return has_ancestor
+
+
+def get_l2_mesh_cache(dataset):
+    """Get the L2 ID -> mesh cache for given dataset.
+
+    Meshes are stored as raw bytes. Use :func:`get_cached_mesh` and
+    :func:`cache_mesh` to read/write entries.
+
+    Returns
+    -------
+    diskcache.Cache
+                    Returns ``None`` if no cache can be used for this dataset.
+
+    """
+    ds = dataset_key(dataset)
+    if ds is None:
+        return None
+
+    return Cache(directory=L2_MESH_CACHE_DIR + ds,
+                 size_limit=L2_MESH_CACHE_SIZE_LIMIT,
+                 eviction_policy='least-recently-used')
+
+
+def get_l2_mesh_stats_cache(dataset):
+    """Get L2 ID -> mesh centroid and area lookup table.
+
+    Returns
+    -------
+    SortedIdStore
+                    With ``centroid`` and ``area`` columns. Returns ``None``
+                    if no cache can be used for this dataset.
+
+    """
+    ds = dataset_key(dataset)
+    if ds is None:
+        return None
+
+    return get_store(Path(L2_MESH_STATS_DIR) / ds, columns=L2_MESH_STATS)
+
+
+def get_cached_mesh(cache, l2_id):
+    """Get mesh for given L2 ID from cache.
+
+    Returns
+    -------
+    (vertices, faces)
+                    Float32 (N, 3) vertices and uint32 (M, 3) faces. Returns
+                    ``None`` if L2 ID is not in the cache.
+
+    """
+    data = cache.get(np.int64(l2_id), default=None)
+    if data is None:
+        return None
+    n_verts, n_faces = np.frombuffer(data[:16], dtype=np.uint64)
+    verts = np.frombuffer(data, dtype=np.float32, count=n_verts * 3, offset=16)
+    faces = np.frombuffer(data, dtype=np.uint32, count=n_faces * 3,
+                          offset=16 + int(n_verts) * 12)
+    return verts.reshape(-1, 3).copy(), faces.reshape(-1, 3).copy()
+
+
+def cache_mesh(cache, l2_id, vertices, faces):
+    """Write mesh for given L2 ID to cache."""
+    vertices = np.asarray(vertices, dtype=np.float32).reshape(-1, 3)
+    faces = np.asarray(faces, dtype=np.uint32).reshape(-1, 3)
+    header = np.array([len(vertices), len(faces)], dtype=np.uint64)
+    cache.set(np.int64(l2_id), header.tobytes() + vertices.tobytes() + faces.tobytes())
@@ -20,8 +20,12 @@ Heavily borrows from code from Casey Schneider-Mizell's "pcg_skel"
 
 """
 
+import hashlib
+import json
 import navis
-import fastremap
+import os
+import time
+import warnings
 
 import networkx as nx
 import numpy as np
@@ -29,13 +33,27 @@ import pandas as pd
 import skeletor as sk
 import trimesh as tm
 
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.spatial import cKDTree
+
 from concurrent.futures import ThreadPoolExecutor
 from functools import partial
+from pathlib import Path
 
-from .utils import get_cloudvolume, get_cave_client, retry, inject_dataset
+from .cache import (get_l2_attribute_cache, L2_ATTRIBUTES, get_l2_leaves_cache,
+                    get_l2_mesh_cache, get_l2_mesh_stats_cache, get_cached_mesh,
+                    cache_mesh, get_cached_ids, cache_ids,
+                    find_cached_ancestors)
+from .utils import (get_cloudvolume, get_cave_client, retry, inject_dataset,
+                    get_id_decoder)
 
 __all__ = ['l2_skeleton', 'l2_dotprops', 'l2_graph', 'l2_info',
-           'find_anchor_loc']
+           'find_anchor_loc', 'L2Graph', 'l2_spatial_index',
+           'L2SpatialIndex', 'export_l2_data']
+
+# Cloudpaths of volumes for which bulk mesh downloads have failed
+NO_MESH_BYPASS = set()
 
 
 @inject_dataset()
@@ -78,39 +96,40 @@ def l2_info(root_ids, progress=True, max_threads=4, *, dataset=None):
 
     """
     if navis.utils.is_iterable(root_ids):
-        root_ids = np.unique(root_ids)
-        info = []
-        with ThreadPoolExecutor(max_workers=max_threads) as pool:
-            func = partial(l2_info, dataset=dataset)
-            futures = pool.map(func, root_ids)
-            info = [f for f in navis.config.tqdm(futures,
-                                                 desc='Fetching L2 info',
-                                                 total=len(root_ids),
-                                                 disable=not progress or len(root_ids) == 1,
-                                                 leave=False)]
-        return pd.concat(info, axis=0).reset_index(drop=True)
-
-    # Get/Initialize the CAVE client
-    client = get_cave_client(dataset=dataset)
+        root_ids = np.unique(np.asarray(root_ids, dtype=np.int64))
+    else:
+        root_ids = np.asarray([root_ids], dtype=np.int64)
 
-    get_l2_ids = partial(retry(client.chunkedgraph.get_leaves), stop_layer=2)
-    l2_ids = get_l2_ids(root_ids)
+    # Fetch L2 IDs for all roots and keep track of which root they belong to
+    l2_ids = _get_l2_leaves(root_ids, max_threads=max_threads,
+                            progress=progress, dataset=dataset)
+    n_chunks = np.array([len(l) for l in l2_ids], dtype=np.int64)
+    owner = np.repeat(np.arange(len(root_ids)), n_chunks)
+    l2_ids = np.concatenate(l2_ids) if len(l2_ids) else np.zeros(0, dtype=np.int64)
 
+    # Fetch attributes for the unique L2 IDs
     attributes = ['area_nm2', 'size_nm3', 'max_dt_nm', 'rep_coord_nm']
-    get_l2data = retry(client.l2cache.get_l2data)
-    info = get_l2data(l2_ids.tolist(), attributes=attributes)
-    n_miss = len([v for v in info.values() if not v])
-
-    row = [root_ids, len(l2_ids), n_miss]
-    info_df = pd.DataFrame([row],
-                           columns=['root_id', 'l2_chunks', 'chunks_missing'])
-
-    # Collect L2 attributes
+    l2_uni, l2_inv = np.unique(l2_ids, return_inverse=True)
+    present, info = _get_l2_attributes(l2_uni, attributes,
+                                       max_threads=max_threads,
+                                       progress=progress,
+                                       dataset=dataset)
+    l2_inv = l2_inv.ravel()
+    present = present[l2_inv]
+
+    info_df = pd.DataFrame()
+    info_df['root_id'] = root_ids
+    info_df['l2_chunks'] = n_chunks
+    info_df['chunks_missing'] = np.bincount(owner, weights=~present,
+                                            minlength=len(root_ids)).astype(int)
+
+    # Sum up L2 attributes per root
     for at in attributes:
         if at in ('rep_coord_nm', ):
             continue
 
-        summed = sum([v.get(at, 0) for v in info.values()])
+        values = np.nan_to_num(info[at][l2_inv]) * present
+        summed = np.bincount(owner, weights=values, minlength=len(root_ids))
         if at.endswith('3'):
             summed /= 1000**3
         elif at.endswith('2'):
@@ -118,23 +137,30 @@ def l2_info(root_ids, progress=True, max_threads=4, *, dataset=None):
         else:
             summed /= 1000
 
-        info_df[at.replace('_nm', '_um')] = [summed]
+        info_df[at.replace('_nm', '_um')] = summed
 
-    # Check bounding box
-    pts = np.array([v['rep_coord_nm'] for v in info.values() if v])
+    # Get bounding boxes from the representative coordinates. Because L2 IDs
+    # are ordered by root, we can reduce over contiguous stretches
+    pts = info['rep_coord_nm'][l2_inv][present]
+    pts_owner = owner[present]
+    n_pts = np.bincount(pts_owner, minlength=len(root_ids))
+    has_pts = np.where(n_pts > 0)[0]
+    starts = np.concatenate(([0], np.cumsum(n_pts)[:-1]))[has_pts]
 
-    if len(pts) > 1:
-        bounds = [v for l in zip(pts.min(axis=0), pts.max(axis=0)) for v in l]
-    elif len(pts) == 1:
-        pt = pts[0]
-        rad = [v['max_dt_nm'] for v in info.values() if v][0] / 2
-        bounds = [pt[0] - rad, pt[0] + rad,
-                  pt[1] - rad, pt[1] + rad,
-                  pt[2] - rad, pt[2] + rad]
-        bounds = [int(co) for co in bounds]
-    else:
-        bounds = None
-    info_df['bounds_nm'] = [bounds]
+    bounds = np.full((len(root_ids), 6), np.nan)
+    if len(pts):
+        bounds[has_pts, 0::2] = np.minimum.reduceat(pts, starts, axis=0)
+        bounds[has_pts, 1::2] = np.maximum.reduceat(pts, starts, axis=0)
+
+    # For roots with a single L2 chunk use the chunk's radius
+    single = n_pts == 1
+    if any(single):
+        rad = np.nan_to_num(info['max_dt_nm'][l2_inv][present] / 2)[starts[single[has_pts]]]
+        bounds[single, 0::2] -= rad.reshape(-1, 1)
+        bounds[single, 1::2] += rad.reshape(-1, 1)
+
+    info_df['bounds_nm'] = [[int(v) for v in b] if n else None
+                            for b, n in zip(bounds, n_pts)]
 
     info_df.rename({'max_dt_um': 'length_um'},
                    axis=1, inplace=True)
@@ -164,41 +190,29 @@ def l2_chunk_info(l2_ids, progress=True, chunk_size=2000, *, dataset=None):
     pandas.DataFrame
 
     """
-    # Get/Initialize the CAVE client
-    client = get_cave_client(dataset=dataset)
+    l2_ids = np.asarray(l2_ids, dtype=np.int64).ravel()
 
     # Get the L2 representative coordinates, vectors and (if required) volume
     attributes = ['rep_coord_nm', 'pca', 'size_nm3']
+    present, info = _get_l2_attributes(l2_ids, attributes,
+                                       chunk_size=chunk_size,
+                                       progress=progress,
+                                       dataset=dataset)
 
-    l2_info = {}
-    with navis.config.tqdm(desc='Fetching L2 info',
-                           disable=not progress,
-                           total=len(l2_ids),
-                           leave=False) as pbar:
-        func = retry(client.l2cache.get_l2data)
-        for chunk_ix in np.arange(0, len(l2_ids), chunk_size):
-            chunk = l2_ids[chunk_ix: chunk_ix + chunk_size]
-            l2_info.update(func(chunk.tolist(), attributes=attributes))
-            pbar.update(len(chunk))
-
-    # L2 chunks without info will show as empty dictionaries
-    # Let's drop them to make our life easier (speeds up indexing too)
-    l2_info = {k: v for k, v in l2_info.items() if v}
-
-    if l2_info:
-        pts = np.vstack([i['rep_coord_nm'] for i in l2_info.values()])
-        vec = np.vstack([i.get('pca', [[None, None, None]])[0] for i in l2_info.values()])
-        sizes = np.array([i['size_nm3'] for i in l2_info.values()])
+    # Drop L2 chunks without info
+    if any(present):
+        pts = info['rep_coord_nm'][present]
+        vec = info['pca'][present][:, 0]
 
         info_df = pd.DataFrame()
-        info_df['id'] = list(l2_info.keys())
+        info_df['id'] = l2_ids[present].astype(str)
         info_df['x'] = (pts[:, 0] / 4).astype(int)
         info_df['y'] = (pts[:, 1] / 4).astype(int)
         info_df['z'] = (pts[:, 2] / 40).astype(int)
         info_df['vec_x'] = vec[:, 0]
         info_df['vec_y'] = vec[:, 1]
         info_df['vec_z'] = vec[:, 2]
-        info_df['size_nm3'] = sizes
+        info_df['size_nm3'] = info['size_nm3'][present]
     else:
         info_df = pd.DataFrame([], columns=['id',
                                             'x', 'y', 'z',
@@ -208,6 +222,457 @@ def l2_chunk_info(l2_ids, progress=True, chunk_size=2000, *, dataset=None):
     return info_df
 
 
+@inject_dataset()
+def export_l2_data(root_ids, path, attributes=('rep_coord_nm', 'pca', 'size_nm3',
+                                               'area_nm2', 'max_dt_nm'),
+                   shard_size=1000, max_threads=4, retries=3, cooldown=5,
+                   progress=True, *, dataset=None):
+    """Export L2 attributes for many neurons to Parquet files.
+
+    Root IDs are split into shards of ``shard_size`` neurons. For each shard,
+    the L2 IDs and L2 attributes are fetched (concurrently) and written to
+    a separate Parquet file in ``path``. Completed shards are recorded in a
+    manifest (``path/_manifest.json``): if the export is interrupted, simply
+    run it again with the same parameters and it will pick up where it left
+    off. Shards that failed repeatedly are skipped and retried on the next
+    run.
+
+    The output can be read in one go via e.g. ``pandas.read_parquet(path)``
+    or lazily via ``pyarrow.dataset.dataset(path)``.
+
+    Parameters
+    ----------
+    root_ids :      list of int
+                    Root IDs to export.
+    path :          str | pathlib.Path
+                    Directory to write to. Will be created if it doesn't
+                    exist.
+    attributes :    list of str
+                    L2 attributes to export. Multi-dimensional attributes are
+                    flattened into separate columns (e.g. ``rep_coord_nm``
+                    becomes ``rep_coord_nm_x``, ``rep_coord_nm_y`` and
+                    ``rep_coord_nm_z``).
+    shard_size :    int
+                    Number of root IDs per shard (i.e. per file).
+    max_threads :   int
+                    Number of parallel requests to make when fetching L2 IDs
+                    and L2 attributes.
+    retries :       int
+                    Number of attempts per shard before it is skipped.
+    cooldown :      int | float
+                    Cooldown in seconds between attempts. Every subsequent
+                    attempt will delay by an additional ``cooldown``.
+    progress :      bool
+                    Whether to show a progress bar.
+    dataset :       "public" | "production" | "sandbox" | "flat_630", optional
+                    Against which FlyWire dataset to query. If ``None`` will fall
+                    back to the default dataset (see
+                    :func:`~fafbseg.flywire.set_default_dataset`).
+
+    Returns
+    -------
+    dict
+                    The manifest.
+
+    Examples
+    --------
+    >>> from fafbseg import flywire
+    >>> _ = flywire.export_l2_data([720575940614131061, 720575940631693610],
+    ...                            path='~/l2_export')
+    >>> import pandas as pd
+    >>> df = pd.read_parquet('~/l2_export')                     # doctest: +SKIP
+
+    """
+    root_ids = np.unique(np.asarray(navis.utils.make_iterable(root_ids)).astype(np.int64))
+    attributes = list(navis.utils.make_iterable(attributes))
+
+    unknown = [at for at in attributes if at not in L2_ATTRIBUTES]
+    if unknown:
+        raise ValueError(f'Unknown L2 attribute(s): {", ".join(unknown)}')
+
+    path = Path(path).expanduser()
+    path.mkdir(parents=True, exist_ok=True)
+    manifest_path = path / '_manifest.json'
+
+    params = {'dataset': str(dataset),
+              'attributes': attributes,
+              'shard_size': int(shard_size),
+              'n_roots': len(root_ids),
+              'roots_md5': hashlib.md5(root_ids.tobytes()).hexdigest()}
+
+    if manifest_path.is_file():
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if any(manifest.get(k) != v for k, v in params.items()):
+            raise ValueError(f'"{path}" contains an export with different '
+                             'root IDs or parameters. Please use a different '
+                             'directory or remove the existing export.')
+    else:
+        manifest = dict(params, shards={}, failed={})
+
+    def write_manifest():
+        tmp = path / '_manifest.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, manifest_path)
+
+    write_manifest()
+
+    shards = [(f'{i:05d}', root_ids[i * shard_size:(i + 1) * shard_size])
+              for i in range(int(np.ceil(len(root_ids) / shard_size)))]
+    todo = [(k, r) for k, r in shards if k not in manifest['shards']]
+
+    for key, roots in navis.config.tqdm(todo,
+                                        desc='Exporting shards',
+                                        disable=not progress,
+                                        initial=len(shards) - len(todo),
+                                        total=len(shards),
+                                        leave=False):
+        for i in range(1, retries + 1):
+            try:
+                df = _l2_export_table(roots, attributes,
+                                      max_threads=max_threads,
+                                      dataset=dataset)
+                break
+            except KeyboardInterrupt:
+                raise
+            except Exception as e:
+                if i >= retries:
+                    navis.config.logger.warning(f'Failed to export shard {key} '
+                                                f'after {retries} attempts: {e}')
+                    manifest['failed'][key] = str(e)
+                    df = None
+                    break
+                time.sleep(cooldown * i)
+
+        if df is None:
+            write_manifest()
+            continue
+
+        # Write to temporary file first so we never leave a partial shard
+        fname = f'shard-{key}.parquet'
+        tmp = path / f'.{fname}.tmp'
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, path / fname)
+
+        manifest['failed'].pop(key, None)
+        manifest['shards'][key] = {'file': fname,
+                                   'n_roots': len(roots),
+                                   'n_l2': len(df)}
+        write_manifest()
+
+    if manifest['failed']:
+        navis.config.logger.warning(f'{len(manifest["failed"])} shard(s) failed. '
+                                    'Run the export again to retry.')
+
+    return manifest
+
+
+def _l2_export_table(root_ids, attributes, max_threads=4, *, dataset):
+    """Fetch L2 IDs and L2 attributes for given roots as flat table."""
+    l2_ids = _get_l2_leaves(root_ids, max_threads=max_threads,
+                            progress=False, dataset=dataset)
+    n_ids = np.array([len(i) for i in l2_ids], dtype=np.int64)
+    l2_ids = np.concatenate(l2_ids).astype(np.int64) if len(l2_ids) else np.zeros(0, dtype=np.int64)
+
+    present, info = _get_l2_attributes(l2_ids, attributes,
+                                       max_threads=max_threads,
+                                       progress=False,
+                                       dataset=dataset)
+
+    data = {'root_id': np.repeat(root_ids, n_ids),
+            'l2_id': l2_ids,
+            'present': present}
+    for at in attributes:
+        values = info[at].reshape(len(l2_ids), -1)
+        if info[at].ndim == 1:
+            data[at] = values[:, 0]
+        elif at == 'rep_coord_nm':
+            for i, co in enumerate('xyz'):
+                data[f'{at}_{co}'] = values[:, i]
+        else:
+            for i in range(values.shape[1]):
+                data[f'{at}_{i}'] = values[:, i]
+
+    return pd.DataFrame(data)
+
+
+def _get_l2_attributes(l2_ids, attributes, chunk_size=2000, max_threads=1,
+                       progress=True, desc='Fetching L2 info', *, dataset):
+    """Fetch attributes for given L2 IDs.
+
+    Attributes are looked up in the local cache first (see
+    ``fafbseg.flywire.cache``) and only the missing ones are fetched from
+    the L2 cache. Fetched attributes are added to the local cache.
+
+    Parameters
+    ----------
+    l2_ids :        (N, ) array
+                    L2 IDs. Can contain duplicates.
+    attributes :    list of str
+                    Attributes to fetch.
+    chunk_size :    int
+                    Number of L2 IDs per query.
+    max_threads :   int
+                    Number of parallel queries.
+
+    Returns
+    -------
+    present :       (N, ) bool array
+                    Whether a given L2 chunk is present in the L2 cache.
+    values :        dict
+                    Maps each attribute to an (N, ...) float array. Values for
+                    L2 chunks that are not present or don't have a given
+                    attribute (e.g. `pca` for very small chunks) are NaN.
+
+    """
+    l2_ids = np.asarray(l2_ids, dtype=np.int64).ravel()
+    uni, inv = np.unique(l2_ids, return_inverse=True)
+    inv = inv.ravel()
+
+    present = np.zeros(len(uni), dtype=bool)
+    values = {}
+    miss = {}
+    stores = {}
+    for at in attributes:
+        dtype, shape = L2_ATTRIBUTES.get(at, (np.float64, ()))
+        values[at] = np.full((len(uni), ) + shape, np.nan, dtype=dtype)
+        stores[at] = get_l2_attribute_cache(dataset, at)
+        if stores[at] is None:
+            miss[at] = np.ones(len(uni), dtype=bool)
+            continue
+        found, cached = stores[at].lookup(uni)
+        values[at][found] = cached['value']
+        # Only chunks that exist in the L2 cache are ever cached locally
+        present |= found
+        miss[at] = ~found
+
+    # Fetch attributes for chunks that are missing any of them
+    to_fetch = np.zeros(len(uni), dtype=bool)
+    for at in attributes:
+        to_fetch |= miss[at]
+    to_fetch = np.where(to_fetch)[0]
+    fetch_at = [at for at in attributes if any(miss[at][to_fetch])]
+
+    if len(to_fetch) and fetch_at:
+        client = get_cave_client(dataset=dataset)
+        get_l2data = retry(client.l2cache.get_l2data)
+        batches = [to_fetch[i: i + chunk_size] for i in range(0, len(to_fetch), chunk_size)]
+        with navis.config.tqdm(desc=desc,
+                               disable=not progress,
+                               total=len(to_fetch),
+                               leave=False) as pbar, \
+             ThreadPoolExecutor(max_workers=max(max_threads, 1)) as pool:
+            futures = pool.map(lambda ix: get_l2data(uni[ix].tolist(),
+                                                     attributes=fetch_at),
+                               batches)
+            for ix, info in zip(batches, futures):
+                # L2 chunks without info will show as empty dictionaries
+                info = [info.get(str(l2), {}) for l2 in uni[ix]]
+                has_info = np.array([bool(v) for v in info], dtype=bool)
+                present[ix[has_info]] = True
+                for at in fetch_at:
+                    this = [v[at] for v in info if v and at in v]
+                    if not this:
+                        continue
+                    has_at = np.array([at in v for v in info], dtype=bool)
+                    values[at][ix[has_at]] = this
+                pbar.update(len(ix))
+
+        # Update the local caches with chunks that exist in the L2 cache
+        # (attributes missing for these will stay NaN forever)
+        fetched = to_fetch[present[to_fetch]]
+        for at in fetch_at:
+            if stores[at] is None or not len(fetched):
+                continue
+            try:
+                stores[at].update(uni[fetched], value=values[at][fetched])
+            except OSError as e:
+                navis.config.logger.debug(f'Failed to cache L2 attribute "{at}": {e}')
+
+    return present[inv], {at: v[inv] for at, v in values.items()}
+
+
+def _get_l2_leaves(root_ids, max_threads=4, progress=True, *, dataset):
+    """Fetch L2 IDs for given root IDs.
+
+    Root IDs are immutable and so is the set of L2 IDs making up a root.
+    Hence we keep a local cache (see ``fafbseg.flywire.cache``). Roots not in
+    the cache are derived from their ancestors if any of those are cached (see
+    :func:`_l2_leaves_from_lineage`) and fetched directly otherwise.
+
+    Parameters
+    ----------
+    root_ids :      (N, ) array
+                    Root IDs. Can contain duplicates.
+    max_threads :   int
+                    Number of parallel requests to make.
+
+    Returns
+    -------
+    list
+                    List of (M, ) int64 arrays of L2 IDs - one for each root.
+
+    """
+    root_ids = np.asarray(root_ids, dtype=np.int64).ravel()
+    uni = np.unique(root_ids)
+
+    cache = get_l2_leaves_cache(dataset)
+
+    leaves = {}
+    if cache is not None:
+        for r in uni:
+            l2 = get_cached_ids(cache, r)
+            if l2 is not None:
+                leaves[r] = l2.astype(np.int64)
+
+    miss = [r for r in uni if r not in leaves]
+    if miss:
+        client = get_cave_client(dataset=dataset)
+        get_leaves = partial(retry(client.chunkedgraph.get_leaves), stop_layer=2)
+
+        # Walking the lineage is only worth it if an ancestor is cached
+        derivable = set()
+        if cache is not None:
+            derivable = find_cached_ancestors(miss, cache, client)
+
+        def _fetch(r):
+            if r in derivable:
+                derived = _l2_leaves_from_lineage(r, cache, client, dataset=dataset)
+                if derived:
+                    return derived
+            return {r: get_leaves(r)}
+
+        with ThreadPoolExecutor(max_workers=max_threads) as pool:
+            futures = pool.map(_fetch, miss)
+            for r, res in navis.config.tqdm(zip(miss, futures),
+                                            desc='Fetching L2 IDs',
+                                            total=len(miss),
+                                            disable=not progress or len(miss) == 1,
+                                            leave=False):
+                leaves[r] = np.asarray(res[r], dtype=np.int64)
+                if cache is not None:
+                    for k, v in res.items():
+                        cache_ids(cache, k, v)
+
+    if cache is not None:
+        cache.close()
+
+    return [leaves[r] for r in root_ids]
+
+
+def _l2_leaves_from_lineage(root, cache, client, max_depth=10, *, dataset):
+    """Derive L2 IDs for given root from cached ancestors.
+
+    An edit only changes L2 IDs in the chunks that contain the supervoxels
+    of the added or removed edges. So we can take the L2 IDs of the parent(s),
+    drop those in the affected chunks and fetch the L2 IDs for the new root
+    in just the affected chunks. For splits, we additionally keep only those
+    L2 IDs of the parent that ended up in the new root.
+
+    Returns
+    -------
+    dict | None
+                    ``{root_id: l2_ids}`` for `root` and any other root
+                    derived along the way. ``None`` if L2 IDs could not be
+                    derived.
+
+    """
+    from .segmentation import supervoxels_to_roots
+
+    root = int(root)
+    try:
+        G = client.chunkedgraph.get_lineage_graph(root, as_nx_graph=True)
+    except Exception as e:
+        navis.config.logger.debug(f'Failed to fetch lineage for {root}: {e}')
+        return None
+
+    vol = get_cloudvolume(dataset)
+    ch_size = np.array(vol.meta.graph_chunk_size)
+    offset = np.array(vol.meta.voxel_offset(0))
+    get_leaves = retry(client.chunkedgraph.get_leaves)
+
+    _chunk_pos = get_id_decoder(vol).chunk_position
+
+    derived = {}
+
+    def _get_l2(n, depth):
+        if n in derived:
+            return derived[n]
+
+        l2 = get_cached_ids(cache, n)
+        if l2 is not None:
+            return l2.astype(np.int64)
+
+        pred = list(G.predecessors(n))
+        if not pred or depth >= max_depth:
+            return None
+
+        parents = [_get_l2(p, depth + 1) for p in pred]
+        if any(p is None for p in parents):
+            return None
+
+        # The operation that created `n` is recorded on its predecessors
+        op_id = G.nodes[pred[0]].get('operation_id', None)
+        ts = G.nodes[n].get('timestamp', None)
+        if op_id is None or ts is None:
+            return None
+
+        details = client.chunkedgraph.get_operation_details([op_id])
+        details = details.get(str(op_id), details.get(op_id, {}))
+        edges = [e for k in ('added_edges', 'removed_edges')
+                 for e in (details.get(k, None) or [])]
+        if not len(edges):
+            return None
+
+        # Find the chunks affected by this edit
+        affected = np.unique(_chunk_pos(np.unique(np.asarray(edges, dtype=np.int64))),
+                             axis=0)
+        if len(affected) > 10:
+            return None
+
+        l2 = np.unique(np.concatenate(parents))
+        in_affected = (_chunk_pos(l2)[:, None, :] == affected[None, :, :]).all(axis=2).any(axis=1)
+        l2 = l2[~in_affected]
+
+        if len(pred) == 1 and len(l2):
+            # Split: keep only L2 IDs that ended up in `n`. If `n` is among
+            # the roots right after the edit, this is complete since a root ID
+            # never changes
+            roots = supervoxels_to_roots(l2,
+                                         timestamp=ts + 1,
+                                         progress=False,
+                                         dataset=dataset)
+            if not any(roots == n):
+                return None
+            l2 = l2[roots == n]
+
+        # Add the current L2 IDs in the affected chunks
+        new_l2 = [l2]
+        for ch in affected:
+            mn = ch * ch_size + offset
+            bounds = np.vstack((mn, mn + ch_size)).T
+            this = np.asarray(get_leaves(n, bounds=bounds, stop_layer=2),
+                              dtype=np.int64)
+            if len(this):
+                this = this[(_chunk_pos(this) == ch).all(axis=1)]
+            new_l2.append(this)
+
+        derived[n] = np.unique(np.concatenate(new_l2))
+        return derived[n]
+
+    try:
+        l2 = _get_l2(root, 0)
+    except Exception as e:
+        navis.config.logger.debug(f'Failed to derive L2 IDs for {root}: {e}')
+        return None
+
+    if l2 is None or not len(l2):
+        return None
+
+    return derived
+
+
 @inject_dataset()
 def find_anchor_loc(root_ids,
                     validate=False,
@@ -218,7 +683,9 @@ def find_anchor_loc(root_ids,
     """Find a representative coordinate.
 
     This works by querying the L2 cache and using the representative coordinate
-    for the largest L2 chunk.
+    for the largest L2 chunk (see :func:`~fafbseg.flywire.l2_spatial_index`).
+    L2 IDs and L2 info are cached locally, i.e. repeated queries for the same
+    neurons do not require any requests.
 
     Parameters
     ----------
@@ -228,7 +695,7 @@ def find_anchor_loc(root_ids,
                     If True, will validate the x/y/z position. I have yet to
                     encounter a representative coordinate that wasn't mapping
                     to the correct L2 chunk - therefore this parameter is False
-                    by default.
+                    by default. All locations are validated in bulk.
     max_threads :   int
                     Number of parallel threads to use.
     dataset :       "public" | "production" | "sandbox" | "flat_630", optional
@@ -241,107 +708,501 @@ def find_anchor_loc(root_ids,
     pandas.DataFrame
 
     """
-    if navis.utils.is_iterable(root_ids):
-        root_ids = np.asarray(root_ids).astype(np.int64)
-        root_ids_unique = np.unique(root_ids)
-        info = []
-        with ThreadPoolExecutor(max_workers=max_threads) as pool:
-            func = partial(find_anchor_loc,
-                           dataset=dataset,
-                           validate=False,
-                           progress=False)
-            futures = pool.map(func, root_ids_unique)
-            info = [f for f in navis.config.tqdm(futures,
-                                                 desc='Fetching locations',
-                                                 total=len(root_ids_unique),
-                                                 disable=not progress or len(root_ids_unique) == 1,
-                                                 leave=False)]
-        df = pd.concat(info, axis=0, ignore_index=True)
-
-        # Validate
-        if validate:
-            has_loc = ~df.x.isnull()
-            if any(has_loc):
-                from .segmentation import locs_to_supervoxels
-                sv = locs_to_supervoxels(df.loc[has_loc, ['x', 'y', 'z']].values)
-                df['supervoxel'] = None
-                df.loc[has_loc, 'supervoxel'] = sv.astype(str)  # do not change str
-
-                # Get/Initialize the CAVE client
-                client = get_cave_client(dataset=dataset)
-
-                # Get root timestamps
-                ts = client.chunkedgraph.get_root_timestamps(df.root_id.values.tolist())
-
-                df['valid'] = False
-                for i in navis.config.trange(len(df),
-                                             desc='Validating',
-                                             disable=not progress or len(df) == 1,
-                                             leave=False):
-                    if df.supervoxel.values[i]:
-                        sv = np.int64(df.supervoxel.values[i])
-                        r = client.chunkedgraph.get_root_id(sv, timestamp=ts[i])
-                        df.loc[i, 'valid'] = r == df.root_id.values[i]
-
-        # Make sure the original order is retained
-        df = df.set_index('root_id').loc[root_ids].reset_index(drop=False)
-
-        return df
-
-    root_ids = np.int64(root_ids)
-
-    # Get/Initialize the CAVE client
-    client = get_cave_client(dataset=dataset)
-
-    get_l2_ids = partial(retry(client.chunkedgraph.get_leaves), stop_layer=2)
-    l2_ids = get_l2_ids(root_ids)
-
-    get_l2data = retry(l2_chunk_info)
-    info = get_l2data(l2_ids, progress=progress)
-
-    if info.empty:
-        loc = [None, None, None]
+    is_single = not navis.utils.is_iterable(root_ids)
+    root_ids = np.asarray(root_ids).astype(np.int64).reshape(-1)
+
+    # Build (or load) the spatial index and get the biggest chunk per neuron
+    index = l2_spatial_index(root_ids, max_threads=max_threads,
+                             progress=progress, dataset=dataset)
+    locs = index.anchors(root_ids) / [4, 4, 40]
+
+    # Neurons without L2 info get `None` for their location
+    has_loc = ~np.isnan(locs[:, 0])
+    if all(has_loc):
+        xyz = locs.astype(int)
     else:
-        info.sort_values('size_nm3', ascending=False, inplace=True)
-        loc = info[['x', 'y', 'z']].values[0].tolist()
+        xyz = np.full(locs.shape, None, dtype=object)
+        xyz[has_loc] = locs[has_loc].astype(int)
 
-    df = pd.DataFrame([[root_ids] + loc],
-                      columns=['root_id', 'x', 'y', 'z'])
+    df = pd.DataFrame(xyz, columns=['x', 'y', 'z'])
+    df.insert(0, 'root_id', root_ids)
 
+    # Validate
     if validate:
-        if not isinstance(loc[0], type(None)):
+        df['supervoxel'] = None
+        df['valid'] = False
+        if any(has_loc):
             from .segmentation import locs_to_supervoxels
-            sv = locs_to_supervoxels([loc])[0]
-            df['supervoxel'] = sv
 
-            if sv:
-                ts = client.chunkedgraph.get_root_timestamps(root_ids)[0]
-                r = client.chunkedgraph.get_root_id(sv, timestamp=ts)
-                df['valid'] = r == root_ids
-            else:
-                df['valid'] = False
+            sv = np.asarray(locs_to_supervoxels(locs[has_loc].astype(int)), dtype=np.int64)
+            df.loc[has_loc, 'supervoxel'] = sv if is_single else sv.astype(str)  # do not change str
+            df.loc[has_loc, 'valid'] = _validate_supervoxels(sv, root_ids[has_loc],
+                                                             dataset=dataset)
 
     return df
 
 
+def _validate_supervoxels(sv, root_ids, *, dataset):
+    """Check whether supervoxels map to the given root IDs.
+
+    Supervoxels of roots that are still current are resolved in a single
+    live query. For the remaining ones, we pick the newest creation time
+    among their roots: all roots that still existed at that time are
+    resolved with a single query at that time. This is repeated for roots
+    that had already been edited by then - typically only a few rounds.
+
+    Returns
+    -------
+    (N, ) bool array
+
+    """
+    from .segmentation import supervoxels_to_roots, is_latest_root
+
+    sv = np.asarray(sv, dtype=np.int64)
+    root_ids = np.asarray(root_ids, dtype=np.int64)
+    valid = np.zeros(len(sv), dtype=bool)
+
+    # Supervoxel 0 (i.e. background) never maps to a neuron
+    is_bg = sv == 0
+    if all(is_bg):
+        return valid
+
+    is_latest = np.asarray(is_latest_root(root_ids, progress=False, dataset=dataset))
+    is_latest = is_latest.reshape(-1) & ~is_bg
+    if any(is_latest):
+        roots = supervoxels_to_roots(sv[is_latest], progress=False, dataset=dataset)
+        valid[is_latest] = roots == root_ids[is_latest]
+
+    remaining = np.where(~is_latest & ~is_bg)[0]
+    if len(remaining):
+        client = get_cave_client(dataset=dataset)
+        ts = np.array(client.chunkedgraph.get_root_timestamps(root_ids[remaining].tolist()))
+        while len(remaining):
+            t = ts.max()
+            # Roots are immutable: for any root that existed at `t` we can
+            # simply check which root its supervoxel mapped to at `t`
+            alive = np.asarray(is_latest_root(root_ids[remaining], timestamp=t,
+                                              progress=False, dataset=dataset))
+            alive = alive.reshape(-1) | (ts == t)
+            this = remaining[alive]
+            roots = supervoxels_to_roots(sv[this], timestamp=t, progress=False,
+                                         dataset=dataset)
+            valid[this] = roots == root_ids[this]
+            remaining, ts = remaining[~alive], ts[~alive]
+
+    return valid
+
+
 @inject_dataset()
-def l2_graph(root_ids, progress=True, *, dataset=None):
+def l2_spatial_index(root_ids, max_threads=4, progress=True, *, dataset=None):
+    """Build a spatial index over the L2 chunks of given neuron(s).
+
+    The index is built from the L2 IDs and the L2 cache's representative
+    coordinates and volumes. Both are cached locally, i.e. once the
+    respective data has been fetched, (re-)building an index for the same
+    neurons does not require any requests.
+
+    Parameters
+    ----------
+    root_ids :      int | list thereof
+                    Root ID(s) to build the index for.
+    max_threads :   int
+                    Number of parallel requests to make when fetching L2 IDs
+                    and L2 info.
+    progress :      bool
+                    Whether to show progress bars.
+    dataset :       "public" | "production" | "sandbox" | "flat_630", optional
+                    Against which FlyWire dataset to query. If ``None`` will fall
+                    back to the default dataset (see
+                    :func:`~fafbseg.flywire.set_default_dataset`).
+
+    Returns
+    -------
+    L2SpatialIndex
+
+    Examples
+    --------
+    >>> from fafbseg import flywire
+    >>> ix = flywire.l2_spatial_index([720575940614131061, 720575940631693610])
+    >>> ix.anchors()                                            # doctest: +SKIP
+    >>> ix.query([430000, 240000, 160000], radius=1000)         # doctest: +SKIP
+
+    """
+    root_ids = np.unique(np.asarray(navis.utils.make_iterable(root_ids)).astype(np.int64))
+
+    l2_ids = _get_l2_leaves(root_ids, max_threads=max_threads,
+                            progress=progress, dataset=dataset)
+    n_ids = np.array([len(i) for i in l2_ids], dtype=np.int64)
+    l2_ids = np.concatenate(l2_ids).astype(np.int64) if len(l2_ids) else np.zeros(0, dtype=np.int64)
+    owner = np.repeat(root_ids, n_ids)
+
+    present, info = _get_l2_attributes(l2_ids, ['rep_coord_nm', 'size_nm3'],
+                                       max_threads=max_threads,
+                                       progress=progress,
+                                       desc='Fetching L2 info',
+                                       dataset=dataset)
+    present &= ~np.isnan(info['rep_coord_nm'][:, 0])
+
+    return L2SpatialIndex(root_ids,
+                          owner[present],
+                          l2_ids[present],
+                          info['rep_coord_nm'][present],
+                          info['size_nm3'][present])
+
+
+class L2SpatialIndex:
+    """Spatial index over the L2 chunks of one or more neurons.
+
+    Use :func:`~fafbseg.flywire.l2_spatial_index` to build an index. All
+    coordinates are in nm.
+
+    Parameters
+    ----------
+    root_ids :  (R, ) array
+                Neurons in this index (including those without any L2 chunks
+                with L2 info).
+    owner :     (N, ) array
+                Root ID for each L2 chunk.
+    l2_ids :    (N, ) array
+                L2 IDs.
+    coords :    (N, 3) array
+                Representative coordinates of the L2 chunks.
+    sizes :     (N, ) array
+                Volumes (in nm^3) of the L2 chunks.
+
+    """
+
+    def __init__(self, root_ids, owner, l2_ids, coords, sizes):
+        self.root_ids = np.unique(np.asarray(root_ids, dtype=np.int64))
+
+        # Sort chunks by neuron
+        owner = np.asarray(owner, dtype=np.int64)
+        srt = np.argsort(owner, kind='stable')
+        self.owner = owner[srt]
+        self.l2_ids = np.asarray(l2_ids, dtype=np.int64)[srt]
+        self.coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)[srt]
+        self.sizes = np.asarray(sizes, dtype=np.float64)[srt]
+
+        # Offsets of each neuron's chunks
+        self.offsets = np.searchsorted(self.owner, self.root_ids)
+        self.offsets = np.append(self.offsets, len(self.owner))
+
+        self._tree = None
+
+    def __len__(self):
+        return len(self.l2_ids)
+
+    def __repr__(self):
+        return (f'<L2SpatialIndex with {len(self.root_ids)} neurons and '
+                f'{len(self)} L2 chunks>')
+
+    @property
+    def tree(self):
+        """KD-tree over all L2 chunks."""
+        if self._tree is None:
+            self._tree = cKDTree(self.coords)
+        return self._tree
+
+    def _root_ix(self, root_ids):
+        root_ids = np.asarray(root_ids, dtype=np.int64).reshape(-1)
+        ix = np.searchsorted(self.root_ids, root_ids).clip(max=max(len(self.root_ids) - 1, 0))
+        if not len(self.root_ids) or any(self.root_ids[ix] != root_ids):
+            miss = root_ids[~np.isin(root_ids, self.root_ids)]
+            raise KeyError(f'Root ID(s) not in index: {miss[:10]}')
+        return ix
+
+    def chunks(self, root_id):
+        """Return L2 IDs (with L2 info) for a given neuron."""
+        ix = self._root_ix(root_id)[0]
+        return self.l2_ids[self.offsets[ix]:self.offsets[ix + 1]]
+
+    def anchors(self, root_ids=None):
+        """Representative coordinates of the largest L2 chunk per neuron.
+
+        Parameters
+        ----------
+        root_ids :  list of int, optional
+                    Neurons to return anchors for. If None, will return
+                    anchors for all neurons in the order of ``.root_ids``.
+
+        Returns
+        -------
+        (R, 3) array
+                    Neurons without any L2 info get NaN.
+
+        """
+        root_ix = np.arange(len(self.root_ids)) if root_ids is None else self._root_ix(root_ids)
+
+        anchors = np.full((len(self.root_ids), 3), np.nan)
+        has_chunks = self.offsets[1:] > self.offsets[:-1]
+        if any(has_chunks):
+            # Sort by neuron and then by size (largest first) -> the first
+            # chunk of each neuron is the largest
+            srt = np.lexsort((-np.nan_to_num(self.sizes, nan=-np.inf), self.owner))
+            anchors[has_chunks] = self.coords[srt[self.offsets[:-1][has_chunks]]]
+
+        return anchors[root_ix]
+
+    def bounds(self, root_ids=None):
+        """Bounding boxes of the neurons' L2 chunk coordinates.
+
+        Returns
+        -------
+        (R, 3, 2) array
+                    ``[[xmin, xmax], [ymin, ymax], [zmin, zmax]]`` for each
+                    neuron. Neurons without any L2 info get NaN.
+
+        """
+        root_ix = np.arange(len(self.root_ids)) if root_ids is None else self._root_ix(root_ids)
+
+        bounds = np.full((len(self.root_ids), 3, 2), np.nan)
+        has_chunks = self.offsets[1:] > self.offsets[:-1]
+        if any(has_chunks):
+            starts = self.offsets[:-1][has_chunks]
+            bounds[has_chunks, :, 0] = np.minimum.reduceat(self.coords, starts, axis=0)
+            bounds[has_chunks, :, 1] = np.maximum.reduceat(self.coords, starts, axis=0)
+
+        return bounds[root_ix]
+
+    def query(self, x, radius, root_id=None):
+        """Find L2 chunks within given distance to point(s).
+
+        Parameters
+        ----------
+        x :         (3, ) | (N, 3) array
+                    Point(s) in nm.
+        radius :    float
+                    Max distance in nm.
+        root_id :   int, optional
+                    If provided, will only return L2 chunks of this neuron.
+
+        Returns
+        -------
+        array | list of arrays
+                    L2 IDs within ``radius`` - one array per point.
+
+        """
+        x = np.asarray(x, dtype=np.float64)
+        is_single = x.ndim == 1
+        x = x.reshape(-1, 3)
+
+        if root_id is not None:
+            ix = self._root_ix(root_id)[0]
+            start, stop = self.offsets[ix], self.offsets[ix + 1]
+            tree = cKDTree(self.coords[start:stop])
+        else:
+            start, tree = 0, self.tree
+
+        res = [self.l2_ids[np.sort(np.asarray(r, dtype=int)) + start]
+               for r in tree.query_ball_point(x, r=radius)]
+
+        return res[0] if is_single else res
+
+    def nearest(self, x, root_id=None):
+        """Find the closest L2 chunk to given point(s).
+
+        Parameters
+        ----------
+        x :         (3, ) | (N, 3) array
+                    Point(s) in nm.
+        root_id :   int, optional
+                    If provided, will only consider L2 chunks of this neuron.
+
+        Returns
+        -------
+        l2_ids :    (N, ) array
+        dist :      (N, ) array
+                    Distance in nm.
+
+        """
+        x = np.asarray(x, dtype=np.float64).reshape(-1, 3)
+
+        if root_id is not None:
+            ix = self._root_ix(root_id)[0]
+            start, stop = self.offsets[ix], self.offsets[ix + 1]
+            if start == stop:
+                raise ValueError(f'Neuron {root_id} has no L2 chunks in the index')
+            tree = cKDTree(self.coords[start:stop])
+        else:
+            if not len(self):
+                raise ValueError('Index does not contain any L2 chunks')
+            start, tree = 0, self.tree
+
+        dist, ix = tree.query(x)
+        return self.l2_ids[ix + start], dist
+
+
+class L2Graph:
+    """Compact, CSR-backed L2 graph.
+
+    A lightweight alternative to ``networkx.Graph`` for large L2 graphs: node
+    IDs are kept as a sorted array and the (undirected) adjacency as a
+    ``scipy.sparse`` CSR matrix. Use :meth:`L2Graph.to_networkx` if you need
+    the full networkx functionality.
+
+    Parameters
+    ----------
+    edges :     (M, 2) array
+                Edges between L2 IDs. Duplicate edges (in either direction)
+                are dropped.
+    nodes :     array-like, optional
+                Additional (e.g. unconnected) nodes.
+
+    Examples
+    --------
+    >>> from fafbseg import flywire
+    >>> G = flywire.l2_graph(720575940614131061, as_networkx=False)
+    >>> G.degree()                                              # doctest: +SKIP
+    array([2, 1, 3, ...])
+
+    """
+
+    def __init__(self, edges, nodes=None):
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        # Drop self-loops
+        edges = edges[edges[:, 0] != edges[:, 1]]
+
+        ids = edges.ravel()
+        if nodes is not None:
+            ids = np.append(ids, np.asarray(nodes, dtype=np.int64).reshape(-1))
+        self.ids = np.unique(ids)
+
+        # Drop duplicate edges using a (lower, higher) index key - this is
+        # much faster than `np.unique(..., axis=0)`
+        ix = np.sort(np.searchsorted(self.ids, edges), axis=1)
+        key = np.unique(ix[:, 0] * len(self.ids) + ix[:, 1])
+        ix = np.stack([key // max(len(self.ids), 1), key % max(len(self.ids), 1)], axis=1)
+        self.edges = self.ids[ix]
+
+        # Build a symmetric adjacency matrix
+        rows = np.append(ix[:, 0], ix[:, 1])
+        cols = np.append(ix[:, 1], ix[:, 0])
+        self.adjacency = sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)),
+                                           shape=(len(self.ids), len(self.ids)))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return bool(self.has_nodes(id)[0])
+
+    def __repr__(self):
+        return f'<L2Graph with {self.n_nodes} nodes and {self.n_edges} edges>'
+
+    @property
+    def n_nodes(self):
+        """Number of nodes."""
+        return len(self.ids)
+
+    @property
+    def n_edges(self):
+        """Number of (undirected) edges."""
+        return len(self.edges)
+
+    def has_nodes(self, ids):
+        """Check whether given IDs are nodes in this graph."""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        ix = np.searchsorted(self.ids, ids).clip(max=max(len(self.ids) - 1, 0))
+        if not len(self.ids):
+            return np.zeros(len(ids), dtype=bool)
+        return self.ids[ix] == ids
+
+    def id_to_index(self, ids):
+        """Map L2 ID(s) to node indices.
+
+        Raises ``KeyError`` if any of the IDs are not in the graph.
+
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        is_node = self.has_nodes(ids)
+        if not all(is_node):
+            raise KeyError(f'IDs not in graph: {ids.reshape(-1)[~is_node][:10]}')
+        return np.searchsorted(self.ids, ids)
+
+    def index_to_id(self, ix):
+        """Map node indices to L2 IDs."""
+        return self.ids[ix]
+
+    def degree(self, ids=None):
+        """Degree of given (or all) nodes."""
+        degrees = np.diff(self.adjacency.indptr)
+        if ids is None:
+            return degrees
+        return degrees[self.id_to_index(ids)]
+
+    def neighbors(self, id):
+        """L2 IDs of the neighbours of given node."""
+        ix = self.id_to_index(id)
+        indptr = self.adjacency.indptr
+        return self.ids[self.adjacency.indices[indptr[ix]:indptr[ix + 1]]]
+
+    def has_edges(self, edges):
+        """Check whether given (N, 2) edges exist (in either direction)."""
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        valid = self.has_nodes(edges[:, 0]) & self.has_nodes(edges[:, 1])
+        res = np.zeros(len(edges), dtype=bool)
+        if any(valid):
+            ix = np.searchsorted(self.ids, edges[valid])
+            res[valid] = np.asarray(self.adjacency[ix[:, 0], ix[:, 1]]).ravel()
+        return res
+
+    def has_edge(self, a, b):
+        """Check whether an edge exists between two L2 IDs."""
+        return bool(self.has_edges([[a, b]])[0])
+
+    def connected_components(self):
+        """Connected components.
+
+        Returns
+        -------
+        list of arrays
+                    L2 IDs of each connected component, largest first.
+
+        """
+        n, labels = csgraph.connected_components(self.adjacency, directed=False)
+        counts = np.bincount(labels, minlength=n)
+        order = np.argsort(labels, kind='stable')
+        comps = np.split(self.ids[order], np.cumsum(counts)[:-1])
+        return [comps[i] for i in np.argsort(-counts, kind='stable')]
+
+    def subgraph(self, ids):
+        """Return subgraph induced by given L2 IDs."""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        ids = ids[self.has_nodes(ids)]
+        keep = np.isin(self.edges, ids).all(axis=1)
+        return L2Graph(self.edges[keep], nodes=ids)
+
+    def to_networkx(self):
+        """Convert to ``networkx.Graph``."""
+        G = nx.Graph()
+        G.add_nodes_from(self.ids)
+        G.add_edges_from(self.edges)
+        return G
+
+
+@inject_dataset()
+def l2_graph(root_ids, progress=True, as_networkx=True, *, dataset=None):
     """Fetch L2 graph(s).
 
     Parameters
     ----------
-    root_ids  : int | list of ints
-                FlyWire root ID(s) for which to fetch the L2 graphs.
-    progress :  bool
-                Whether to show a progress bar.
-    dataset :   "public" | "production" | "sandbox" | "flat_630", optional
-                Against which FlyWire dataset to query. If ``None`` will fall
-                back to the default dataset (see
-                :func:`~fafbseg.flywire.set_default_dataset`).
+    root_ids  :     int | list of ints
+                    FlyWire root ID(s) for which to fetch the L2 graphs.
+    progress :      bool
+                    Whether to show a progress bar.
+    as_networkx :   bool
+                    If True (default), will return ``networkx.Graph``. If
+                    False, will return a compact :class:`~fafbseg.flywire.L2Graph`
+                    which is much faster to construct and requires much less
+                    memory for large neurons.
+    dataset :       "public" | "production" | "sandbox" | "flat_630", optional
+                    Against which FlyWire dataset to query. If ``None`` will fall
+                    back to the default dataset (see
+                    :func:`~fafbseg.flywire.set_default_dataset`).
 
     Returns
     -------
-    networkx.Graph
+    networkx.Graph | L2Graph
                         The L2 graph or list thereof.
 
     Examples
@@ -355,7 +1216,7 @@ def l2_graph(root_ids, progress=True, *, dataset=None):
         for id in navis.config.tqdm(root_ids, desc='Fetching',
                                     disable=not progress or len(root_ids) == 1,
                                     leave=False):
-            n = l2_graph(id, dataset=dataset)
+            n = l2_graph(id, as_networkx=as_networkx, dataset=dataset)
             graphs.append(n)
         return graphs
 
@@ -366,19 +1227,16 @@ def l2_graph(root_ids, progress=True, *, dataset=None):
     # This is a (N,2) array of edges
     l2_eg = np.array(client.chunkedgraph.level2_chunk_graph(root_ids))
 
-    # Generate graph
-    G = nx.Graph()
-
     if not len(l2_eg):
         # If no edges, this neuron consists of a single chunk
         # Get the single chunk's ID
-        chunks = client.chunkedgraph.get_leaves(root_ids, stop_layer=2)
-        G.add_nodes_from(chunks)
+        chunks = _get_l2_leaves([root_ids], progress=False, dataset=dataset)[0]
+        G = L2Graph([], nodes=chunks)
     else:
-        # Drop duplicate edges
-        l2_eg = np.unique(np.sort(l2_eg, axis=1), axis=0)
+        G = L2Graph(l2_eg)
 
-        G.add_edges_from(l2_eg)
+    if as_networkx:
+        return G.to_networkx()
 
     return G
 
@@ -418,7 +1276,8 @@ def l2_skeleton(root_id, refine=True, drop_missing=True, l2_node_ids=False,
                     Whether to show a progress bar.
     max_threads :   int
                     Number of parallel requests to make when fetching the
-                    L2 skeletons.
+                    L2 graphs and L2 info. Node positions for all neurons
+                    are fetched in one go.
     dataset :       "public" | "production" | "sandbox" | "flat_630", optional
                     Against which FlyWire dataset to query. If ``None`` will fall
                     back to the default dataset (see
@@ -450,38 +1309,12 @@ def l2_skeleton(root_id, refine=True, drop_missing=True, l2_node_ids=False,
         raise ValueError('`omit_failures` must be either None, True or False. '
                          f'Got "{omit_failures}".')
 
-    if navis.utils.is_iterable(root_id):
-        root_id = np.asarray(root_id, dtype=np.int64)
-
-        get_l2_skels = partial(l2_skeleton, refine=refine, drop_missing=drop_missing,
-                               omit_failures=omit_failures, dataset=dataset, **kwargs)
-        if (max_threads > 1) and (len(root_id) > 1):
-            with ThreadPoolExecutor(max_workers=max_threads) as pool:
-                futures = pool.map(get_l2_skels, root_id)
-                nl = [f for f in navis.config.tqdm(futures,
-                                                   desc='Fetching L2 skeletons',
-                                                   total=len(root_id),
-                                                   disable=not progress or len(root_id) == 1,
-                                                   leave=False)]
-        else:
-            nl = [get_l2_skels(r) for r in navis.config.tqdm(root_id,
-                                               desc='Fetching L2 skeletons',
-                                               total=len(root_id),
-                                               disable=not progress or len(root_id) == 1,
-                                               leave=False)]
-
-        # Turn into neuron list
-        nl = navis.NeuronList(nl)
-
-        # Bring in original order
-        if len(nl):
-            root_id = root_id[np.isin(root_id, nl.id)]
-            nl = nl.idx[root_id]
-
-        return nl
+    is_single = not navis.utils.is_iterable(root_id)
+    root_id = np.asarray(root_id, dtype=np.int64).reshape(-1)
+    root_uni = np.unique(root_id)
 
-    # Turn into integer
-    root_id = np.int64(root_id)
+    if not len(root_uni):
+        return navis.NeuronList([])
 
     # Get the cloudvolume
     vol = get_cloudvolume(dataset)
@@ -489,10 +1322,77 @@ def l2_skeleton(root_id, refine=True, drop_missing=True, l2_node_ids=False,
     # Get/Initialize the CAVE client
     client = get_cave_client(dataset=dataset)
 
-    # Load the L2 graph for given root ID (this is a (N, 2) array of edges)
+    # Load the L2 graphs for all roots (each a (N, 2) array of edges)
     get_l2_edges = retry(client.chunkedgraph.level2_chunk_graph)
-    l2_eg = get_l2_edges(root_id)
+    with ThreadPoolExecutor(max_workers=max(max_threads, 1)) as pool:
+        futures = pool.map(get_l2_edges, root_uni)
+        l2_egs = [f for f in navis.config.tqdm(futures,
+                                               desc='Fetching L2 graphs',
+                                               total=len(root_uni),
+                                               disable=not progress or len(root_uni) == 1,
+                                               leave=False)]
+
+    # Drop duplicate edges
+    l2_egs = [np.asarray(eg, dtype=np.int64).reshape(-1, 2) for eg in l2_egs]
+    l2_egs = [np.unique(np.sort(eg, axis=1), axis=0) for eg in l2_egs]
+
+    if refine:
+        # Get the L2 representative coordinates for all roots in one go
+        l2_all = np.unique(np.concatenate([eg.ravel() for eg in l2_egs]))
+        present, l2_info = _get_l2_attributes(l2_all, ['rep_coord_nm', 'max_dt_nm'],
+                                              max_threads=max_threads,
+                                              progress=progress and len(root_uni) > 1,
+                                              dataset=dataset)
+
+    nl = {}
+    for r, l2_eg in navis.config.tqdm(zip(root_uni, l2_egs),
+                                      desc='Creating L2 skeletons',
+                                      total=len(root_uni),
+                                      disable=not progress or len(root_uni) == 1,
+                                      leave=False):
+        if refine:
+            ix = np.searchsorted(l2_all, np.unique(l2_eg))
+            info = (present[ix], l2_info['rep_coord_nm'][ix], l2_info['max_dt_nm'][ix])
+        else:
+            info = None
+
+        nl[r] = _l2_edges_to_skeleton(r, l2_eg, vol,
+                                      l2_info=info,
+                                      drop_missing=drop_missing,
+                                      l2_node_ids=l2_node_ids,
+                                      omit_failures=omit_failures,
+                                      **kwargs)
+
+    if is_single:
+        tn = nl[root_id[0]]
+        # If omission simply return an empty NeuronList
+        return tn if tn is not None else navis.NeuronList([])
+
+    # Bring into original order (skipping omitted neurons)
+    return navis.NeuronList([nl[r] for r in root_id if nl[r] is not None])
+
+
+def _l2_edges_to_skeleton(root_id, l2_eg, vol, l2_info=None, drop_missing=True,
+                          l2_node_ids=False, omit_failures=None, **kwargs):
+    """Turn L2 graph into skeleton.
+
+    Parameters
+    ----------
+    root_id :       int
+    l2_eg :         (N, 2) array
+                    Unique edges of the L2 graph.
+    vol :           CloudVolume
+    l2_info :       tuple, optional
+                    If provided, will refine node positions. Must be a tuple of
+                    ``(present, rep_coord_nm, max_dt_nm)`` arrays - one entry
+                    for each of the unique L2 IDs in ``l2_eg``.
+
+    Returns
+    -------
+    navis.TreeNeuron
+                    Returns ``None`` if skeleton failed and should be omitted.
 
+    """
     # If no edges, we can't create a skeleton
     if not len(l2_eg):
         msg = (f'Unable to create L2 skeleton: root ID {root_id} '
@@ -503,26 +1403,17 @@ def l2_skeleton(root_id, refine=True, drop_missing=True, l2_node_ids=False,
         navis.config.logger.warning(msg)
 
         if omit_failures:
-            # If omission simply return an empty NeuronList
-            return navis.NeuronList([])
-            # If no omission, return empty TreeNeuron
-        else:
-            return navis.TreeNeuron(None, id=root_id, units='1 nm', **kwargs)
-
-    # Drop duplicate edges
-    l2_eg = np.unique(np.sort(l2_eg, axis=1), axis=0)
+            return None
+        # If no omission, return empty TreeNeuron
+        return navis.TreeNeuron(None, id=root_id, units='1 nm', **kwargs)
 
     # Unique L2 IDs
     l2_ids = np.unique(l2_eg)
 
-    # ID to index
-    l2dict = {l2: ii for ii, l2 in enumerate(l2_ids)}
-
     # Remap edge graph to indices
-    eg_arr_rm = fastremap.remap(l2_eg, l2dict)
+    eg_arr_rm = np.searchsorted(l2_ids, l2_eg)
 
-    coords = [np.array(vol.mesh.meta.meta.decode_chunk_position(l)) for l in l2_ids]
-    coords = np.vstack(coords)
+    coords = get_id_decoder(vol).chunk_position(l2_ids)
 
     # This turns the graph into a hierarchal tree by removing cycles and
     # ensuring all edges point towards a root
@@ -544,25 +1435,21 @@ def l2_skeleton(root_id, refine=True, drop_missing=True, l2_node_ids=False,
     xyz = swc[['x', 'y', 'z']].values
     swc[['x', 'y', 'z']] = chunks_to_nm(xyz, vol) + ch_dims / 2
 
-    if refine:
-        # Get the L2 representative coordinates
-        get_l2data = retry(client.l2cache.get_l2data)
-        l2_info = get_l2data(l2_ids.tolist(), attributes=['rep_coord_nm', 'max_dt_nm'])
-        # Missing L2 chunks will be {'id': {}}
-        new_co = {l2dict[np.int64(k)]: v['rep_coord_nm'] for k, v in l2_info.items() if v}
-        new_r = {l2dict[np.int64(k)]: v.get('max_dt_nm', 0) for k, v in l2_info.items() if v}
+    if l2_info is not None:
+        present, rep_coord, max_dt = l2_info
 
-        # Map refined coordinates onto the SWC
-        has_new = swc.node_id.isin(new_co)
+        # Map refined coordinates onto the SWC (node IDs are indices into
+        # `l2_ids` at this point)
+        node_ix = swc.node_id.values
+        has_new = present[node_ix]
 
         # Only apply if we actually have new coordinates - otherwise there
         # the datatype is changed to object for some reason...
         if any(has_new):
-            swc.loc[has_new, 'x'] = swc.loc[has_new, 'node_id'].map(lambda x: new_co[x][0])
-            swc.loc[has_new, 'y'] = swc.loc[has_new, 'node_id'].map(lambda x: new_co[x][1])
-            swc.loc[has_new, 'z'] = swc.loc[has_new, 'node_id'].map(lambda x: new_co[x][2])
+            swc.loc[has_new, ['x', 'y', 'z']] = rep_coord[node_ix[has_new]]
 
-        swc['radius'] = swc.node_id.map(new_r)
+        # Chunks without `max_dt_nm` get radius 0, missing chunks get NaN
+        swc['radius'] = np.where(has_new, np.nan_to_num(max_dt[node_ix]), np.nan)
 
         # Turn into a proper neuron
         tn = navis.TreeNeuron(swc, id=root_id, units='1 nm', **kwargs)
@@ -577,7 +1464,7 @@ def l2_skeleton(root_id, refine=True, drop_missing=True, l2_node_ids=False,
                 if omit_failures is None:
                     raise ValueError(msg)
                 elif omit_failures:
-                    return navis.NeuronList([])
+                    return None
                     # If no omission, return empty TreeNeuron
                 else:
                     return navis.TreeNeuron(None, id=root_id, units='1 nm', **kwargs)
@@ -593,16 +1480,18 @@ def l2_skeleton(root_id, refine=True, drop_missing=True, l2_node_ids=False,
         tn = navis.TreeNeuron(swc, id=root_id, units='1 nm', **kwargs)
 
     if l2_node_ids:
-        ixdict = {ii: l2 for ii, l2 in enumerate(l2_ids)}
-        tn.nodes['node_id'] = tn.nodes.node_id.map(ixdict)
-        tn.nodes['parent_id'] = tn.nodes.parent_id.map(lambda x: ixdict.get(x, -1))
+        node_id = tn.nodes.node_id.values
+        parent_id = tn.nodes.parent_id.values
+        tn.nodes['node_id'] = l2_ids[node_id]
+        tn.nodes['parent_id'] = np.where(parent_id >= 0, l2_ids[parent_id.clip(min=0)], -1)
 
     return tn
 
 
 @inject_dataset()
 def l2_dotprops(root_ids, min_size=None, sample=False, omit_failures=None,
-                progress=True, max_threads=10, *, dataset=None, **kwargs):
+                progress=True, max_threads=10, as_generator=False,
+                batch_size=10_000, *, dataset=None, **kwargs):
     """Generate dotprops from L2 chunks.
 
     L2 chunks not present in the L2 cache or without a `pca` attribute
@@ -635,6 +1524,16 @@ def l2_dotprops(root_ids, min_size=None, sample=False, omit_failures=None,
     max_threads :   int
                     Number of parallel requests to make when fetching the
                     L2 IDs (but not the L2 info).
+    as_generator :  bool
+                    If True, will return a generator that yields a
+                    ``NeuronList`` of Dotprops for batches of ``batch_size``
+                    root IDs at a time. L2 IDs and L2 info are fetched
+                    batch-by-batch which keeps memory usage in check. Use
+                    this to e.g. stream very large numbers of neurons to
+                    disk.
+    batch_size :    int
+                    Only relevant if ``as_generator=True``: number of root IDs
+                    per batch.
     dataset :       "public" | "production" | "sandbox" | "flat_630", optional
                     Against which FlyWire dataset to query. If ``None`` will fall
                     back to the default dataset (see
@@ -645,8 +1544,9 @@ def l2_dotprops(root_ids, min_size=None, sample=False, omit_failures=None,
 
     Returns
     -------
-    dps :           navis.NeuronList
-                    List of Dotprops.
+    dps :           navis.NeuronList | generator
+                    List of Dotprops. If ``as_generator=True``, a generator
+                    of NeuronLists.
 
     See Also
     --------
@@ -674,26 +1574,40 @@ def l2_dotprops(root_ids, min_size=None, sample=False, omit_failures=None,
     if '0' in root_ids or 0 in root_ids:
         raise ValueError('Unable to produce dotprops for root ID 0.')
 
-    # Get/Initialize the CAVE client
-    client = get_cave_client(dataset=dataset)
-
+    if sample and (sample <= 0 or sample >= 1):
+        raise ValueError(f'`sample` must be between 0 and 1, got {sample}')
+
+    func = partial(_l2_dotprops_batch,
+                   min_size=min_size,
+                   sample=sample,
+                   omit_failures=omit_failures,
+                   max_threads=max_threads,
+                   dataset=dataset,
+                   **kwargs)
+
+    if as_generator:
+        if batch_size < 1:
+            raise ValueError(f'`batch_size` must be >= 1, got {batch_size}')
+        batches = (root_ids[i:i + batch_size] for i in range(0, len(root_ids), batch_size))
+        return (func(b, progress=False) for b in navis.config.tqdm(batches,
+                                                                  desc='Batches',
+                                                                  total=int(np.ceil(len(root_ids) / batch_size)),
+                                                                  disable=not progress,
+                                                                  leave=False))
+
+    return func(root_ids, progress=progress)
+
+
+def _l2_dotprops_batch(root_ids, min_size, sample, omit_failures, max_threads,
+                       progress, dataset, **kwargs):
+    """Generate L2 dotprops for a batch of root IDs."""
     # Load the L2 IDs
-    with ThreadPoolExecutor(max_workers=max_threads) as pool:
-        get_l2_ids = partial(retry(client.chunkedgraph.get_leaves), stop_layer=2)
-        futures = pool.map(get_l2_ids, root_ids)
-        l2_ids = [f for f in navis.config.tqdm(futures,
-                                               desc='Fetching L2 IDs',
-                                               total=len(root_ids),
-                                               disable=not progress or len(root_ids) == 1,
-                                               leave=False)]
+    l2_ids = _get_l2_leaves(root_ids, max_threads=max_threads,
+                            progress=progress, dataset=dataset)
 
-    # Turn IDs into strings
-    l2_ids = [i.astype(str) for i in l2_ids]
+    l2_ids = [np.asarray(i, dtype=np.int64) for i in l2_ids]
 
     if sample:
-        if sample <= 0 or sample >= 1:
-            raise ValueError(f'`sample` must be between 0 and 1, got {sample}')
-
         for i in range(len(l2_ids)):
             # Make the sampling deterministic
             np.random.seed(1985)
@@ -701,44 +1615,48 @@ def l2_dotprops(root_ids, min_size=None, sample=False, omit_failures=None,
                                          size=max(1, int(len(l2_ids[i]) * sample)),
                                          replace=False)
 
-    # Flatten into a list of all L2 IDs
-    l2_ids_all = np.unique([i for l in l2_ids for i in l])
+    # Flatten into a list of all L2 IDs (and track which root they belong to)
+    n_ids = np.array([len(i) for i in l2_ids], dtype=np.int64)
+    l2_ids_flat = np.concatenate(l2_ids) if len(l2_ids) else np.zeros(0, dtype=np.int64)
+    l2_ids_all = np.unique(l2_ids_flat)
 
     # Get the L2 representative coordinates, vectors and (if required) volume
-    chunk_size = 2000  # no. of L2 IDs per query (doesn't seem have big impact)
     attributes = ['rep_coord_nm', 'pca']
     if min_size:
         attributes.append('size_nm3')
 
-    l2_info = {}
-    with navis.config.tqdm(desc='Fetching L2 vectors',
-                           disable=not progress,
-                           total=len(l2_ids_all),
-                           leave=False) as pbar:
-        get_l2data = retry(client.l2cache.get_l2data)
-        for chunk_ix in np.arange(0, len(l2_ids_all), chunk_size):
-            chunk = l2_ids_all[chunk_ix: chunk_ix + chunk_size]
-            l2_info.update(get_l2data(chunk.tolist(), attributes=attributes))
-            pbar.update(len(chunk))
+    present, l2_info = _get_l2_attributes(l2_ids_all, attributes,
+                                          progress=progress,
+                                          desc='Fetching L2 vectors',
+                                          dataset=dataset)
+
+    # Small L2 chunks won't have a `pca` entry - we'll ignore those
+    is_valid = present & ~np.isnan(l2_info['pca'][:, 0, 0])
+
+    # Gather indices into `l2_ids_all` for all neurons in one go
+    ix = np.searchsorted(l2_ids_all, l2_ids_flat)
+    owner = np.repeat(np.arange(len(l2_ids)), n_ids)
+    valid = is_valid[ix]
+    n_valid = np.bincount(owner[valid], minlength=len(l2_ids))
+
+    # Apply min size filter if requested
+    keep = valid
+    if min_size:
+        keep = valid & (l2_info['size_nm3'][ix] >= min_size)
+    ix, owner = ix[keep], owner[keep]
 
-    # L2 chunks without info will show as empty dictionaries
-    # Let's drop them to make our life easier (speeds up indexing too)
-    # Note that small L2 chunks won't have a `pca` entry
-    l2_info = {k: v for k, v in l2_info.items() if 'pca' in v}
+    # Get xyz points and the first component of the PCA as vector
+    offsets = np.cumsum(np.bincount(owner, minlength=len(l2_ids)))[:-1]
+    pts = np.split(l2_info['rep_coord_nm'][ix], offsets)
+    vec = np.split(l2_info['pca'][ix, 0], offsets)
 
     # Generate dotprops
     dps = []
-    for root, ids in navis.config.tqdm(zip(root_ids, l2_ids),
-                                       desc='Creating dotprops',
-                                       total=len(root_ids),
-                                       disable=not progress or len(root_ids) <= 1,
-                                       leave=False):
-        # Get xyz points and the first component of the PCA as vector
-        # Note that first subsetting IDs to what's actually available in
-        # `l2_info` is actually slower than doing it like this
-        this_info = [l2_info[i] for i in ids if i in l2_info]
-
-        if not len(this_info):
+    for i, root in enumerate(navis.config.tqdm(root_ids,
+                                               desc='Creating dotprops',
+                                               disable=not progress or len(root_ids) <= 1,
+                                               leave=False)):
+        if not n_valid[i]:
             msg = ('Unable to create L2 dotprops: none of the L2 chunks for '
                    f'root ID {root} are present in the L2 cache.')
             if omit_failures == None:
@@ -748,22 +1666,13 @@ def l2_dotprops(root_ids, min_size=None, sample=False, omit_failures=None,
                 # If no omission, add empty Dotprops
                 dps.append(navis.Dotprops(None, k=None, id=root,
                                           units='1 nm', **kwargs))
-                dps[-1]._l2_chunks_missing = len(ids)
+                dps[-1]._l2_chunks_missing = int(n_ids[i])
             continue
 
-        pts = np.vstack([i['rep_coord_nm'] for i in this_info])
-        vec = np.vstack([i['pca'][0] for i in this_info])
-
-        # Apply min size filter if requested
-        if min_size:
-            sizes = np.array([i['size_nm3'] for i in this_info])
-            pts = pts[sizes >= min_size]
-            vec = vec[sizes >= min_size]
-
         # Generate the actual dotprops
-        dps.append(navis.Dotprops(points=pts, vect=vec, id=root, k=None,
+        dps.append(navis.Dotprops(points=pts[i], vect=vec[i], id=root, k=None,
                                   units='1 nm', **kwargs))
-        dps[-1]._l2_chunks_missing = len(ids) - len(this_info)
+        dps[-1]._l2_chunks_missing = int(n_ids[i] - n_valid[i])
 
     return navis.NeuronList(dps)
 
@@ -772,11 +1681,15 @@ def l2_dotprops(root_ids, min_size=None, sample=False, omit_failures=None,
 def l2_meshes(x, threads=10, progress=True, *, dataset=None):
     """Fetch L2 meshes for a given neuron.
 
+    L2 meshes are cached locally (see ``fafbseg.flywire.cache``), i.e.
+    repeated queries for the same L2 chunks are fast.
+
     Parameters
     ----------
     x :         int | str
                 Root ID.
     threads :   int
+                Number of parallel batches of L2 meshes to fetch.
     progress :  bool
     dataset :   "public" | "production" | "sandbox" | "flat_630", optional
                 Against which FlyWire dataset to query. If ``None`` will fall
@@ -793,53 +1706,170 @@ def l2_meshes(x, threads=10, progress=True, *, dataset=None):
     except ValueError:
         raise ValueError(f'Unable to convert root ID {x} to integer')
 
-    # Get/Initialize the CAVE client
-    client = get_cave_client(dataset=dataset)
-
     # Get the cloudvolume
     vol = get_cloudvolume(dataset)
 
     # Load the L2 IDs
-    l2_ids = client.chunkedgraph.get_leaves(x, stop_layer=2)
+    l2_ids = _get_l2_leaves([x], progress=False, dataset=dataset)[0]
+
+    # Fetch meshes (this uses the local cache where possible)
+    meshes = _get_l2_meshes(l2_ids, vol, threads=threads, progress=progress)
+
+    return navis.NeuronList([navis.MeshNeuron(tm.Trimesh(*v, process=False), id=k)
+                             for k, v in meshes.items()])
+
+
+def _get_l2_meshes(l2_ids, vol, threads=10, progress=True, batch_size=500):
+    """Fetch L2 meshes.
+
+    L2 meshes are immutable and are hence cached locally (see
+    ``cache.L2_MESH_CACHE_DIR``). Centroids and areas of newly fetched meshes
+    are computed right away and written to their own lookup table.
 
-    with ThreadPoolExecutor(max_workers=threads) as pool:
+    Parameters
+    ----------
+    l2_ids :        iterable
+                    L2 IDs to fetch meshes for.
+    vol :           cloudvolume.CloudVolume
+    threads :       int
+                    Number of batches to fetch in parallel.
+    batch_size :    int
+                    Number of L2 IDs per batch.
+
+    Returns
+    -------
+    dict
+                    ``{l2_id: (vertices, faces)}``. L2 IDs without a mesh are
+                    silently dropped.
+
+    """
+    l2_ids = np.unique(np.asarray(l2_ids, dtype=np.int64))
+
+    cache = get_l2_mesh_cache(vol)
+    meshes = {}
+    if cache is not None:
+        for i in l2_ids:
+            m = get_cached_mesh(cache, i)
+            if m is not None:
+                meshes[i] = m
+
+    miss = l2_ids[~np.isin(l2_ids, list(meshes))]
+    if not len(miss):
+        return meshes
+
+    batches = [miss[i:i + batch_size] for i in range(0, len(miss), batch_size)]
+    fetch = partial(_fetch_l2_meshes, vol=vol)
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as pool:
+        futures = pool.map(fetch, batches)
+        res = [f for f in navis.config.tqdm(futures,
+                                            total=len(batches),
+                                            disable=not progress or len(batches) == 1,
+                                            leave=False,
+                                            desc='Loading meshes')]
+    new = {k: v for d in res for k, v in d.items()}
+
+    if new:
+        # Write meshes and their centroids/areas to the local caches
+        stats = get_l2_mesh_stats_cache(vol)
+        try:
+            if cache is not None:
+                for k, (verts, faces) in new.items():
+                    cache_mesh(cache, k, verts, faces)
+            if stats is not None:
+                ids = np.fromiter(new, dtype=np.int64, count=len(new))
+                centroids, areas = zip(*[_mesh_centroid_area(*new[i]) for i in ids])
+                stats.update(ids, centroid=np.array(centroids), area=np.array(areas))
+        except OSError as e:
+            navis.config.logger.debug(f'Failed to write L2 meshes to cache: {e}')
+
+    meshes.update(new)
+    return meshes
+
+
+def _fetch_l2_meshes(l2_ids, vol):
+    """Fetch a batch of L2 meshes from the remote.
+
+    Tries fetching all meshes in bulk directly from storage (skips the
+    manifests and uses a pooled connection). If that fails (e.g. because
+    the storage is not directly accessible), falls back to fetching them
+    one-by-one through the mesh manifests.
+
+    Returns
+    -------
+    dict
+                    ``{l2_id: (vertices, faces)}``.
+
+    """
+    meshes = None
+    can_bypass = hasattr(vol.mesh, 'get_meshes_on_bypass')
+    if can_bypass and vol.cloudpath not in NO_MESH_BYPASS:
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                meshes = vol.mesh.get_meshes_on_bypass(l2_ids, allow_missing=True)
+        except Exception as e:
+            navis.config.logger.debug(f'Bulk L2 mesh download failed: {e}')
+            # Don't try again for this volume
+            NO_MESH_BYPASS.add(vol.cloudpath)
+
+    if meshes is None:
         mesh_get = retry(vol.mesh.get)
-        futures = [pool.submit(mesh_get, i,
-                               allow_missing=True,
-                               deduplicate_chunk_boundaries=False) for i in l2_ids]
+        meshes = mesh_get(l2_ids, allow_missing=True,
+                          deduplicate_chunk_boundaries=False)
+
+    return {np.int64(k): (np.asarray(m.vertices, dtype=np.float32),
+                          np.asarray(m.faces, dtype=np.uint32).reshape(-1, 3))
+            for k, m in meshes.items()}
 
-        res = [f.result() for f in navis.config.tqdm(futures,
-                                                     disable=not progress,
-                                                     leave=False,
-                                                     desc='Loading meshes')]
 
-    # Unpack results
-    meshes = {k: v for d in res for k, v in d.items()}
+def _mesh_centroid_area(vertices, faces):
+    """Compute area-weighted centroid and surface area of a mesh.
+
+    Produces the same centroid as ``trimesh.Trimesh.centroid``.
+
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    if not len(faces):
+        return vertices.mean(axis=0) if len(vertices) else np.full(3, np.nan), 0.
+
+    tris = vertices[faces]
+    tri_areas = np.linalg.norm(np.cross(tris[:, 1] - tris[:, 0],
+                                        tris[:, 2] - tris[:, 0]), axis=1) / 2
+    area = tri_areas.sum()
+    if area == 0:
+        return vertices.mean(axis=0), 0.
 
-    return navis.NeuronList([navis.MeshNeuron(v, id=k) for k, v in meshes.items()])
+    centroid = (tris.mean(axis=1) * tri_areas[:, None]).sum(axis=0) / area
+    return centroid, area
 
 
 def _get_l2_centroids(l2_ids, vol, threads=10, progress=True):
-    """Fetch L2 meshes and compute centroid."""
-    with ThreadPoolExecutor(max_workers=threads) as pool:
-        futures = [pool.submit(vol.mesh.get, i,
-                               allow_missing=True,
-                               deduplicate_chunk_boundaries=False) for i in l2_ids]
+    """Get centroids of L2 meshes.
 
-        res = [f.result() for f in navis.config.tqdm(futures,
-                                                     disable=not progress,
-                                                     leave=False,
-                                                     desc='Loading meshes')]
+    Uses precomputed centroids where possible and fetches the meshes only
+    for the remaining L2 IDs.
 
-    # Unpack results
-    meshes = {k: v for d in res for k, v in d.items()}
+    Returns
+    -------
+    dict
+                    ``{l2_id: centroid}``. L2 IDs without a mesh are
+                    silently dropped.
+
+    """
+    l2_ids = np.unique(np.asarray(l2_ids, dtype=np.int64))
 
-    # For each mesh find the center of mass and move the corresponding point
     centroids = {}
-    for k, m in meshes.items():
-        m = tm.Trimesh(m.vertices, m.faces)
-        # Do NOT use center_mass here -> garbage if not non-watertight
-        centroids[k] = m.centroid
+    stats = get_l2_mesh_stats_cache(vol)
+    if stats is not None:
+        found, values = stats.lookup(l2_ids)
+        centroids.update(zip(l2_ids[found], values['centroid']))
+        l2_ids = l2_ids[~found]
+
+    if len(l2_ids):
+        meshes = _get_l2_meshes(l2_ids, vol, threads=threads, progress=progress)
+        for k, (verts, faces) in meshes.items():
+            # Do NOT use center_mass here -> garbage if not non-watertight
+            centroids[k] = _mesh_centroid_area(verts, faces)[0]
 
     return centroids
 
@@ -855,10 +1885,10 @@ def l2_soma(x, progress=True, *, dataset=None):
 
     Parameters
     ----------
-    x  :                int | nx.Graph | lists thereof
+    x  :                int | nx.Graph | L2Graph | lists thereof
                         The neuron(s) for which to find somas. Can be either:
                             - root ID (s)
-                            - networkx L2 graph(s)
+                            - networkx or :class:`L2Graph` L2 graph(s)
 
     Returns
     -------
@@ -869,39 +1899,26 @@ def l2_soma(x, progress=True, *, dataset=None):
     >>> n = flywire.l2_soma(720575940614131061)
 
     """
-    if navis.utils.is_iterable(x):
+    if navis.utils.is_iterable(x) and not isinstance(x, (nx.Graph, L2Graph)):
         res = []
         for id in navis.config.tqdm(x, desc='Finding somas',
                                     disable=not progress, leave=False):
-            res.append(l2_soma(id, progress=False))
+            res.append(l2_soma(id, progress=False, dataset=dataset))
         return res
 
     # Get the cloudvolume
     vol = get_cloudvolume(dataset)
 
-    # Get/Initialize the CAVE client
-    client = get_cave_client(dataset=dataset)
-
-    if not isinstance(x, nx.Graph):
-        # Load the L2 graph for given root ID
-        # This is a (N,2) array of edges
-        l2_eg = np.array(client.chunkedgraph.level2_chunk_graph(x))
-
-        # Drop duplicate edges
-        l2_eg = np.unique(np.sort(l2_eg, axis=1), axis=0)
-
-        G = nx.Graph()
-        G.add_edges_from(l2_eg)
-    else:
+    if isinstance(x, nx.Graph):
+        G = L2Graph(np.array(x.edges, dtype=np.int64).reshape(-1, 2), nodes=list(x.nodes))
+    elif isinstance(x, L2Graph):
         G = x
-
-    # Get degrees from the graph
-    degrees = np.array(list(G.degree))
-    l2_ids = degrees[:, 0]
-    l2_degrees = degrees[:, 1]
+    else:
+        # Load the L2 graph for given root ID
+        G = l2_graph(x, as_networkx=False, dataset=dataset)
 
     # Find the node with highest degree
-    mx_deg = l2_ids[np.argmax(l2_degrees)]
+    mx_deg = G.ids[np.argmax(G.degree())]
 
     # Get it's centroid
     centroid = _get_l2_centroids([mx_deg], vol, threads=1, progress=False)
@@ -929,9 +1946,12 @@ def chunks_to_nm(xyz_ch, vol, voxel_resolution=[4, 4, 40]):
     """
     mip_scaling = vol.mip_resolution(0) // np.array(voxel_resolution, dtype=int)
 
-    x_vox = np.atleast_2d(xyz_ch) * vol.mesh.meta.meta.graph_chunk_size
+    # Chunk size and offset are cached alongside the ID decoder
+    decoder = get_id_decoder(vol)
+
+    x_vox = np.atleast_2d(xyz_ch) * decoder.graph_chunk_size
     return (
-        (x_vox + np.array(vol.mesh.meta.meta.voxel_offset(0)))
+        (x_vox + decoder.voxel_offset)
         * voxel_resolution
         * mip_scaling
     )
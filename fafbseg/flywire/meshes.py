@@ -25,7 +25,7 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from .l2 import l2_graph
 from .synapses import fetch_synapses
-from .utils import get_cloudvolume, inject_dataset
+from .utils import get_cloudvolume, inject_dataset, get_id_decoder
 
 __all__ = ['get_mesh_neuron']
 
@@ -172,7 +172,8 @@ def _get_mesh(seg_id, vol):
     """Fetch mesh."""
     import DracoPy
 
-    level = vol.mesh.meta.meta.decode_layer_id(seg_id)
+    decoder = get_id_decoder(vol)
+    level = int(decoder.layer(seg_id)[0])
     fragment_filenames = vol.mesh.get_fragment_filenames(seg_id,
                                                          level=level,
                                                          bbox=None,
@@ -202,13 +203,13 @@ def _get_mesh(seg_id, vol):
     mesh = Mesh.concatenate(*fragments)
     mesh.segid = seg_id
 
+    # Get levels of all fragments in one go
+    levels = decoder.layer([m.segid for m in fragments])
+
     # Generate vertex -> L2 ID mapping
     l2_map = {}
     ix = 0
-    for m in fragments:
-        # Get level of this fragment
-        level = vol.mesh.meta.meta.decode_layer_id(m.segid)
-
+    for m, level in zip(fragments, levels):
         # If already L2 ID just track
         n_verts = m.vertices.shape[0]
         if level == 2:
@@ -221,9 +222,9 @@ def _get_mesh(seg_id, vol):
 
         ix += n_verts
 
-    G = l2_graph(seg_id)
+    G = l2_graph(seg_id, as_networkx=False)
 
-    edges = [e for e in G.edges if e[0] in l2_map and e[1] in l2_map]
+    edges = G.edges[np.isin(G.edges, list(l2_map)).all(axis=1)]
     edges = [[l2_map[e[0]], l2_map[e[1]]] for e in edges]
     edges = [e for e in edges if e[0] != e[1]]
 
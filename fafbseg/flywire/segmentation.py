@@ -13,11 +13,11 @@
 #    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 #    GNU General Public License for more details.
 
+import fastremap
 import pymaid
 import navis
 import requests
 import textwrap
-import time
 import copy
 
 import cloudvolume as cv
@@ -27,7 +27,7 @@ import pandas as pd
 import networkx as nx
 
 from concurrent import futures
-from diskcache import Cache
+from functools import partial
 from requests_futures.sessions import FuturesSession
 from scipy import ndimage
 from tqdm.auto import tqdm
@@ -38,7 +38,9 @@ from .. import xform
 from ..utils import make_iterable, GSPointLoader
 from .utils import (get_cloudvolume, FLYWIRE_DATASETS, get_chunkedgraph_secret,
                     retry, get_cave_client, parse_bounds, package_timestamp,
-                    inject_dataset)
+                    inject_dataset, run_batched, get_id_decoder)
+from .cache import (get_sv2root_cache, get_svoxel_cache,
+                    get_cached_ids, cache_ids, find_cached_ancestors)
 
 
 __all__ = ['fetch_edit_history', 'fetch_leaderboard', 'locs_to_segments',
@@ -334,7 +336,9 @@ def roots_to_supervoxels(x, use_cache=True, progress=True, *, dataset=None):
                     Segmentation (root) ID(s).
     use_cache :     bool
                     Whether to use disk cache to avoid repeated queries for the
-                    same root. Cache is stored in `~/.fafbseg/`.
+                    same root. Cache is stored in `~/.fafbseg/`. Roots that
+                    are not yet cached but were merged from cached ancestors
+                    are derived from those.
     progress :      bool
                     If True, show progress bar.
     dataset :       "public" | "production" | "sandbox", optional
@@ -372,22 +376,14 @@ def roots_to_supervoxels(x, use_cache=True, progress=True, *, dataset=None):
     # See what we can get from cache
     if use_cache:
         # Cache for root -> supervoxels
-        # Grows to max 1Gb by default and persists across sessions
-        with Cache(directory='~/.fafbseg/svoxel_cache/') as sv_cache:
-            # See if we have any of these roots cached
-            with sv_cache.transact():
-                is_cached = np.isin(x, sv_cache)
-
-            # Add supervoxels from cache if we have any
-            if np.any(is_cached):
-                # Get values from cache
-                with sv_cache.transact():
-                    svoxels.update({i: sv_cache[i] for i in x[is_cached]})
-
-    # Get the supervoxels for the roots that are still missing
-    # We need to convert keys to integer array because otherwise there is a
-    # mismatch in types (int vs np.int?) which causes all root IDs to be in miss
-    # -> I think that's because of the way disk cache works
+        # Persists across sessions and evicts least-recently-used roots once
+        # it grows beyond its size limit
+        with get_svoxel_cache() as sv_cache:
+            for i in x:
+                sv = get_cached_ids(sv_cache, i)
+                if sv is not None:
+                    svoxels[i] = sv
+
     miss = x[~np.isin(x, np.array(list(svoxels.keys()), dtype=np.int64))]
     get_leaves = retry(vol.get_leaves)
     with navis.config.tqdm(desc='Querying',
@@ -397,23 +393,106 @@ def roots_to_supervoxels(x, use_cache=True, progress=True, *, dataset=None):
         # Update for those for which we had cached data
         pbar.update(len(svoxels))
 
-        for i in miss:
-            svoxels[i] = get_leaves(i, bbox=vol.meta.bounds(0), mip=0)
-            pbar.update()
-
-    # Update cache
-    if use_cache:
-        with Cache(directory='~/.fafbseg/svoxel_cache/') as sv_cache:
-            with sv_cache.transact():
+        if use_cache and len(miss):
+            client = get_cave_client(dataset=dataset)
+            with get_svoxel_cache() as sv_cache:
+                # Walking the lineage is only worth it if an ancestor is cached
+                derivable = find_cached_ancestors(miss, sv_cache, client)
                 for i in miss:
-                    sv_cache[i] = svoxels[i]
+                    derived = None
+                    if i in derivable:
+                        derived = _svoxels_from_lineage(i, sv_cache, client)
+                    if derived:
+                        svoxels[i] = derived[i]
+                    else:
+                        derived = {i: get_leaves(i, bbox=vol.meta.bounds(0), mip=0)}
+                        svoxels[i] = derived[i]
+
+                    # Cache (also any intermediate roots we came across)
+                    for r, sv in derived.items():
+                        cache_ids(sv_cache, r, sv)
+                    pbar.update()
+        else:
+            for i in miss:
+                svoxels[i] = get_leaves(i, bbox=vol.meta.bounds(0), mip=0)
+                pbar.update()
 
     return svoxels
 
 
+def _svoxels_from_lineage(root, sv_cache, client, max_depth=10):
+    """Derive supervoxels for given root from cached ancestors.
+
+    Edits never change the supervoxels themselves, so a merge produces the
+    union of its parents' supervoxels. Splits can't be derived cheaply:
+    if there is one on the way from the cached ancestors to `root`, we give
+    up and the caller fetches the supervoxels from scratch.
+
+    Parameters
+    ----------
+    root :          int
+                    Root ID to derive supervoxels for.
+    sv_cache :      diskcache.Cache
+                    The root -> supervoxels cache.
+    client :        CAVEclient
+    max_depth :     int
+                    Max number of edits to walk back in the lineage.
+
+    Returns
+    -------
+    dict | None
+                    ``{root_id: supervoxels}`` for `root` and any other root
+                    derived along the way. ``None`` if supervoxels could not
+                    be derived.
+
+    """
+    root = int(root)
+    try:
+        G = client.chunkedgraph.get_lineage_graph(root, as_nx_graph=True)
+    except Exception as e:
+        navis.config.logger.debug(f'Failed to fetch lineage for {root}: {e}')
+        return None
+
+    derived = {}
+
+    def _get_svoxels(n, depth):
+        if n in derived:
+            return derived[n]
+
+        sv = get_cached_ids(sv_cache, n)
+        if sv is not None:
+            return sv
+
+        # Only merges are cheap to derive: mapping a split back would mean
+        # looking up roots for all of the parent's supervoxels which costs
+        # more than just fetching the leaves
+        pred = list(G.predecessors(n))
+        if len(pred) < 2 or depth >= max_depth:
+            return None
+
+        parents = [_get_svoxels(p, depth + 1) for p in pred]
+        if any(p is None for p in parents):
+            return None
+
+        derived[n] = np.unique(np.concatenate(parents))
+        return derived[n]
+
+    try:
+        sv = _get_svoxels(root, 0)
+    except Exception as e:
+        navis.config.logger.debug(f'Failed to derive supervoxels for {root}: {e}')
+        return None
+
+    if sv is None or not len(sv):
+        return None
+
+    return derived
+
+
 @inject_dataset(disallowed=['flat_630', 'flat_571'])
 def supervoxels_to_roots(x, timestamp=None, batch_size=10_000, stop_layer=10,
-                         retry=True, progress=True, *, dataset=None):
+                         retry=True, use_cache=False, max_threads=4,
+                         progress=True, *, dataset=None):
     """Get root(s) for given supervoxel(s).
 
     Parameters
@@ -428,12 +507,23 @@ def supervoxels_to_roots(x, timestamp=None, batch_size=10_000, stop_layer=10,
                     materialization. You can also use e.g. "mat_438" to get the
                     root ID at a specific materialization.
     batch_size :    int
-                    Max number of supervoxel IDs per query. Reduce batch size if
-                    you experience time outs.
+                    Max number of supervoxel IDs per query. Batches that time
+                    out are automatically split and the batch size reduced.
     stop_layer :    int
                     Set e.g. to ``2`` to get L2 IDs instead of root IDs.
     retry :         bool
                     Whether to retry if a batched query fails.
+    use_cache :     bool
+                    If True, will use (and update) a local on-disk lookup table
+                    stored in `~/.fafbseg/sv2root_cache/` and only query the
+                    supervoxels that aren't already in it. Lookups for a fixed
+                    timestamp (e.g. "mat_630") never expire. For live queries
+                    (``timestamp=None``), cached roots are checked with
+                    :func:`~fafbseg.flywire.is_latest_root` and re-fetched if
+                    outdated. Live queries with ``stop_layer`` below the root
+                    layer can't be checked and are never cached.
+    max_threads :   int
+                    Max number of batches to query in parallel.
     progress :      bool
                     If True, show progress bar.
     dataset :       "public" | "production" | "sandbox", optional
@@ -476,32 +566,61 @@ def supervoxels_to_roots(x, timestamp=None, batch_size=10_000, stop_layer=10,
     if isinstance(timestamp, np.datetime64):
         timestamp = str(timestamp)
 
-    with tqdm(desc='Fetching roots',
-              leave=False,
-              total=len(x),
-              disable=not progress or len(x) < batch_size) as pbar:
-
-        for i in range(0, len(x), int(batch_size)):
-            # This batch
-            batch = x[i:i+batch_size]
-
-            # get_roots() doesn't like to be asked for zeros - causes server error
-            not_zero = batch != 0
-            try:
-                roots[i:i+batch_size][not_zero] = vol.get_roots(batch[not_zero],
-                                                                stop_layer=stop_layer,
-                                                                timestamp=timestamp)
-            except KeyboardInterrupt:
-                raise
-            except BaseException:
-                if not retry:
-                    raise
-                time.sleep(1)
-                roots[i:i+batch_size][not_zero] = vol.get_roots(batch[not_zero],
-                                                                stop_layer=stop_layer,
-                                                                timestamp=timestamp)
-
-            pbar.update(len(batch))
+    # Live lookups are validated with `is_latest_root` which only works for
+    # actual roots - IDs from lower layers (e.g. L2) can't be cached
+    if timestamp is None and stop_layer != 10:
+        use_cache = False
+
+    cache = get_sv2root_cache(dataset, timestamp, stop_layer) if use_cache else None
+    if cache is not None:
+        # We only need to look up (and query) every supervoxel once
+        svoxels, inv = np.unique(x, return_inverse=True)
+        sv_roots = np.zeros(svoxels.shape, dtype=np.int64)
+
+        # get_roots() doesn't like to be asked for zeros
+        not_zero = svoxels != 0
+        is_cached, cached = cache.lookup(svoxels[not_zero])
+
+        # For live queries we have to check if the cached roots are outdated
+        if timestamp is None and any(is_cached):
+            cached_uni, cached_inv = np.unique(cached['root'], return_inverse=True)
+            il = is_latest_root(cached_uni, dataset=dataset, progress=False)
+            is_cached[is_cached] = il[cached_inv]
+            cached['root'] = cached['root'][il[cached_inv]]
+
+        sv_roots[np.where(not_zero)[0][is_cached]] = cached['root']
+        miss = svoxels[not_zero][~is_cached]
+
+        if len(miss):
+            new_roots = supervoxels_to_roots(miss,
+                                             timestamp=timestamp,
+                                             batch_size=batch_size,
+                                             stop_layer=stop_layer,
+                                             retry=retry,
+                                             use_cache=False,
+                                             max_threads=max_threads,
+                                             progress=progress,
+                                             dataset=dataset)
+            sv_roots[np.where(not_zero)[0][~is_cached]] = new_roots
+
+            # Zeros indicate supervoxels that could not be mapped -> don't cache
+            cache.update(miss[new_roots != 0], root=new_roots[new_roots != 0])
+
+        return sv_roots[inv.ravel()].reshape(x.shape)
+
+    # get_roots() doesn't like to be asked for zeros - causes server error
+    not_zero = np.where(x != 0)[0]
+
+    get_roots = partial(vol.get_roots, stop_layer=stop_layer, timestamp=timestamp)
+    batches = run_batched(get_roots,
+                          x[not_zero],
+                          batch_size=batch_size,
+                          max_threads=max_threads,
+                          retries=5 if retry else 0,
+                          progress=progress and len(x) >= batch_size,
+                          desc='Fetching roots')
+    for start, stop, batch_roots in batches:
+        roots[not_zero[start:stop]] = batch_roots
 
     return roots
 
@@ -663,7 +782,8 @@ def neuron_to_segments(x, short=False, coordinates='voxel', *, dataset=None):
 
 @inject_dataset(disallowed=['flat_630', 'flat_571'])
 def locs_to_segments(locs, timestamp=None, backend='spine',
-                     coordinates='voxel', *, dataset=None):
+                     coordinates='voxel', chunk_size=None, max_threads=2, *,
+                     dataset=None):
     """Retrieve FlyWire segment IDs (root IDs) at given location(s).
 
     Parameters
@@ -684,6 +804,15 @@ def locs_to_segments(locs, timestamp=None, backend='spine',
     coordinates :   "voxel" | "nm"
                     Units in which your coordinates are in. "voxel" is assumed
                     to be 4x4x40 (x/y/z) nanometers.
+    chunk_size :    int, optional
+                    If provided, will process ``locs`` in chunks of this many
+                    locations and return a generator that yields the root IDs
+                    for one chunk at a time. Fetching supervoxels and roots for
+                    subsequent chunks runs concurrently. Use this for very large
+                    numbers of locations to keep memory usage in check.
+    max_threads :   int
+                    Max number of chunks for which to fetch supervoxels in
+                    parallel. Only relevant if ``chunk_size`` is given.
     dataset :       "public" | "production" | "sandbox" | "flat_630", optional
                     Against which FlyWire dataset to query. If ``None`` will fall
                     back to the default dataset (see
@@ -694,6 +823,9 @@ def locs_to_segments(locs, timestamp=None, backend='spine',
     -------
     numpy.array
                     List of segmentation IDs in the same order as ``locs``.
+    generator
+                    If ``chunk_size`` is given: generator yielding arrays of
+                    segmentation IDs for each chunk of ``locs`` (in order).
 
     Examples
     --------
@@ -703,12 +835,131 @@ def locs_to_segments(locs, timestamp=None, backend='spine',
     >>> flywire.locs_to_segments(locs)
     array([720575940621039145, 720575940621039145])
 
+    Process locations in chunks:
+
+    >>> roots = np.concatenate(list(flywire.locs_to_segments(locs, chunk_size=1)))
+
     """
+    if chunk_size:
+        return _locs_to_segments_chunked(locs,
+                                         chunk_size=chunk_size,
+                                         timestamp=timestamp,
+                                         backend=backend,
+                                         coordinates=coordinates,
+                                         max_threads=max_threads,
+                                         dataset=dataset)
+
     svoxels = locs_to_supervoxels(locs, coordinates=coordinates, backend=backend)
 
     return supervoxels_to_roots(svoxels, timestamp=timestamp, dataset=dataset)
 
 
+def _locs_to_segments_chunked(locs, chunk_size, timestamp=None, backend='spine',
+                              coordinates='voxel', max_threads=2,
+                              max_lookup=10_000_000, *, dataset=None):
+    """Generator that yields root IDs for chunks of locations.
+
+    Supervoxels for the next chunks are fetched while we are fetching roots
+    for the current chunk. Supervoxels are only ever queried once per chunk and
+    we keep a lookup of the roots of the most recently seen supervoxels
+    (up to `max_lookup`) to avoid querying them again in later chunks.
+
+    """
+    if isinstance(timestamp, str) and timestamp.startswith('mat'):
+        client = get_cave_client(dataset=dataset)
+        if timestamp == 'mat' or timestamp == 'mat_latest':
+            timestamp = client.materialize.get_timestamp()
+        else:
+            # Split e.g. 'mat_432' to extract version and query timestamp
+            version = int(timestamp.split('_')[1])
+            timestamp = client.materialize.get_timestamp(version)
+
+    if not isinstance(locs, pd.DataFrame):
+        locs = np.asarray(locs)
+
+    # Lookup for supervoxel -> roots: sorted supervoxels + matching roots and
+    # the (running) number of the chunk each supervoxel was added in
+    lookup_sv = np.zeros(0, dtype=np.int64)
+    lookup_roots = np.zeros(0, dtype=np.int64)
+    lookup_chunk = np.zeros(0, dtype=np.int64)
+    n_chunks = 0
+
+    def _to_roots(sv_future):
+        nonlocal lookup_sv, lookup_roots, lookup_chunk, n_chunks
+
+        svoxels = np.asarray(sv_future.result()).astype(np.int64)
+        uni, inv = np.unique(svoxels, return_inverse=True)
+        roots = np.zeros(len(uni), dtype=np.int64)
+
+        if len(lookup_sv):
+            ix = np.searchsorted(lookup_sv, uni).clip(max=len(lookup_sv) - 1)
+            known = lookup_sv[ix] == uni
+            roots[known] = lookup_roots[ix[known]]
+        else:
+            known = np.zeros(len(uni), dtype=bool)
+
+        # Zeros are not looked up at all
+        miss = ~known & (uni != 0)
+        if any(miss):
+            roots[miss] = supervoxels_to_roots(uni[miss],
+                                               timestamp=timestamp,
+                                               progress=False,
+                                               dataset=dataset)
+
+            # Update lookup: the misses are sorted and not yet in the lookup,
+            # so inserting them at their sorted positions keeps it sorted
+            pos = np.searchsorted(lookup_sv, uni[miss])
+            lookup_sv = np.insert(lookup_sv, pos, uni[miss])
+            lookup_roots = np.insert(lookup_roots, pos, roots[miss])
+            lookup_chunk = np.insert(lookup_chunk, pos, n_chunks)
+            n_chunks += 1
+
+            # Drop the oldest chunks if the lookup grows too large (but always
+            # keep the most recent one)
+            if len(lookup_sv) > max_lookup:
+                per_chunk = np.bincount(lookup_chunk, minlength=n_chunks)[::-1]
+                n_keep = max(np.searchsorted(np.cumsum(per_chunk), max_lookup,
+                                             side='right'), 1)
+                keep = lookup_chunk >= n_chunks - n_keep
+                lookup_sv = lookup_sv[keep]
+                lookup_roots = lookup_roots[keep]
+                lookup_chunk = lookup_chunk[keep]
+
+        return roots[inv.ravel()]
+
+    def _get_chunk(start):
+        if isinstance(locs, pd.DataFrame):
+            return locs.iloc[start:start + chunk_size]
+        return locs[start:start + chunk_size]
+
+    starts = list(range(0, len(locs), chunk_size))
+    with futures.ThreadPoolExecutor(max_workers=max(max_threads, 1)) as sv_pool:
+        # Roots are fetched in a single thread so that chunks are processed
+        # (and the lookup is updated) in order
+        with futures.ThreadPoolExecutor(max_workers=1) as root_pool:
+            pending = []
+            try:
+                for start in starts:
+                    sv_fut = sv_pool.submit(locs_to_supervoxels,
+                                            _get_chunk(start),
+                                            coordinates=coordinates,
+                                            backend=backend)
+                    pending.append((sv_fut, root_pool.submit(_to_roots, sv_fut)))
+
+                    # Keep a limited number of chunks in flight
+                    if len(pending) > max_threads:
+                        yield pending.pop(0)[1].result()
+
+                while pending:
+                    yield pending.pop(0)[1].result()
+            finally:
+                # Cancel anything that's still queued (e.g. if the generator
+                # is closed early)
+                for sv_fut, root_fut in pending:
+                    root_fut.cancel()
+                    sv_fut.cancel()
+
+
 @inject_dataset()
 def skid_to_id(x,
                sample=None,
@@ -818,8 +1069,8 @@ def skid_to_id(x,
 
 
 @inject_dataset(disallowed=['flat_630', 'flat_571'])
-@retry
-def is_latest_root(id, timestamp=None, progress=True, *, dataset=None, **kwargs):
+def is_latest_root(id, timestamp=None, progress=True, max_threads=4, *,
+                   dataset=None, **kwargs):
     """Check if root is the current one.
 
     Parameters
@@ -834,6 +1085,8 @@ def is_latest_root(id, timestamp=None, progress=True, *, dataset=None, **kwargs)
                     root ID at a specific materialization.
     progress :      bool
                     Whether to show progress bar.
+    max_threads :   int
+                    Max number of batches to query in parallel.
     dataset :       "public" | "production" | "sandbox", optional
                     Against which FlyWire dataset to query. If ``None`` will fall
                     back to the default dataset (see
@@ -892,23 +1145,21 @@ def is_latest_root(id, timestamp=None, progress=True, *, dataset=None, **kwargs)
     else:
         params = None
 
-    batch_size = 100_000
-    with navis.config.tqdm(desc='Checking',
-                           total=not_zero.sum(),
-                           disable=(not_zero.sum() <= batch_size) or not progress,
-                           leave=False) as pbar:
-        for i in range(0, not_zero.sum(), batch_size):
-            batch = id[not_zero][i:i+batch_size]
-            post = {'node_ids': batch.tolist()}
-
-            # Update progress bar
-            pbar.update(len(batch))
-
-            r = session.post(url, json=post, params=params)
-
-            r.raise_for_status()
+    def _is_latest(batch):
+        r = session.post(url, json={'node_ids': batch.tolist()}, params=params)
+        r.raise_for_status()
+        return np.array(r.json()['is_latest'])
 
-            is_latest[np.where(not_zero)[0][i:i+batch_size]] = np.array(r.json()['is_latest'])
+    not_zero = np.where(not_zero)[0]
+    batch_size = 100_000
+    batches = run_batched(_is_latest,
+                          id[not_zero],
+                          batch_size=batch_size,
+                          max_threads=max_threads,
+                          progress=progress and len(not_zero) > batch_size,
+                          desc='Checking')
+    for start, stop, batch_latest in batches:
+        is_latest[not_zero[start:stop]] = batch_latest
 
     return is_latest
 
@@ -975,6 +1226,7 @@ def update_ids(id,
                supervoxels=None,
                timestamp=None,
                progress=True,
+               max_threads=4,
                *,
                dataset=None,
                **kwargs):
@@ -1009,6 +1261,9 @@ def update_ids(id,
                     Asking for a specific time will slow things down considerably.
     progress :      bool
                     If True, shows progress bar.
+    max_threads :   int
+                    Max number of parallel requests when updating many IDs at
+                    once.
     dataset :       "public" | "production" | "sandbox", optional
                     Against which FlyWire dataset to query. If ``None`` will fall
                     back to the default dataset (see
@@ -1074,17 +1329,13 @@ def update_ids(id,
         is_latest = is_latest_root(id, dataset=dataset, timestamp=timestamp)
 
         if isinstance(supervoxels, type(None)):
-            res = [update_ids(x,
-                              dataset=dataset,
-                              is_latest=il,
-                              supervoxels=None,
-                              timestamp=timestamp,
-                              stop_layer=stop_layer) for x, il, in navis.config.tqdm(zip(id, is_latest),
-                                                                               desc='Updating',
-                                                                               leave=False,
-                                                                               total=len(id),
-                                                                               disable=not progress or len(id) == 1)]
-            res = pd.concat(res, axis=0, sort=False, ignore_index=True)
+            res = _update_ids_bulk(id,
+                                   is_latest=is_latest,
+                                   stop_layer=stop_layer,
+                                   timestamp=timestamp,
+                                   max_threads=max_threads,
+                                   progress=progress,
+                                   dataset=dataset)
         else:
             supervoxels = np.asarray(supervoxels)
             if len(supervoxels) != len(id):
@@ -1197,6 +1448,139 @@ def update_ids(id,
                         ).astype({'old_id': np.int64, 'new_id': np.int64})
 
 
+def _update_ids_bulk(id, is_latest, stop_layer=2, timestamp=None, max_threads=4,
+                     progress=True, *, dataset=None):
+    """Update many root IDs at once.
+
+    Works in two stages:
+        1. For live queries, ask for the latest successors of each outdated
+           root. Roots with a single successor (i.e. that have only seen
+           merges) are done.
+        2. For the remaining roots, fetch their leaves (at `stop_layer`), map
+           all (unique) leaves to their new roots in one go and pick the new
+           root that contains the most of the original leaves.
+
+    Parameters
+    ----------
+    id :            (N, ) array
+                    Root IDs to update.
+    is_latest :     (N, ) bool array
+                    Whether each root is already up-to-date.
+
+    Returns
+    -------
+    pandas.DataFrame
+
+    """
+    id = np.asarray(id, dtype=np.int64)
+    is_latest = np.asarray(is_latest, dtype=bool)
+
+    if isinstance(timestamp, np.datetime64):
+        timestamp = str(timestamp)
+
+    new_id = id.copy()
+    conf = np.ones(len(id), dtype=np.float64)
+
+    # We only need to update each outdated root once
+    outdated, outdated_ix = np.unique(id[~is_latest], return_inverse=True)
+
+    winner = np.zeros(len(outdated), dtype=np.int64)
+    winner_conf = np.zeros(len(outdated), dtype=np.float64)
+
+    if len(outdated):
+        client = get_cave_client(dataset=dataset)
+
+    # Stage 1: roots with a single successor
+    if len(outdated) and not timestamp:
+        def _get_latest(batch):
+            # This endpoint in caveclient seems to require uint64
+            return [client.chunkedgraph.get_latest_roots(np.uint64(r))
+                    for r in batch]
+
+        for start, stop, res in run_batched(_get_latest,
+                                            outdated,
+                                            batch_size=10,
+                                            max_threads=max_threads,
+                                            progress=progress and len(outdated) > 10,
+                                            desc='Fetching successors'):
+            for i, pot_roots in zip(range(start, stop), res):
+                # See `update_ids` for why we check the successor isn't the
+                # original ID (disconnected lineage graphs)
+                if len(pot_roots) == 1 and pot_roots[0] != outdated[i]:
+                    winner[i] = pot_roots[0]
+                    winner_conf[i] = 1
+
+    # Stage 2: let the leaves vote for the remaining (e.g. split) roots
+    ambiguous = np.where(winner == 0)[0]
+    if len(ambiguous):
+        if stop_layer == 2:
+            # L2 IDs for roots are cached locally
+            from .l2 import _get_l2_leaves
+            leaves = _get_l2_leaves(outdated[ambiguous],
+                                    max_threads=max_threads,
+                                    progress=progress,
+                                    dataset=dataset)
+        else:
+            def _get_leaves(batch):
+                res = client.chunkedgraph.get_leaves_many(batch.tolist(),
+                                                          stop_layer=stop_layer)
+                return [res.get(r, np.zeros(0, dtype=np.int64)) for r in batch]
+
+            leaves = []
+            for start, stop, res in run_batched(_get_leaves,
+                                                outdated[ambiguous],
+                                                batch_size=10,
+                                                max_threads=max_threads,
+                                                progress=progress and len(ambiguous) > 10,
+                                                desc='Fetching leaves'):
+                leaves += res
+
+        # Track which outdated root each leaf belongs to
+        owner = np.repeat(ambiguous, [len(l) for l in leaves])
+        leaves = np.concatenate(leaves).astype(np.int64) if leaves else np.zeros(0, dtype=np.int64)
+
+        # Map (unique) leaves to their current roots
+        leaves_uni, leaves_inv = np.unique(leaves, return_inverse=True)
+        roots_uni = supervoxels_to_roots(leaves_uni,
+                                         timestamp=timestamp,
+                                         max_threads=max_threads,
+                                         progress=progress,
+                                         dataset=dataset)
+        roots = roots_uni[leaves_inv]
+
+        # Drop leaves that don't map to anything
+        not_zero = roots != 0
+        owner, roots = owner[not_zero], roots[not_zero]
+
+        # Count leaves per (old root, new root) pair
+        cand, cand_inv = np.unique(roots, return_inverse=True)
+        pairs, counts = np.unique(owner * len(cand) + cand_inv,
+                                  return_counts=True)
+        pair_owner = pairs // max(len(cand), 1)
+        pair_root = cand[pairs % max(len(cand), 1)]
+        total = np.bincount(owner, minlength=len(outdated))
+
+        # Sort by owner, then by count (descending) and pick the first
+        # candidate for each owner (ties go to the lower root ID)
+        srt = np.lexsort((pair_root, -counts, pair_owner))
+        first = srt[np.unique(pair_owner[srt], return_index=True)[1]]
+
+        winner[pair_owner[first]] = pair_root[first]
+        winner_conf[pair_owner[first]] = counts[first] / total[pair_owner[first]]
+
+        if not timestamp:
+            winner_conf = winner_conf.round(2)
+
+    if len(outdated):
+        new_id[~is_latest] = winner[outdated_ix]
+        conf[~is_latest] = winner_conf[outdated_ix]
+
+    return pd.DataFrame({'old_id': id,
+                         'new_id': new_id,
+                         'confidence': conf,
+                         'changed': id != new_id})
+
+
 @inject_dataset()
 def snap_to_id(locs, id, snap_zero=False, search_radius=160, coordinates='nm',
                max_workers=4, verbose=True, *, dataset=None):
@@ -1222,6 +1606,8 @@ def snap_to_id(locs, id, snap_zero=False, search_radius=160, coordinates='nm',
                     Coordinate system of `locs`. If "voxel" it is assumed to be
                     4 x 4 x 40 nm.
     max_workers :   int
+                    Max number of cutouts to fetch in parallel. Locations close
+                    to each other share the same cutout.
     verbose :       bool
                     If True will plot summary at then end.
     dataset :       "public" | "production" | "sandbox" | "flat_630", optional
@@ -1258,28 +1644,18 @@ def snap_to_id(locs, id, snap_zero=False, search_radius=160, coordinates='nm',
     if not snap_zero:
         to_fix = to_fix & not_zero
 
-    # Use parallel processes to go over the to-fix nodes
-    with navis.config.tqdm(desc='Snapping', total=to_fix.sum(), leave=False) as pbar:
-        with futures.ProcessPoolExecutor(max_workers=max_workers) as ex:
-            loc_futures = [ex.submit(_process_cutout,
-                                     id=id,
-                                     loc=locs[ix],
-                                     dataset=dataset,
-                                     radius=search_radius) for ix in np.where(to_fix)[0]]
-            for f in futures.as_completed(loc_futures):
-                pbar.update(1)
-
-    # Get results
-    results = [f.result() for f in loc_futures]
-
-    # Stack locations
-    new_locs = np.vstack(results)
+    to_fix_ix = np.where(to_fix)[0]
+    new_locs = _snap_locs(locs[to_fix_ix],
+                          id=id,
+                          radius=search_radius,
+                          max_workers=max_workers,
+                          dataset=dataset)
 
     # If no new location found, array will be [0, 0, 0]
     not_snapped = new_locs.max(axis=1) == 0
 
     # Update location
-    to_update = np.where(to_fix)[0][~not_snapped]
+    to_update = to_fix_ix[~not_snapped]
     locs[to_update, :] = new_locs[~not_snapped]
 
     if verbose:
@@ -1293,53 +1669,136 @@ def snap_to_id(locs, id, snap_zero=False, search_radius=160, coordinates='nm',
     return locs
 
 
-def _process_cutout(loc, id, radius=160, dataset='production'):
-    """Process single cutout for snap_to_id."""
-    # Get this location
-    loc = loc.round()
+def _snap_locs(locs, id, radius=160, max_workers=4, tile_size=(2048, 2048, 400),
+               dataset='production'):
+    """Snap locations to the closest voxel with given ID.
+
+    Locations are grouped into tiles which share a single cutout. Cutouts are
+    fetched in parallel and each is cut down to the windows around its
+    locations as soon as it arrives. Supervoxels across all cutouts are then
+    mapped to roots in one go.
+
+    Parameters
+    ----------
+    locs :          (N, 3) array
+                    Locations in nanometers.
+    id :            int
+                    The ID to snap to.
+    radius :        int
+                    Radius [nm] around each location to search.
+    tile_size :     (3, ) tuple
+                    Size [nm] of the tiles used to group locations.
+
+    Returns
+    -------
+    (N, 3) array
+                    Snapped locations. Locations that could not be snapped
+                    are returned as [0, 0, 0].
+
+    """
+    new_locs = np.zeros((len(locs), 3))
+    if not len(locs):
+        return new_locs
+
+    vol = get_cloudvolume(dataset)
+    res = np.asarray(vol.meta.resolution(0))
 
-    # Generating bounding box around this location
+    # Bounding boxes around each location (in voxels of the cutout)
+    loc = np.asarray(locs).round()
     mn = loc - radius
     mx = loc + radius
     # Make sure it's a multiple of 4 and 40
     mn = mn - mn % [4, 4, 40]
     mx = mx - mx % [4, 4, 40]
+    mn = (mn / res).round().astype(int)
+    mx = (mx / res).round().astype(int)
+
+    # Group locations into tiles
+    tiles = (loc // tile_size).astype(np.int64)
+    _, tile_ix = np.unique(tiles, axis=0, return_inverse=True)
+    tile_ix = tile_ix.ravel()
+    order = np.argsort(tile_ix, kind='stable')
+    members = np.split(order, np.cumsum(np.bincount(tile_ix))[:-1])
+    boxes = [np.vstack((mn[m].min(axis=0), mx[m].max(axis=0))) for m in members]
+
+    def _fetch_tile(m, box):
+        cutout, _, _ = get_segmentation_cutout(box * res,
+                                               root_ids=False,
+                                               coordinates='nm',
+                                               dataset=dataset)
+        # Renumbering makes the cutout much smaller in memory
+        cutout, remap = fastremap.renumber(cutout, in_place=True)
+
+        # Label -> supervoxel lookup
+        labels = np.zeros(max(remap.values()) + 1, dtype=np.uint64)
+        labels[list(remap.values())] = list(remap.keys())
+
+        # Keep only the windows around each location (copies, so that the
+        # full cutout can be released)
+        windows = [cutout[mn[i][0] - box[0][0]:mx[i][0] - box[0][0],
+                          mn[i][1] - box[0][1]:mx[i][1] - box[0][1],
+                          mn[i][2] - box[0][2]:mx[i][2] - box[0][2]].copy()
+                   for i in m]
+        return labels, windows
+
+    # Cutouts are reduced to their windows as soon as they arrive - i.e. only
+    # cutouts in flight are held in memory
+    tile_labels = []
+    windows = [None] * len(locs)
+    with navis.config.tqdm(desc='Fetching cutouts',
+                           total=len(boxes),
+                           disable=len(boxes) == 1,
+                           leave=False) as pbar:
+        with futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
+            for m, (labels, wins) in zip(members,
+                                         ex.map(_fetch_tile, members, boxes)):
+                tile_labels.append(labels)
+                for i, w in zip(m, wins):
+                    windows[i] = w
+                pbar.update(1)
 
-    # Generate bounding box
-    bbox = np.vstack((mn, mx))
+    # Map supervoxels across all cutouts to roots in one go
+    svoxels = np.unique(np.concatenate(tile_labels))
+    svoxels = svoxels[svoxels != 0]
+    if "flat" in str(dataset):
+        target = svoxels[svoxels == id]
+    else:
+        roots = supervoxels_to_roots(svoxels, dataset=vol)
+        target = svoxels[roots == id]
 
-    # Get the cutout, the resolution and offset
-    cutout, res, offset_nm = get_segmentation_cutout(bbox,
-                                                     dataset=dataset,
-                                                     root_ids=True,
-                                                     coordinates='nm')
+    for m, labels in zip(members, tile_labels):
+        is_target = np.isin(labels, target)
+        if not any(is_target):
+            continue
 
-    # Generate a mask
-    mask = (cutout == id).astype(int, copy=False)
+        for i in m:
+            window = is_target[windows[i]]
+            windows[i] = None
 
-    # Erode so we move our point slightly more inside the segmentation
-    mask = ndimage.binary_erosion(mask).astype(mask.dtype)
+            # Erode so we move our point slightly more inside the segmentation
+            window = ndimage.binary_erosion(window)
 
-    # Find positions the ID we are looking for
-    our_id = np.vstack(np.where(mask)).T
+            # Find positions the ID we are looking for
+            our_id = np.vstack(np.where(window)).T
 
-    # Return [0, 0, 0] if unable to snap (i.e. if id not within radius)
-    if not our_id.size:
-        return np.array([0, 0, 0])
+            # Leave [0, 0, 0] if unable to snap (i.e. if id not within radius)
+            if not our_id.size:
+                continue
 
-    # Get the closest on to the center of the cutout
-    center = np.divide(cutout.shape, 2).round()
-    dist = np.abs(our_id - center).sum(axis=1)
-    closest = our_id[np.argmin(dist)]
+            # Get the closest on to the center of the window
+            center = np.divide(window.shape, 2).round()
+            dist = np.abs(our_id - center).sum(axis=1)
+            closest = our_id[np.argmin(dist)]
 
-    # Convert the cutout offset to absolute 4/4/40 voxel coordinates
-    snapped = closest * res + offset_nm
+            # Convert to absolute coordinates
+            new_locs[i] = (closest + mn[i]) * res
 
-    return snapped
+    return new_locs
 
 
 @inject_dataset()
-def get_segmentation_cutout(bbox, root_ids=True, mip=0, coordinates='voxel', *, dataset=None):
+def get_segmentation_cutout(bbox, root_ids=True, mip=0, coordinates='voxel',
+                            return_lut=False, *, dataset=None):
     """Fetch cutout of segmentation.
 
     Parameters
@@ -1355,6 +1814,10 @@ def get_segmentation_cutout(bbox, root_ids=True, mip=0, coordinates='voxel', *,
     coordinates :   "voxel" | "nm"
                     Units in which your coordinates are in. "voxel" is assumed
                     to be 4x4x40 (x/y/z) nanometers.
+    return_lut :    bool
+                    If True and ``root_ids=True``, will not relabel the cutout
+                    but instead return supervoxel IDs plus a supervoxel -> root
+                    ID lookup table. Ignored if dataset is "flat_630".
     dataset :       "public" | "production" | "sandbox" | "flat_630", optional
                     Against which FlyWire dataset to query. If ``None`` will fall
                     back to the default dataset (see
@@ -1369,6 +1832,9 @@ def get_segmentation_cutout(bbox, root_ids=True, mip=0, coordinates='voxel', *,
     nm_offset :     (3, ) numpy array
                     [x, y, z] offset in nanometers of the cutout with respect
                     to the absolute coordinates.
+    lut :           dict
+                    Only if ``return_lut=True``: ``{supervoxel_id: root_id}``
+                    for all (non-zero) supervoxels in the cutout.
 
     """
     assert coordinates in ['nm', 'nanometer', 'nanometers', 'voxel', 'voxels']
@@ -1400,16 +1866,26 @@ def get_segmentation_cutout(bbox, root_ids=True, mip=0, coordinates='voxel', *,
                  bbox[0][1]:bbox[1][1],
                  bbox[0][2]:bbox[1][2]]
 
+    cutout = np.asarray(cutout)[:, :, :, 0]
+    resolution = np.asarray(vol.scale['resolution'])
+
     if root_ids and ("flat" not in dataset):
-        svoxels = np.unique(cutout.flatten())
+        svoxels = fastremap.unique(cutout)
+        svoxels = svoxels[svoxels != 0]
         roots = supervoxels_to_roots(svoxels, dataset=vol)
 
-        sv2r = dict(zip(svoxels[svoxels != 0], roots[svoxels != 0]))
+        sv2r = dict(zip(svoxels.tolist(), roots.astype(cutout.dtype).tolist()))
 
-        for k, v in sv2r.items():
-            cutout[cutout == k] = v
+        if return_lut:
+            return cutout, resolution, offset_nm, sv2r
 
-    return cutout[:, :, :, 0], np.asarray(vol.scale['resolution']), offset_nm
+        # Relabel all supervoxels in one go (zeros remain zeros)
+        cutout = fastremap.remap(cutout, sv2r, preserve_missing_labels=True,
+                                 in_place=True)
+    elif return_lut:
+        return cutout, resolution, offset_nm, {}
+
+    return cutout, resolution, offset_nm
 
 
 @inject_dataset(disallowed=['flat_630', 'flat_571'])
@@ -1502,7 +1978,7 @@ def is_valid_supervoxel(x, raise_exc=False, *, dataset=None):
 
 @inject_dataset(disallowed=['flat_630', 'flat_571'])
 def get_voxels(x, mip=0, sv_map=False, bounds=None, thin=False, progress=True,
-               use_mirror=True, threads=4, *, dataset=None):
+               use_mirror=True, threads=4, as_generator=False, *, dataset=None):
     """Fetch voxels making a up given root ID.
 
     Parameters
@@ -1533,6 +2009,10 @@ def get_voxels(x, mip=0, sv_map=False, bounds=None, thin=False, progress=True,
                     Number of parallel threads to use for fetching the data.
     progress :      bool
                     Whether to show a progress bar or not.
+    as_generator :  bool
+                    If True, will return a generator that yields voxels (and
+                    supervoxel IDs if `sv_map=True`) for one L2 chunk at a time.
+                    Can not be combined with `thin=True`.
     dataset :       "public" | "production" | "sandbox" | "flat_630", optional
                     Against which FlyWire dataset to query. If ``None`` will fall
                     back to the default dataset (see
@@ -1551,11 +2031,13 @@ def get_voxels(x, mip=0, sv_map=False, bounds=None, thin=False, progress=True,
     # 2. Get L2 graph and determine which L2 chunks are supposed to be connected
     # 3. Remove surface voxel between adjacent but not connected L2 chunks
 
-    from .l2 import chunks_to_nm
+    from .l2 import chunks_to_nm, _get_l2_leaves
+
+    if thin and as_generator:
+        raise ValueError('`thin=True` can not be combined with `as_generator=True`')
 
     # This is a mirror for base segmentation
     vol = get_cloudvolume(dataset)
-    client = get_cave_client()
 
     if use_mirror:
         sv_vol = cv.CloudVolume('precomputed://https://seungdata.princeton.edu/'
@@ -1568,13 +2050,13 @@ def get_voxels(x, mip=0, sv_map=False, bounds=None, thin=False, progress=True,
     is_valid_root(x, raise_exc=True)
 
     # Get L2 chunks making up this neuron
-    l2_ids = client.chunkedgraph.get_leaves(x, stop_layer=2)
+    l2_ids = _get_l2_leaves([x], progress=False, dataset=dataset)[0]
 
     # Get supervoxels for this neuron
     sv = roots_to_supervoxels(x, dataset=dataset)[x]
 
     # Turn l2_ids into chunk indices
-    l2_ix = [np.array(vol.mesh.meta.meta.decode_chunk_position(l)) for l in l2_ids]
+    l2_ix = get_id_decoder(vol).chunk_position(l2_ids)
     l2_ix = np.unique(l2_ix, axis=0)
 
     # Convert to nm
@@ -1591,98 +2073,201 @@ def get_voxels(x, mip=0, sv_map=False, bounds=None, thin=False, progress=True,
         l2_vxl = l2_vxl[np.all(l2_vxl >= bounds[:, 0], axis=1)]
         l2_vxl = l2_vxl[np.all(l2_vxl <= bounds[:, 1], axis=1)]
 
-    voxels = []
-    svids = []
     ch_size = np.array(vol.mesh.meta.meta.graph_chunk_size)
     ch_size = ch_size // (vol.mip_resolution(mip) / vol.mip_resolution(0))
-    old_mip = sv_vol.mip
-    old_parallel = sv_vol.parallel
-    try:
-        sv_vol.mip = mip
-        sv_vol.parallel = threads
-        for ch in tqdm(l2_vxl,
-                       disable=not progress,
-                       leave=False,
-                       desc='Fetching voxels'):
-            ct = sv_vol[ch[0]:ch[0] + ch_size[0],
-                        ch[1]:ch[1] + ch_size[1],
-                        ch[2]:ch[2] + ch_size[2]][:, :, :, 0]
-            is_root = np.isin(ct, sv)
-            this_vxl = np.dstack(np.where(is_root))[0]
-            this_vxl = this_vxl + ch
-            voxels.append(this_vxl)
 
-            if sv_map or thin:
-                svids.append(ct[is_root])
-    except BaseException:
-        raise
-    finally:
-        sv_vol.mip = old_mip
-        sv_vol.parallel = old_parallel
+    chunks = _iter_chunk_voxels(sv_vol, l2_vxl.astype(int), ch_size.astype(int),
+                                svoxels=sv, mip=mip, threads=threads,
+                                progress=progress)
 
+    if as_generator:
+        if sv_map:
+            return chunks
+        return (vxl for vxl, _ in chunks)
+
+    # Preallocate buffers and grow them as needed
     # uint 16 should be sufficient because even at mip 0 the volume has
     # shape (54100, 28160, 7046) -> doesn't exceed 65_535
-    voxels = np.vstack(voxels).astype('uint16')
-    if len(svids):
-        svids = np.concatenate(svids)
+    n = 0
+    voxels = np.zeros((max(len(l2_vxl), 1) * 1024, 3), dtype='uint16')
+    svids = np.zeros(len(voxels) if (sv_map or thin) else 0, dtype=np.uint64)
+    for this_vxl, this_sv in chunks:
+        if n + len(this_vxl) > len(voxels):
+            new_size = max(len(voxels) * 2, n + len(this_vxl))
+            voxels.resize((new_size, 3), refcheck=False)
+            if sv_map or thin:
+                svids.resize(new_size, refcheck=False)
+
+        voxels[n:n + len(this_vxl)] = this_vxl
+        if sv_map or thin:
+            svids[n:n + len(this_vxl)] = this_sv
+        n += len(this_vxl)
+
+    # Trim buffers to the final size
+    voxels.resize((n, 3), refcheck=False)
+    if sv_map or thin:
+        svids.resize(n, refcheck=False)
 
     if thin:
         from .l2 import l2_graph
 
-        try:
-            from pykdtree.kdtree import KDTree
-        except ImportError:
-            from scipy.spatial import cKDTree as KDTree
-
         # Get the l2 ID for each supervoxel
-        l2_ids = vol.get_roots(svids, stop_layer=2)
-        l2_dict = dict(zip(svids, l2_ids))
+        sv_uni, sv_inv = np.unique(svids, return_inverse=True)
+        l2_ids = np.asarray(vol.get_roots(sv_uni, stop_layer=2),
+                            dtype=np.int64)[sv_inv.ravel()]
 
         # Get the l2 graph
-        G = l2_graph(x)
+        G = l2_graph(x, as_networkx=False, dataset=dataset)
 
-        # Create KD tree for all voxels
-        tree = KDTree(voxels)
+        invalid = _find_invalid_voxels(voxels, svids, l2_ids, G.edges)
 
-        # Create a mask for invalidated voxels
-        invalid = np.zeros(len(voxels), dtype=bool)
+        voxels = voxels[~invalid]
+        svids = svids[~invalid]
+
+    if not sv_map:
+        return voxels
+    else:
+        return voxels, svids
 
-        # Now go over each supervoxel
-        for sv in tqdm(np.unique(svids),
-                       disable= not progress,
-                       desc='Thinning',
-                       leave=False):
-            # Get the voxels for this supervoxel
-            is_this_sv = svids == sv
 
-            # If supervoxel has no voxels just continue
-            if not np.any(is_this_sv):
-                continue
+def _find_invalid_voxels(voxels, svids, l2_ids, edges):
+    """Find voxels touching voxels of a not-connected L2 chunk.
 
-            # Get all supervoxels that could be connected to this supervoxel
-            is_this_l2 = l2_ids == l2_dict[sv]
-            is_connected_l2 = np.isin(l2_ids, list(G.neighbors(l2_dict[sv])))
+    For each pair of face-adjacent voxels (6-neighbourhood) that belong to
+    different L2 chunks which are not connected according to the L2 graph,
+    the voxel with the lower supervoxel ID is invalidated.
 
-            # The mask needs to exclude anything that:
-            # Isn't this supervoxel OR is supposed to be connected OR
-            # has already been invalidated in a prior run
-            mask = is_this_l2 | is_connected_l2 | invalid
+    Parameters
+    ----------
+    voxels :    (N, 3) array
+                Voxel coordinates. Must be unique.
+    svids :     (N, ) array
+                Supervoxel ID for each voxel.
+    l2_ids :    (N, ) array
+                L2 ID for each voxel.
+    edges :     (M, 2) array
+                Edges of the L2 graph.
 
-            # Find "other" voxels that touch voxels for this supervoxel
-            dist, ix = tree.query(voxels[is_this_sv],
-                                  mask=mask,
-                                  distance_upper_bound=1.75)
-            is_touching = dist < np.inf
+    Returns
+    -------
+    invalid :   (N, ) bool array
 
-            if not np.any(is_touching):
-                continue
+    """
+    invalid = np.zeros(len(voxels), dtype=bool)
+    if not len(voxels):
+        return invalid
+
+    # Turn voxel coordinates into linear indices - pad by one voxel on each
+    # side so that neighbours don't wrap around
+    vxl = voxels.astype(np.int64) - voxels.min(axis=0).astype(np.int64) + 1
+    dims = vxl.max(axis=0) + 2
+    keys = np.ravel_multi_index(vxl.T, dims)
+    srt = np.argsort(keys)
+    keys_srt = keys[srt]
+
+    # Turn L2 IDs into indices and edges into sorted (lower, higher) keys
+    l2_uni, l2_ix = np.unique(l2_ids, return_inverse=True)
+    l2_ix = l2_ix.ravel()
+    edges = edges[np.isin(edges, l2_uni).all(axis=1)]
+    edges = np.searchsorted(l2_uni, edges)
+    edge_keys = np.unique(edges.min(axis=1) * len(l2_uni) + edges.max(axis=1))
+
+    # We only need to check half the neighbourhood since pairs are symmetric
+    offsets = np.eye(3, dtype=np.int64)
+    for o in offsets:
+        nb = keys + np.ravel_multi_index(o + 1, dims) - np.ravel_multi_index((1, 1, 1), dims)
+        ix = np.searchsorted(keys_srt, nb).clip(max=len(keys_srt) - 1)
+        has_nb = keys_srt[ix] == nb
+
+        this = np.where(has_nb)[0]
+        other = srt[ix[has_nb]]
+
+        # Ignore pairs within the same L2 chunk
+        a, b = l2_ix[this], l2_ix[other]
+        diff = a != b
+        this, other, a, b = this[diff], other[diff], a[diff], b[diff]
+
+        # Ignore pairs of L2 chunks that are connected
+        pair_keys = np.minimum(a, b) * len(l2_uni) + np.maximum(a, b)
+        if len(edge_keys):
+            eix = np.searchsorted(edge_keys, pair_keys).clip(max=len(edge_keys) - 1)
+            connected = edge_keys[eix] == pair_keys
+        else:
+            connected = np.zeros(len(pair_keys), dtype=bool)
+        this, other = this[~connected], other[~connected]
 
-            invalid[np.where(is_this_sv)[0][is_touching]] = True
+        # Invalidate the voxel with the lower supervoxel ID
+        lower = np.where(svids[this] < svids[other], this, other)
+        invalid[lower] = True
 
-        voxels = voxels[~invalid]
-        svids = svids[~invalid]
+    return invalid
 
-    if not sv_map:
-        return voxels
-    else:
-        return voxels, svids
+
+def _iter_chunk_voxels(sv_vol, chunks, ch_size, svoxels, mip=0, threads=4,
+                       progress=True):
+    """Generator yielding voxels belonging to given supervoxels chunk by chunk.
+
+    Chunks are fetched in parallel threads but yielded in order.
+
+    Parameters
+    ----------
+    sv_vol :    CloudVolume
+                Volume to fetch supervoxels from.
+    chunks :    (N, 3) array
+                Offsets of chunks to fetch (in voxels at given `mip`).
+    ch_size :   (3, ) array
+                Size of chunks (in voxels at given `mip`).
+    svoxels :   array
+                Supervoxels to collect voxels for.
+
+    Yields
+    ------
+    voxels :    (M, 3) uint16 array
+    svoxels :   (M, ) uint64 array
+                Supervoxel ID for each voxel.
+
+    """
+    svoxels = np.unique(np.asarray(svoxels, dtype=np.uint64))
+
+    def _fetch(ch):
+        # Pass `mip` and `parallel` (we use our own threads) explicitly
+        # instead of setting them on the (shared) volume
+        ct = sv_vol.download(cv.Bbox(ch, ch + ch_size),
+                             mip=mip,
+                             parallel=1,
+                             agglomerate=False)[:, :, :, 0]
+
+        # Restrict the look-up to the supervoxels in this chunk
+        present = fastremap.unique(ct).astype(np.uint64, copy=False)
+        if len(svoxels):
+            ix = np.searchsorted(svoxels, present).clip(max=len(svoxels) - 1)
+            present = present[svoxels[ix] == present]
+        else:
+            present = present[:0]
+
+        if not len(present):
+            return np.zeros((0, 3), dtype='uint16'), np.zeros(0, dtype=np.uint64)
+
+        is_root = np.isin(ct, present)
+        this_vxl = (np.argwhere(is_root) + ch).astype('uint16')
+        return this_vxl, ct[is_root].astype(np.uint64, copy=False)
+
+    with tqdm(total=len(chunks),
+              disable=not progress,
+              leave=False,
+              desc='Fetching voxels') as pbar:
+        with futures.ThreadPoolExecutor(max_workers=max(threads, 1)) as ex:
+            # Only keep a limited number of chunks in flight
+            pending = []
+            try:
+                for ch in chunks:
+                    pending.append(ex.submit(_fetch, ch))
+                    if len(pending) > threads * 2:
+                        yield pending.pop(0).result()
+                        pbar.update()
+                while pending:
+                    yield pending.pop(0).result()
+                    pbar.update()
+            finally:
+                for f in pending:
+                    f.cancel()
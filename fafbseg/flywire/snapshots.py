@@ -0,0 +1,571 @@
+#    A collection of tools to interface with manually traced and autosegmented
+#    data in FAFB.
+#
+#    Copyright (C) 2019 Philipp Schlegel
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+
+"""Local snapshots of materialized synapse tables.
+
+A snapshot is a one-off download of a (frozen) materialization's synapse
+table which is then used to answer synapse queries locally. On disk, a
+snapshot is a directory with the following layout::
+
+    _snapshot.json          manifest (parameters + download progress)
+    pages/                  raw download pages (removed once complete)
+    by_pre/part-XXX.parquet synapses partitioned by `pre_pt_root_id % N`
+                            and sorted by `pre_pt_root_id`
+    by_post/part-XXX.parquet  same for `post_pt_root_id`
+
+Each partition is written with small row groups. Parquet keeps min/max
+statistics for each row group which lets pyarrow skip row groups that
+can't contain any of the queried root IDs (predicate pushdown).
+
+"""
+
+import json
+import navis
+import os
+import shutil
+
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+from .cache import CACHE_ROOT, dataset_key
+from .utils import get_cave_client, retry, inject_dataset
+
+__all__ = ['create_synapse_snapshot', 'get_synapse_snapshot',
+           'list_synapse_snapshots', 'SynapseSnapshot']
+
+# Snapshots live here
+SNAPSHOT_DIR = CACHE_ROOT + 'synapse_snapshots/'
+
+# Columns stored in the snapshots (positions are split into x/y/z)
+SNAPSHOT_COLUMNS = ['id', 'pre_pt_root_id', 'post_pt_root_id', 'cleft_score',
+                    'pre_pt_position', 'post_pt_position',
+                    'gaba', 'ach', 'glut', 'oct', 'ser', 'da']
+
+# The view containing only the "valid" (i.e. filtered) synapses
+FILTERED_VIEW = 'valid_synapses_nt_v2_view'
+
+
+def _snapshot_path(dataset, mat, filtered):
+    ds = dataset_key(dataset)
+    if ds is None:
+        return None
+    kind = 'filtered' if filtered else 'unfiltered'
+    return Path(SNAPSHOT_DIR).expanduser() / ds / f'mat{int(mat)}_{kind}'
+
+
+class SynapseSnapshot:
+    """Local snapshot of a materialized synapse table.
+
+    Use :func:`~fafbseg.flywire.create_synapse_snapshot` to create and
+    :func:`~fafbseg.flywire.get_synapse_snapshot` to load snapshots.
+
+    Parameters
+    ----------
+    path :      str | pathlib.Path
+                Directory containing the snapshot.
+
+    """
+
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+        with open(self.path / '_snapshot.json', 'r') as f:
+            self.manifest = json.load(f)
+
+        if self.manifest.get('status') != 'complete':
+            raise ValueError(f'Snapshot at "{self.path}" is incomplete. Run '
+                             '`create_synapse_snapshot` again to resume.')
+
+        self.n_partitions = self.manifest['n_partitions']
+
+    def __repr__(self):
+        return (f'<SynapseSnapshot(mat={self.mat}, filtered={self.filtered}, '
+                f'n_rows={self.manifest["n_rows"]:,})>')
+
+    @property
+    def mat(self):
+        """Materialization version of this snapshot."""
+        return self.manifest['mat']
+
+    @property
+    def filtered(self):
+        """Whether this snapshot contains only the filtered synapses."""
+        return self.manifest['filtered']
+
+    @property
+    def timestamp(self):
+        """Timestamp of the materialization (``None`` for older snapshots)."""
+        ts = self.manifest.get('timestamp', None)
+        return dt.datetime.fromisoformat(ts) if ts else None
+
+    @property
+    def columns(self):
+        """Columns available in this snapshot."""
+        return self.manifest['columns']
+
+    def query(self, pre=None, post=None, columns=None):
+        """Query synapses by pre- and/or postsynaptic root IDs.
+
+        Parameters
+        ----------
+        pre :       list of int, optional
+                    Presynaptic root IDs.
+        post :      list of int, optional
+                    Postsynaptic root IDs. If both ``pre`` and ``post`` are
+                    provided, will return synapses between the two sets.
+        columns :   list of str, optional
+                    Columns to return. Positions can be requested either as
+                    e.g. "pre_pt_position" or as "pre_pt_position_x".
+
+        Returns
+        -------
+        pandas.DataFrame
+
+        """
+        if pre is None and post is None:
+            raise ValueError('Must provide `pre` and/or `post` root IDs.')
+
+        columns = self._parse_columns(columns)
+
+        # Use the side with fewer IDs for the lookup
+        if pre is not None and (post is None or len(pre) <= len(post)):
+            side, ids, other, other_ids = 'pre', pre, 'post', post
+        else:
+            side, ids, other, other_ids = 'post', post, 'pre', pre
+
+        read_cols = columns
+        if other_ids is not None and f'{other}_pt_root_id' not in read_cols:
+            read_cols = read_cols + [f'{other}_pt_root_id']
+
+        df = self._read(side, ids, read_cols)
+
+        if other_ids is not None:
+            other_ids = np.asarray(other_ids, dtype=np.int64)
+            df = df[np.isin(df[f'{other}_pt_root_id'].values, other_ids)]
+
+        return df[columns].reset_index(drop=True)
+
+    def _parse_columns(self, columns):
+        if columns is None:
+            return list(self.columns)
+
+        parsed = []
+        for c in navis.utils.make_iterable(columns):
+            if c in self.columns:
+                parsed.append(c)
+            elif f'{c}_x' in self.columns:
+                parsed += [f'{c}_{co}' for co in 'xyz']
+            else:
+                raise ValueError(f'Column "{c}" not in snapshot')
+        return parsed
+
+    def _read(self, side, ids, columns):
+        """Read rows for given root IDs from the given side."""
+        import pyarrow.parquet as pq
+
+        col = f'{side}_pt_root_id'
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        parts = ids % self.n_partitions
+
+        tables = []
+        for p in np.unique(parts):
+            fp = self.path / f'by_{side}' / f'part-{p:03d}.parquet'
+            if not fp.is_file():
+                continue
+            # Partitions are sorted by root ID -> pyarrow will use the
+            # row group statistics to skip row groups not containing our IDs
+            t = pq.read_table(fp, columns=columns,
+                              filters=[(col, 'in', ids[parts == p].tolist())])
+            tables.append(t.to_pandas())
+
+        if not tables:
+            return pd.DataFrame({c: pd.Series(dtype=self.manifest['dtypes'][c])
+                                 for c in columns})
+
+        return pd.concat(tables, axis=0, ignore_index=True)
+
+    def query_table(self, filter_in_dict=None, select_columns=None, **kwargs):
+        """Mimic ``client.materialize.query_table`` for synapse queries.
+
+        Only ``filter_in_dict`` with ``pre_pt_root_id`` and/or
+        ``post_pt_root_id`` is supported. Positions are always returned
+        split into x/y/z.
+        """
+        filter_in_dict = dict(filter_in_dict or {})
+
+        # Unpack join-style filters, e.g. {'synapses_nt_v1': {...}}
+        if len(filter_in_dict) == 1:
+            v = list(filter_in_dict.values())[0]
+            if isinstance(v, dict):
+                filter_in_dict = v
+
+        unknown = set(filter_in_dict) - {'pre_pt_root_id', 'post_pt_root_id'}
+        if unknown:
+            raise ValueError(f'Unsupported filter(s): {unknown}')
+
+        return self.query(pre=filter_in_dict.get('pre_pt_root_id', None),
+                          post=filter_in_dict.get('post_pt_root_id', None),
+                          columns=select_columns)
+
+
+@inject_dataset(disallowed=["flat_630", "flat_571"])
+def get_synapse_snapshot(mat, filtered=True, *, dataset=None):
+    """Load local synapse snapshot.
+
+    Parameters
+    ----------
+    mat :           int
+                    Materialization version.
+    filtered :      bool
+                    Whether to load the snapshot of the filtered or the
+                    unfiltered synapse table.
+    dataset :       "public" | "production" | "sandbox", optional
+                    Against which FlyWire dataset to query. If ``None`` will fall
+                    back to the default dataset (see
+                    :func:`~fafbseg.flywire.set_default_dataset`).
+
+    Returns
+    -------
+    SynapseSnapshot
+                    Returns ``None`` if there is no (complete) snapshot.
+
+    """
+    if not isinstance(mat, (int, np.integer)):
+        return None
+
+    path = _snapshot_path(dataset, mat, filtered)
+    if path is None or not (path / '_snapshot.json').is_file():
+        return None
+
+    try:
+        return SynapseSnapshot(path)
+    except ValueError:
+        return None
+
+
+def list_synapse_snapshots():
+    """List local synapse snapshots.
+
+    Returns
+    -------
+    pandas.DataFrame
+
+    """
+    rows = []
+    for fp in sorted(Path(SNAPSHOT_DIR).expanduser().glob('*/*/_snapshot.json')):
+        with open(fp, 'r') as f:
+            m = json.load(f)
+        rows.append([m['dataset'], m['mat'], m['filtered'], m['status'],
+                     m.get('n_rows', None), str(fp.parent)])
+
+    return pd.DataFrame(rows, columns=['dataset', 'mat', 'filtered', 'status',
+                                       'n_rows', 'path'])
+
+
+@inject_dataset(disallowed=["flat_630", "flat_571"])
+def create_synapse_snapshot(mat, filtered=True, page_size=100_000,
+                            n_partitions=64, row_group_size=50_000,
+                            max_threads=4, progress=True, *, dataset=None):
+    """Download a materialized synapse table for local queries.
+
+    Once a snapshot exists, :func:`~fafbseg.flywire.fetch_synapses`,
+    :func:`~fafbseg.flywire.fetch_connectivity` and
+    :func:`~fafbseg.flywire.fetch_adjacency` will use it to answer queries
+    for that materialization version locally instead of querying CAVE.
+
+    The download is split into pages of synapse IDs (``page_size`` IDs per
+    page) up to the highest synapse ID in the table. Pages that hit the row
+    limit for individual queries are split until they don't. Once all pages
+    are downloaded, the number of synapses is checked against the server.
+    If interrupted, simply run this function again to resume.
+
+    Parameters
+    ----------
+    mat :           int
+                    Materialization version to download. Use e.g.
+                    :func:`~fafbseg.flywire.get_materialization_versions` to
+                    see what's available.
+    filtered :      bool
+                    If True (default), will download the filtered synapses
+                    (``valid_synapses_nt_v2_view``). If False, will download
+                    the full synapse table.
+    page_size :     int
+                    Number of synapse IDs per page. Pages with more synapses
+                    than a single query can return are split automatically.
+    n_partitions :  int
+                    Number of files to partition the synapses into.
+    row_group_size : int
+                    Number of rows per Parquet row group. Smaller row groups
+                    make lookups of few neurons faster.
+    max_threads :   int
+                    Number of pages to download in parallel.
+    progress :      bool
+                    Whether to show progress bars.
+    dataset :       "public" | "production" | "sandbox", optional
+                    Against which FlyWire dataset to query. If ``None`` will fall
+                    back to the default dataset (see
+                    :func:`~fafbseg.flywire.set_default_dataset`).
+
+    Returns
+    -------
+    SynapseSnapshot
+
+    Examples
+    --------
+    >>> from fafbseg import flywire
+    >>> snap = flywire.create_synapse_snapshot(783)             # doctest: +SKIP
+    >>> # This now answers from the local snapshot
+    >>> syn = flywire.fetch_synapses(720575940603231916, mat=783)  # doctest: +SKIP
+
+    """
+    if not isinstance(mat, (int, np.integer)):
+        raise ValueError(f'`mat` must be an integer, got "{mat}"')
+
+    if dataset in ('public', ) and not filtered:
+        raise ValueError('Unable to query unfiltered synapses for the public '
+                         'release data.')
+
+    path = _snapshot_path(dataset, mat, filtered)
+    if path is None:
+        raise ValueError(f'Unable to create snapshot for dataset "{dataset}"')
+    path.mkdir(parents=True, exist_ok=True)
+
+    manifest_path = path / '_snapshot.json'
+    if manifest_path.is_file():
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if manifest['status'] == 'complete':
+            return SynapseSnapshot(path)
+        if manifest['page_size'] != page_size:
+            raise ValueError('Existing (incomplete) snapshot was created with '
+                             f'`page_size={manifest["page_size"]}`')
+    else:
+        manifest = {'dataset': str(dataset),
+                    'mat': int(mat),
+                    'filtered': bool(filtered),
+                    'page_size': int(page_size),
+                    'status': 'downloading',
+                    'pages': {}}
+
+    def write_manifest():
+        tmp = path / '_snapshot.json.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, manifest_path)
+
+    write_manifest()
+
+    client = get_cave_client(dataset=dataset)
+    if filtered:
+        func = partial(retry(client.materialize.query_view),
+                       view_name=FILTERED_VIEW)
+    else:
+        func = partial(retry(client.materialize.query_table),
+                       table=client.materialize.synapse_table)
+    func = partial(func, materialization_version=mat)
+
+    # Keep the materialization's timestamp so that we can check root IDs
+    # against it without asking the server
+    if 'timestamp' not in manifest:
+        manifest['timestamp'] = retry(client.materialize.get_timestamp)(mat).isoformat()
+        write_manifest()
+
+    if manifest['status'] == 'downloading':
+        if 'max_id' not in manifest:
+            manifest['max_id'] = _find_max_id(func)
+            write_manifest()
+
+        _download_pages(partial(func,
+                                split_positions=True,
+                                select_columns=SNAPSHOT_COLUMNS),
+                        path, manifest, write_manifest,
+                        max_threads=max_threads,
+                        progress=progress)
+
+        # Make sure we got everything
+        n_server = _count_rows(client, mat, filtered)
+        n_local = sum(manifest['pages'].values())
+        if n_server != n_local:
+            raise ValueError(f'Downloaded {n_local:,} synapses but the server '
+                             f'reports {n_server:,}. Snapshot remains incomplete.')
+
+        manifest['status'] = 'partitioning'
+        write_manifest()
+
+    _partition_pages(path, manifest,
+                     n_partitions=n_partitions,
+                     row_group_size=row_group_size,
+                     progress=progress)
+    manifest['status'] = 'complete'
+    write_manifest()
+
+    # Raw pages are no longer needed
+    shutil.rmtree(path / 'pages', ignore_errors=True)
+
+    return SynapseSnapshot(path)
+
+
+def _find_max_id(func):
+    """Find the highest synapse ID in a table (or view)."""
+    def exists(above):
+        return not func(filter_greater_dict={'id': above},
+                        select_columns=['id'],
+                        limit=1).empty
+
+    if not exists(-1):
+        raise ValueError('Table contains no synapses.')
+
+    # Find an upper bound, then bisect such that there is an ID > lo but
+    # none > hi
+    lo, hi = -1, 1
+    while exists(hi):
+        lo, hi = hi, hi * 2
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if exists(mid):
+            lo = mid
+        else:
+            hi = mid
+    return hi
+
+
+def _fetch_id_range(func, start, stop, limit):
+    """Fetch synapses with IDs in [start, stop) - splitting if truncated."""
+    df = func(filter_greater_equal_dict={'id': start},
+              filter_less_dict={'id': stop})
+    df.attrs = {}
+    if len(df) < limit:
+        return df
+    if stop - start <= 1:
+        raise ValueError(f'Query for synapse ID {start} hit the row limit.')
+    mid = (start + stop) // 2
+    return pd.concat([_fetch_id_range(func, start, mid, limit),
+                      _fetch_id_range(func, mid, stop, limit)],
+                     axis=0, ignore_index=True)
+
+
+def _count_rows(client, mat, filtered):
+    """Get the number of synapses in the table/view on the server."""
+    if filtered:
+        n = retry(client.materialize.query_view)(FILTERED_VIEW,
+                                                 materialization_version=mat,
+                                                 get_counts=True)
+    else:
+        n = retry(client.materialize.get_annotation_count)(
+            client.materialize.synapse_table, version=mat)
+
+    # Counts for views come back as a (single cell) DataFrame
+    if isinstance(n, pd.DataFrame):
+        n = n.values.ravel()[0]
+
+    return int(n)
+
+
+def _download_pages(func, path, manifest, write_manifest, max_threads,
+                    progress):
+    """Download synapse table in pages of synapse IDs."""
+    from .synapses import MAX_QUERY_ROWS
+
+    page_size = manifest['page_size']
+    pages_dir = path / 'pages'
+    pages_dir.mkdir(exist_ok=True)
+
+    def fetch_page(k):
+        fp = pages_dir / f'page-{k:06d}.parquet'
+        df = _fetch_id_range(func, k * page_size, (k + 1) * page_size,
+                             limit=MAX_QUERY_ROWS)
+        if not df.empty:
+            tmp = pages_dir / f'.page-{k:06d}.parquet.tmp'
+            df.to_parquet(tmp, index=False)
+            os.replace(tmp, fp)
+        return len(df)
+
+    n_pages = manifest['max_id'] // page_size + 1
+    todo = [k for k in range(n_pages) if str(k) not in manifest['pages']]
+    with navis.config.tqdm(desc='Downloading synapses',
+                           total=n_pages,
+                           initial=n_pages - len(todo),
+                           disable=not progress,
+                           unit=' pages',
+                           leave=False) as pbar, \
+         ThreadPoolExecutor(max_workers=max(max_threads, 1)) as pool:
+        # Fetch in waves so that we can record progress along the way
+        wave_size = max(max_threads, 1) * 4
+        for i in range(0, len(todo), wave_size):
+            wave = todo[i:i + wave_size]
+            for p, n in zip(wave, pool.map(fetch_page, wave)):
+                manifest['pages'][str(p)] = n
+                pbar.update(1)
+            write_manifest()
+
+
+def _partition_pages(path, manifest, n_partitions, row_group_size, progress):
+    """Partition and sort downloaded pages by pre- and postsynaptic IDs."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    pages = sorted((path / 'pages').glob('page-*.parquet'))
+    if not pages:
+        raise ValueError('No synapses downloaded.')
+
+    schema = pq.read_schema(pages[0])
+    manifest['columns'] = schema.names
+    manifest['dtypes'] = {f.name: np.dtype(f.type.to_pandas_dtype()).str
+                          for f in schema}
+    manifest['n_partitions'] = int(n_partitions)
+    manifest['n_rows'] = int(sum(manifest['pages'].values()))
+
+    for side in ('pre', 'post'):
+        col = f'{side}_pt_root_id'
+        side_dir = path / f'by_{side}'
+        staging = path / f'staging_{side}'
+        shutil.rmtree(side_dir, ignore_errors=True)
+        shutil.rmtree(staging, ignore_errors=True)
+        staging.mkdir()
+
+        # Step 1: split pages into partitions (streaming)
+        writers = {}
+        try:
+            for fp in navis.config.tqdm(pages,
+                                        desc=f'Partitioning ({side})',
+                                        disable=not progress,
+                                        leave=False):
+                table = pq.read_table(fp).cast(schema)
+                part = table[col].to_numpy() % n_partitions
+                for p in np.unique(part):
+                    if p not in writers:
+                        writers[p] = pq.ParquetWriter(staging / f'part-{p:03d}.parquet',
+                                                      schema)
+                    writers[p].write_table(table.filter(pa.array(part == p)))
+        finally:
+            for w in writers.values():
+                w.close()
+
+        # Step 2: sort each partition and write with small row groups
+        side_dir.mkdir()
+        for fp in navis.config.tqdm(sorted(staging.glob('part-*.parquet')),
+                                    desc=f'Sorting ({side})',
+                                    disable=not progress,
+                                    leave=False):
+            table = pq.read_table(fp).sort_by([(col, 'ascending'),
+                                                ('id', 'ascending')])
+            pq.write_table(table, side_dir / fp.name,
+                           row_group_size=row_group_size)
+
+        shutil.rmtree(staging, ignore_errors=True)
@@ -14,13 +14,13 @@
 #    GNU General Public License for more details.
 
 import navis
+import requests
 
 import datetime as dt
 import numpy as np
 import pandas as pd
 
 from functools import partial
-from tqdm.auto import trange
 
 from .segmentation import get_lineage_graph, roots_to_supervoxels
 from .utils import (
@@ -30,8 +30,11 @@ from .utils import (
     get_synapse_areas,
     find_mat_version,
     inject_dataset,
+    run_batched,
+    is_timeout,
 )
 from .annotations import is_proofread
+from .snapshots import get_synapse_snapshot
 
 from ..utils import make_iterable
 from ..synapses.utils import catmaid_table
@@ -45,6 +48,9 @@ __all__ = [
     "synapse_counts",
 ]
 
+# Individual queries can't return more than this many rows
+MAX_QUERY_ROWS = 200_000
+
 
 @inject_dataset(disallowed=["flat_630", "flat_571"])
 def synapse_counts(
@@ -290,6 +296,9 @@ def fetch_synapses(
     clean=True,
     mat="auto",
     batch_size=10,
+    max_threads=4,
+    compact=False,
+    as_generator=False,
     *,
     dataset=None,
     progress=True,
@@ -336,10 +345,20 @@ def fetch_synapses(
                         - drop synapses that are >10um from the skeleton (only
                           if ``attach=True``)
     batch_size :    int
-                    Number of IDs to query per batch. Too large batches might
-                    lead to truncated tables: currently individual queries can
-                    not return more than 500_000 rows and you will see a warning
-                    if that limit is exceeded.
+                    Max number of IDs to query per batch. Individual queries
+                    can not return more than 200_000 rows: batches that hit
+                    this limit are split and queried again.
+    max_threads :   int
+                    Number of batches to query in parallel.
+    compact :       bool
+                    If True, will use memory-efficient data types: int32 for
+                    positions, float32 for transmitter probabilities and
+                    uint64 for root IDs.
+    as_generator :  bool
+                    If True, will return a generator that yields one table
+                    per batch instead of a single table. Use this to process
+                    the synapses of very large queries in chunks. Note that
+                    ``attach`` is ignored in this case.
     mat :           int | str, optional
                     Which materialization to query:
                      - 'auto' (default) tries to find the most recent
@@ -359,6 +378,9 @@ def fetch_synapses(
                     will show up only once. Depending on the query neurons
                     (`x`), a given row might represent a presynapse for one and
                     a postsynapse for another neuron.
+    generator
+                    If ``as_generator=True``. Yields one DataFrame per batch.
+                    Each synapse is still only returned once.
 
 
     Examples
@@ -414,20 +436,24 @@ def fetch_synapses(
                "also drop the de-duplication (see docstring).")
         navis.config.logger.warning(msg)
 
-    # Parse root IDs
+    # Parse root IDs (drop duplicates but keep the order)
     ids = parse_root_ids(x).astype(np.int64)
-
-    # Get the cave client
-    client = get_cave_client(dataset=dataset)
+    ids = ids[np.sort(np.unique(ids, return_index=True)[1])]
 
     # Check if IDs existed at this materialization
     if mat == "latest":
-        mat = client.materialize.most_recent_version()
+        mat = get_cave_client(dataset=dataset).materialize.most_recent_version()
 
     if mat == "auto":
         mat = find_mat_version(ids, dataset=dataset, verbose=progress)
+        snap = get_synapse_snapshot(mat, filtered=filtered, dataset=dataset)
     else:
-        _check_ids(ids, mat=mat, dataset=dataset)
+        # Use a local snapshot for this materialization if we have one
+        snap = get_synapse_snapshot(mat, filtered=filtered, dataset=dataset)
+        _check_ids(ids, mat=mat, snapshot=snap, dataset=dataset)
+
+    # Local snapshots are queried without the server
+    client = get_cave_client(dataset=dataset) if snap is None else None
 
     columns = [
         "pre_pt_root_id",
@@ -445,15 +471,17 @@ def fetch_synapses(
         raise ValueError("Can't fetch filtered synapses for live query.")
     elif mat == "live":
         func = partial(
-            retry(client.materialize.live_query),
+            client.materialize.live_query,
             table=client.materialize.synapse_table,
             timestamp=dt.datetime.utcnow(),
             split_positions=True,
             select_columns=columns,
         )
+    elif snap is not None:
+        func = partial(snap.query_table, select_columns=columns)
     elif filtered:
         func = partial(
-            retry(client.materialize.query_view),
+            client.materialize.query_view,
             view_name='valid_synapses_nt_v2_view',
             materialization_version=mat,
             split_positions=True,
@@ -461,86 +489,59 @@ def fetch_synapses(
         )
     else:
         func = partial(
-            retry(client.materialize.query_table),
+            client.materialize.query_table,
             table=client.materialize.synapse_table,
             split_positions=True,
             materialization_version=mat,
             select_columns=columns,
         )
 
-    syn = []
-    for i in trange(
-        0,
-        len(ids),
-        batch_size,
-        desc="Fetching synapses",
-        disable=not progress or len(ids) <= batch_size,
-    ):
-        batch = ids[i : i + batch_size]
-        if post:
-            syn.append(func(filter_in_dict=dict(post_pt_root_id=batch)))
-        if pre:
-            syn.append(func(filter_in_dict=dict(pre_pt_root_id=batch)))
-
-    # Drop attrs to avoid issues when concatenating
-    for df in syn:
-        df.attrs = {}
-
-    # Combine results from batches
-    syn = pd.concat(syn, axis=0, ignore_index=True)
-
-    # Rename some of those columns
-    syn.rename(
-        {
-            "post_pt_root_id": "post",
-            "pre_pt_root_id": "pre",
-            "post_pt_position_x": "post_x",
-            "post_pt_position_y": "post_y",
-            "post_pt_position_z": "post_z",
-            "pre_pt_position_x": "pre_x",
-            "pre_pt_position_y": "pre_y",
-            "pre_pt_position_z": "pre_z",
-            "idx": "id",  # this may exists if we made a join query
-            "id_x": "id",  # this may exists if we made a join query
-        },
-        axis=1,
-        inplace=True,
+    filters = []
+    if post:
+        filters.append(lambda b: dict(post_pt_root_id=b))
+    if pre:
+        filters.append(lambda b: dict(pre_pt_root_id=b))
+
+    # Each batch is cleaned up (and de-duplicated) individually
+    process = partial(
+        _process_synapse_batch,
+        ids=ids,
+        pre=pre,
+        post=post,
+        min_score=min_score,
+        clean=clean,
+        compact=compact,
+        # For generators we need to add neuropils per batch
+        neuropils=neuropils and as_generator,
     )
 
-    # Depending on how queries were batched, we need to drop duplicate synapses
-    syn.drop_duplicates("id", inplace=True)
-
-    if transmitters:
-        syn.rename(
-            {
-                "ach": "acetylcholine",
-                "glut": "glutamate",
-                "oct": "octopamine",
-                "ser": "serotonin",
-                "da": "dopamine",
-            },
-            axis=1,
-            inplace=True,
-        )
-
-    # Next we need to run some clean-up:
-    # Drop below threshold connections
-    if min_score:
-        syn = syn[syn.cleft_score >= min_score]
-
-    if clean:
-        # Drop autapses
-        syn = syn[syn.pre != syn.post]
-        # Drop connections involving 0 (background, glia)
-        syn = syn[(syn.pre != 0) & (syn.post != 0)]
+    if as_generator:
+        return _iter_synapse_batches(func, ids, filters, process,
+                                     batch_size=batch_size,
+                                     max_threads=max_threads,
+                                     progress=progress,
+                                     row_limit=_row_limit(snap),
+                                     mat=mat)
+
+    syn = _run_queries(func, ids, filters,
+                       batch_size=batch_size,
+                       max_threads=max_threads,
+                       progress=progress,
+                       process=process,
+                       row_limit=_row_limit(snap),
+                       desc="Fetching synapses")
+
+    # Offset the indices such that they are unique across batches
+    offset = 0
+    for n, df in syn:
+        df.index += offset
+        offset += n
 
-    # Avoid copy warning
-    if syn._is_view:
-        syn = syn.copy()
+    # Combine results from batches
+    syn = pd.concat([df for _, df in syn], axis=0)
 
     if neuropils:
         syn["neuropil"] = get_synapse_areas(syn["id"].values)
-        syn["neuropil"] = syn.neuropil.astype("category")
 
     # Drop ID column
     # syn.drop('id', axis=1, inplace=True)
@@ -554,14 +555,14 @@ def fetch_synapses(
             add_cols = ["neuropil"] if neuropils else []
             if pre:
                 cols = ["pre_x", "pre_y", "pre_z", "cleft_score", "post"] + add_cols
-                presyn = syn.loc[syn.pre == np.int64(n.id), cols].rename(
+                presyn = syn.loc[syn.pre == syn.pre.dtype.type(n.id), cols].rename(
                     {"pre_x": "x", "pre_y": "y", "pre_z": "z", "post": "partner_id"},
                     axis=1,
                 )
                 presyn["type"] = "pre"
             if post:
                 cols = ["post_x", "post_y", "post_z", "cleft_score", "pre"] + add_cols
-                postsyn = syn.loc[syn.post == np.int64(n.id), cols].rename(
+                postsyn = syn.loc[syn.post == syn.post.dtype.type(n.id), cols].rename(
                     {"post_x": "x", "post_y": "y", "post_z": "z", "pre": "partner_id"},
                     axis=1,
                 )
@@ -603,6 +604,7 @@ def fetch_adjacency(
     filtered=True,
     min_score=None,
     batch_size=1000,
+    max_threads=4,
     *,
     dataset=None,
     progress=True,
@@ -647,11 +649,11 @@ def fetch_adjacency(
                     in their paper. However, for FlyWire analyses that threshold
                     was raised to 50 (see also `filtered`).
     batch_size :    int
-                    Number of IDs to query per batch. Too large batches can
-                    lead to truncated tables: currently individual queries do
-                    not return more than 200_000 connections. If you see a
-                    warning that this limit has been exceeded, decrease the
-                    batch size!
+                    Max number of IDs to query per batch. Individual queries
+                    can not return more than 200_000 connections: batches that
+                    hit this limit are split and queried again.
+    max_threads :   int
+                    Number of batches to query in parallel.
     mat :           int | str, optional
                     Which materialization to query:
                      - 'auto' (default) tries to find the most recent
@@ -693,26 +695,33 @@ def fetch_adjacency(
     targets = parse_root_ids(targets).astype(np.int64)
     both = np.unique(np.append(sources, targets))
 
-    client = get_cave_client(dataset=dataset)
-
     # Check if IDs existed at this materialization
     if mat == "latest":
-        mat = client.materialize.most_recent_version()
+        mat = get_cave_client(dataset=dataset).materialize.most_recent_version()
 
     if mat == "auto":
         mat = find_mat_version(both, dataset=dataset, verbose=progress)
+        snap = get_synapse_snapshot(mat, filtered=filtered, dataset=dataset)
     else:
-        _check_ids(both, mat=mat, dataset=dataset)
+        # Use a local snapshot for this materialization if we have one
+        snap = get_synapse_snapshot(mat, filtered=filtered, dataset=dataset)
+        _check_ids(both, mat=mat, snapshot=snap, dataset=dataset)
+
+    # Local snapshots are queried without the server
+    client = get_cave_client(dataset=dataset) if snap is None else None
 
     columns = ["pre_pt_root_id", "post_pt_root_id", "cleft_score", "id"]
 
     if mat == "live":
         func = partial(
-            retry(client.materialize.live_query),
+            client.materialize.live_query,
             table=client.materialize.synapse_table,
             timestamp=dt.datetime.utcnow(),
             select_columns=columns,
         )
+    elif snap is not None:
+        # Snapshots contain the individual synapses -> we aggregate below
+        func = partial(snap.query_table, select_columns=columns)
     elif filtered:
         has_view = "valid_connection_v2" in client.materialize.get_views(mat)
         no_np = isinstance(neuropils, type(None))
@@ -720,7 +729,7 @@ def fetch_adjacency(
         if has_view & no_np & no_score_thresh:
             columns = ["pre_pt_root_id", "post_pt_root_id", "n_syn"]
             func = partial(
-                retry(client.materialize.query_view),
+                client.materialize.query_view,
                 view_name="valid_connection_v2",
                 select_columns=columns,
                 materialization_version=mat,
@@ -728,7 +737,7 @@ def fetch_adjacency(
             filtered = False  # Set to false since we don't need the join
         else:
             func = partial(
-                retry(client.materialize.join_query),
+                client.materialize.join_query,
                 tables=[
                     [client.materialize.synapse_table, "id"],
                     ["valid_synapses_nt_v2", "target_id"],
@@ -738,43 +747,38 @@ def fetch_adjacency(
             )
     else:
         func = partial(
-            retry(client.materialize.query_table),
+            client.materialize.query_table,
             table=client.materialize.synapse_table,
             materialization_version=mat,
             select_columns=columns,
         )
 
-    syn = []
-    for i in trange(
-        0,
-        len(sources),
-        batch_size,
-        desc="Fetching adjacency",
-        disable=not progress or len(sources) <= batch_size,
-    ):
-        source_batch = sources[i : i + batch_size]
-        for k in range(0, len(targets), batch_size):
-            target_batch = targets[k : k + batch_size]
-
-            if not filtered:
-                filter_in_dict = dict(
-                    post_pt_root_id=target_batch, pre_pt_root_id=source_batch
-                )
-            else:
-                filter_in_dict = dict(
-                    synapses_nt_v1=dict(
-                        post_pt_root_id=target_batch, pre_pt_root_id=source_batch
-                    )
-                )
-
-            this = func(filter_in_dict=filter_in_dict)
-
-            # We need to drop the .attrs (which contain meta data from queries)
-            # Otherwise we run into issues when concatenating
-            this.attrs = {}
-
-            if not this.empty:
-                syn.append(this)
+    def make_filter(source_batch, target_batch):
+        filter_in_dict = dict(
+            post_pt_root_id=target_batch, pre_pt_root_id=source_batch
+        )
+        if filtered:
+            filter_in_dict = dict(synapses_nt_v1=filter_in_dict)
+        return filter_in_dict
+
+    # Batches run in parallel along the longer of the two axes; each batch
+    # is queried against the other axis in chunks of `batch_size`
+    if len(sources) >= len(targets):
+        ids = sources
+        filters = [partial(lambda t, b: make_filter(b, t), targets[k : k + batch_size])
+                   for k in range(0, len(targets), batch_size)]
+    else:
+        ids = targets
+        filters = [partial(make_filter, sources[k : k + batch_size])
+                   for k in range(0, len(sources), batch_size)]
+
+    syn = _run_queries(func, ids, filters,
+                       batch_size=batch_size,
+                       max_threads=max_threads,
+                       progress=progress,
+                       row_limit=_row_limit(snap),
+                       desc="Fetching adjacency")
+    syn = [df for df in syn if not df.empty]
 
     # Combine results from batches
     if len(syn):
@@ -804,7 +808,6 @@ def fetch_adjacency(
             filter_out = [n[1:] for n in neuropils if n.startswith("~")]
 
             syn["neuropil"] = get_synapse_areas(syn["id"].values)
-            syn["neuropil"] = syn.neuropil.astype("category")
 
             if filter_in:
                 syn = syn[syn.neuropil.isin(filter_in)]
@@ -855,6 +858,7 @@ def fetch_connectivity(
     filtered=True,
     min_score=None,
     batch_size=30,
+    max_threads=4,
     mat="auto",
     *,
     progress=True,
@@ -904,7 +908,11 @@ def fetch_connectivity(
                     As such the predictions need to be taken with a grain
                     of salt - in particular for weak connections!
                     To get the "full" predictions see
-                    :func:`fafbseg.flywire.predict_transmitter`.
+                    :func:`fafbseg.flywire.predict_transmitter`. With a local
+                    synapse snapshot (see
+                    :func:`~fafbseg.flywire.create_synapse_snapshot`) the
+                    predictions are aggregated from the individual synapses
+                    instead of taken from the connection view.
     neuropils :     str | list of str, optional
                     Provide neuropil (e.g. ``'AL_R'``) or list thereof (e.g.
                     ``['AL_R', 'AL_L']``) to filter connectivity to these ROIs.
@@ -919,10 +927,11 @@ def fetch_connectivity(
                     in their paper. However, for FlyWire analyses that threshold
                     was raised to 50 (see also `filtered`).
     batch_size :    int
-                    Number of IDs to query per batch. Too large batches might
-                    lead to truncated tables: currently individual queries can
-                    not return more than 200_000 rows and you will see a warning
-                    if that limit is exceeded.
+                    Max number of IDs to query per batch. Individual queries
+                    can not return more than 200_000 rows: batches that hit
+                    this limit are split and queried again.
+    max_threads :   int
+                    Number of batches to query in parallel.
     mat :           int | str, optional
                     Which materialization to query:
                      - 'auto' (default) tries to find the most recent
@@ -963,41 +972,54 @@ def fetch_connectivity(
     # Parse root IDs
     ids = parse_root_ids(x)
 
-    client = get_cave_client(dataset=dataset)
-
     # Check if IDs existed at this materialization
     if mat == "latest":
-        mat = client.materialize.most_recent_version()
+        mat = get_cave_client(dataset=dataset).materialize.most_recent_version()
 
     if mat == "auto":
         mat = find_mat_version(ids, dataset=dataset, verbose=progress)
+        snap = get_synapse_snapshot(mat, filtered=filtered, dataset=dataset)
     else:
-        _check_ids(ids, mat=mat, dataset=dataset)
+        # Use a local snapshot for this materialization if we have one
+        snap = get_synapse_snapshot(mat, filtered=filtered, dataset=dataset)
+        _check_ids(ids, mat=mat, snapshot=snap, dataset=dataset)
+
+    # Local snapshots are queried without the server
+    client = get_cave_client(dataset=dataset) if snap is None else None
 
     columns = ["pre_pt_root_id", "post_pt_root_id", "cleft_score", "id"]
 
     if transmitters:
         columns += ["gaba", "ach", "glut", "oct", "ser", "da"]
 
+    # Local snapshots contain the individual synapses (and their transmitter
+    # predictions) which we aggregate below - no need to ask for views
+    use_view = False
+    if filtered and not isinstance(mat, str) and snap is None:
+        has_view = "valid_connection_v2" in client.materialize.get_views(mat)
+        no_np = isinstance(neuropils, type(None))
+        no_score_thresh = (not min_score) or (min_score == 50)
+        use_view = has_view & no_np & no_score_thresh
+
     if mat == "live" and filtered:
         raise ValueError("Can't fetch filtered synapses for live query.")
     elif mat == "live":
         func = partial(
-            retry(client.materialize.live_query),
+            client.materialize.live_query,
             table=client.materialize.synapse_table,
             timestamp=dt.datetime.utcnow(),
             select_columns=columns,
         )
+    elif snap is not None:
+        # Snapshots contain the individual synapses -> we aggregate below
+        func = partial(snap.query_table, select_columns=columns)
     elif filtered:
-        has_view = "valid_connection_v2" in client.materialize.get_views(mat)
-        no_np = isinstance(neuropils, type(None))
-        no_score_thresh = (not min_score) or (min_score == 50)
-        if has_view & no_np & no_score_thresh:
+        if use_view:
             columns = ["pre_pt_root_id", "post_pt_root_id", "n_syn"]
             if transmitters:
                 columns += ["gaba", "ach", "glut", "oct", "ser", "da"]
             func = partial(
-                retry(client.materialize.query_view),
+                client.materialize.query_view,
                 view_name="valid_connection_v2",
                 select_columns=columns,
                 materialization_version=mat,
@@ -1005,7 +1027,7 @@ def fetch_connectivity(
             filtered = False  # Set to false since we don't need the join
         else:
             func = partial(
-                retry(client.materialize.join_query),
+                client.materialize.join_query,
                 tables=[
                     [client.materialize.synapse_table, "id"],
                     ["valid_synapses_nt_v2", "target_id"],
@@ -1015,37 +1037,26 @@ def fetch_connectivity(
             )
     else:
         func = partial(
-            retry(client.materialize.query_table),
+            client.materialize.query_table,
             table=client.materialize.synapse_table,
             materialization_version=mat,
             select_columns=columns,
         )
 
-    syn = []
-    for i in trange(
-        0,
-        len(ids),
-        batch_size,
-        desc="Fetching connectivity",
-        disable=not progress or len(ids) <= batch_size,
-    ):
-        batch = ids[i : i + batch_size]
-        if upstream:
-            if not filtered:
-                filter_in_dict = dict(post_pt_root_id=batch)
-            else:
-                filter_in_dict = dict(synapses_nt_v1=dict(post_pt_root_id=batch))
-            syn.append(func(filter_in_dict=filter_in_dict))
-        if downstream:
-            if not filtered:
-                filter_in_dict = dict(pre_pt_root_id=batch)
-            else:
-                filter_in_dict = dict(synapses_nt_v1=dict(pre_pt_root_id=batch))
-            syn.append(func(filter_in_dict=filter_in_dict))
-
-    # Drop attrs to avoid issues when concatenating
-    for df in syn:
-        df.attrs = {}
+    filters = []
+    if upstream:
+        filters.append(lambda b: dict(post_pt_root_id=b))
+    if downstream:
+        filters.append(lambda b: dict(pre_pt_root_id=b))
+    if filtered:
+        filters = [lambda b, f=f: dict(synapses_nt_v1=f(b)) for f in filters]
+
+    syn = _run_queries(func, ids, filters,
+                       batch_size=batch_size,
+                       max_threads=max_threads,
+                       progress=progress,
+                       row_limit=_row_limit(snap),
+                       desc="Fetching connectivity")
 
     # Combine results from batches
     syn = pd.concat(syn, axis=0, ignore_index=True)
@@ -1067,7 +1078,6 @@ def fetch_connectivity(
             filter_out = [n[1:] for n in neuropils if n.startswith("~")]
 
             syn["neuropil"] = get_synapse_areas(syn["id"].values)
-            syn["neuropil"] = syn.neuropil.astype("category")
 
             if filter_in:
                 syn = syn[syn.neuropil.isin(filter_in)]
@@ -1143,7 +1153,8 @@ def fetch_connectivity(
 
 @inject_dataset()
 def fetch_supervoxel_synapses(
-    x, pre=True, post=True, batch_size=300, progress=True, *, dataset=None
+    x, pre=True, post=True, batch_size=300, max_threads=4, progress=True, *,
+    dataset=None
 ):
     """Fetch Buhmann et al. (2019) synapses for given supervoxels.
 
@@ -1156,10 +1167,11 @@ def fetch_supervoxel_synapses(
     post :          bool
                     Whether to fetch postsynapses for the given neurons.
     batch_size :    int
-                    Number of IDs to query per batch. Too large batches might
-                    lead to truncated tables: currently individual queries can
-                    not return more than 200_000 rows and you will see a warning
-                    if that limit is exceeded.
+                    Max number of IDs to query per batch. Individual queries
+                    can not return more than 200_000 rows: batches that hit
+                    this limit are split and queried again.
+    max_threads :   int
+                    Number of batches to query in parallel.
     dataset :       "public" | "production" | "sandbox" | "flat_630", optional
                     Against which FlyWire dataset to query. If ``None`` will fall
                     back to the default dataset (see
@@ -1188,29 +1200,23 @@ def fetch_supervoxel_synapses(
     ]
 
     func = partial(
-        retry(client.materialize.query_table),
+        client.materialize.query_table,
         table=client.materialize.synapse_table,
         split_positions=True,
         select_columns=columns,
     )
 
-    syn = []
-    for i in trange(
-        0,
-        len(ids),
-        batch_size,
-        desc="Fetching synapses",
-        disable=not progress or len(ids) <= batch_size,
-    ):
-        batch = ids[i : i + batch_size]
-        if post:
-            syn.append(func(filter_in_dict=dict(post_pt_supervoxel_id=batch)))
-        if pre:
-            syn.append(func(filter_in_dict=dict(pre_pt_supervoxel_id=batch)))
-
-    # Drop attrs to avoid issues when concatenating
-    for df in syn:
-        df.attrs = {}
+    filters = []
+    if post:
+        filters.append(lambda b: dict(post_pt_supervoxel_id=b))
+    if pre:
+        filters.append(lambda b: dict(pre_pt_supervoxel_id=b))
+
+    syn = _run_queries(func, ids, filters,
+                       batch_size=batch_size,
+                       max_threads=max_threads,
+                       progress=progress,
+                       desc="Fetching synapses")
 
     # Combine results from batches
     syn = pd.concat(syn, axis=0, ignore_index=True)
@@ -1316,66 +1322,275 @@ def synapse_contributions(x, *, dataset=None):
     )
 
 
-def _check_ids(ids, mat, dataset="production"):
+def _check_ids(ids, mat, snapshot=None, dataset="production"):
     """Check IDs whether they existed at given materialization.
 
     Parameters
     ----------
     ids :       iterable
     mat :       "live" | "latest" | int
+    snapshot :  SynapseSnapshot, optional
+                If provided, we use its timestamp and the check is best-effort
+                (i.e. skipped if the server can't be reached) so that local
+                snapshots also work offline.
 
     Returns
     -------
     None
 
     """
-    client = get_cave_client(dataset=dataset)
+    def _check(ids, mat):
+        client = get_cave_client(dataset=dataset)
 
-    ids = np.asarray(ids)
+        ids = np.asarray(ids)
 
-    _is_latest_roots = retry(client.chunkedgraph.is_latest_roots)
-    _get_timestamp = retry(client.materialize.get_timestamp)
-    _get_root_timestamps = retry(client.chunkedgraph.get_root_timestamps)
+        _is_latest_roots = retry(client.chunkedgraph.is_latest_roots)
+        _get_timestamp = retry(client.materialize.get_timestamp)
+        _get_root_timestamps = retry(client.chunkedgraph.get_root_timestamps)
 
-    # Check if any of these root IDs are outdated
-    if mat == "live":
-        not_latest = ids[~_is_latest_roots(ids)]
-        if any(not_latest):
-            print(
-                f'Root ID(s) {", ".join(not_latest.astype(str))} are outdated '
-                "and live connectivity might be inaccurrate."
-            )
-    else:
-        if mat == "latest":
-            mat = client.materialize.most_recent_version()
-
-        # Is the root ID more recent than the materialization?
-        ts_m = _get_timestamp(mat)
-        ts_r = _get_root_timestamps(ids)
-        too_recent = ids[ts_r > ts_m]
-        if any(too_recent):
-            print(
-                "Some root IDs are more recent than materialization "
-                f"{mat} and synapse/connectivity data will be "
-                f'inaccurate:\n\n {", ".join(too_recent.astype(str))}\n\n'
-                "You can either try mapping these IDs back in time or use"
-                '`mat="auto"`.'
-            )
-
-        # Those that aren't too young might be too old
-        ids = ids[ts_r <= ts_m]
-        if len(ids):
-            # This only checks if these were the up to date roots at the given time
-            # hence it doesn't tell us whether the root is too young or too old
-            # but since we checked the too young roots before we can assume
-            # the roots flagged here are too old
-            not_latest = ids[~_is_latest_roots(ids, timestamp=ts_m)]
+        # Check if any of these root IDs are outdated
+        if mat == "live":
+            not_latest = ids[~_is_latest_roots(ids)]
             if any(not_latest):
                 print(
-                    "Some root IDs were already outdated at materialization "
+                    f'Root ID(s) {", ".join(not_latest.astype(str))} are outdated '
+                    "and live connectivity might be inaccurrate."
+                )
+        else:
+            if mat == "latest":
+                mat = client.materialize.most_recent_version()
+
+            # Is the root ID more recent than the materialization?
+            if snapshot is not None and snapshot.timestamp is not None:
+                ts_m = snapshot.timestamp
+            else:
+                ts_m = _get_timestamp(mat)
+            ts_r = _get_root_timestamps(ids)
+            too_recent = ids[ts_r > ts_m]
+            if any(too_recent):
+                print(
+                    "Some root IDs are more recent than materialization "
                     f"{mat} and synapse/connectivity data will be "
-                    f'inaccurrate:\n\n {", ".join(not_latest.astype(str))}\n\n'
-                    "Try updating the root IDs using `flywire.update_ids` "
-                    "or `flywire.supervoxels_to_roots` if you have supervoxel IDs,"
-                    " or pick a different materialization version."
+                    f'inaccurate:\n\n {", ".join(too_recent.astype(str))}\n\n'
+                    "You can either try mapping these IDs back in time or use"
+                    '`mat="auto"`.'
                 )
+
+            # Those that aren't too young might be too old
+            ids = ids[ts_r <= ts_m]
+            if len(ids):
+                # This only checks if these were the up to date roots at the given time
+                # hence it doesn't tell us whether the root is too young or too old
+                # but since we checked the too young roots before we can assume
+                # the roots flagged here are too old
+                not_latest = ids[~_is_latest_roots(ids, timestamp=ts_m)]
+                if any(not_latest):
+                    print(
+                        "Some root IDs were already outdated at materialization "
+                        f"{mat} and synapse/connectivity data will be "
+                        f'inaccurrate:\n\n {", ".join(not_latest.astype(str))}\n\n'
+                        "Try updating the root IDs using `flywire.update_ids` "
+                        "or `flywire.supervoxels_to_roots` if you have supervoxel IDs,"
+                        " or pick a different materialization version."
+                    )
+
+    if snapshot is None:
+        return _check(ids, mat)
+
+    try:
+        _check(ids, mat)
+    except Exception as e:
+        navis.config.logger.debug(f'Unable to check root IDs: {e}')
+
+
+def _process_synapse_batch(res, batch, ids, pre, post, min_score, clean,
+                           neuropils, compact):
+    """Clean up the synapse table for a single batch of root IDs.
+
+    Parameters
+    ----------
+    res :       list of pandas.DataFrames
+                Results of the (post and/or pre) queries for this batch.
+    batch :     np.ndarray
+                The batch of root IDs. Must be a contiguous slice of `ids`.
+    ids :       np.ndarray
+                All (unique) query root IDs.
+
+    Returns
+    -------
+    n_rows :    int
+                Number of rows before clean up.
+    syn :       pandas.DataFrame
+
+    """
+    syn = pd.concat(res, axis=0, ignore_index=True)
+    n_rows = len(syn)
+
+    # Rename some of those columns
+    syn.rename(
+        {
+            "post_pt_root_id": "post",
+            "pre_pt_root_id": "pre",
+            "post_pt_position_x": "post_x",
+            "post_pt_position_y": "post_y",
+            "post_pt_position_z": "post_z",
+            "pre_pt_position_x": "pre_x",
+            "pre_pt_position_y": "pre_y",
+            "pre_pt_position_z": "pre_z",
+            "idx": "id",  # this may exists if we made a join query
+            "id_x": "id",  # this may exists if we made a join query
+            "ach": "acetylcholine",
+            "glut": "glutamate",
+            "oct": "octopamine",
+            "ser": "serotonin",
+            "da": "dopamine",
+        },
+        axis=1,
+        inplace=True,
+    )
+
+    # A synapse between two query neurons shows up in the batches of both. We
+    # only keep it in the batch that contains the first of the two neurons
+    # (in order of `ids`) - this is equivalent to dropping duplicates across
+    # all batches but doesn't need to see the other batches
+    order = np.argsort(ids)
+    sorted_ids = ids[order]
+
+    def position(x):
+        ix = np.searchsorted(sorted_ids, x).clip(max=len(ids) - 1)
+        return np.where(sorted_ids[ix] == x, order[ix], len(ids))
+
+    first = np.full(len(syn), len(ids))
+    if post:
+        first = np.minimum(first, position(syn.post.values))
+    if pre:
+        first = np.minimum(first, position(syn.pre.values))
+    start = position(batch[:1])[0]
+    keep = (first >= start) & (first < start + len(batch))
+
+    # Pre- and postsynapses of the same batch can overlap too
+    keep &= ~syn.id.duplicated().values
+
+    # Next we need to run some clean-up:
+    # Drop below threshold connections
+    if min_score:
+        keep &= syn.cleft_score.values >= min_score
+
+    if clean:
+        # Drop autapses
+        keep &= syn.pre.values != syn.post.values
+        # Drop connections involving 0 (background, glia)
+        keep &= (syn.pre.values != 0) & (syn.post.values != 0)
+
+    if not keep.all():
+        syn = syn[keep]
+
+    if compact:
+        dtypes = {c: np.int32 for c in ("pre_x", "pre_y", "pre_z",
+                                        "post_x", "post_y", "post_z")}
+        dtypes.update({c: np.float32 for c in ("gaba", "acetylcholine",
+                                               "glutamate", "octopamine",
+                                               "serotonin", "dopamine")})
+        dtypes.update({"pre": np.uint64, "post": np.uint64})
+        syn = syn.astype({k: v for k, v in dtypes.items() if k in syn.columns})
+    elif syn._is_view:
+        # Avoid copy warning
+        syn = syn.copy()
+
+    if neuropils:
+        syn["neuropil"] = get_synapse_areas(syn["id"].values)
+
+    return n_rows, syn
+
+
+def _row_limit(snap):
+    """Row limit for queries (local snapshots have none)."""
+    return None if snap is not None else MAX_QUERY_ROWS
+
+
+def _iter_synapse_batches(func, ids, filters, process, batch_size,
+                          max_threads, progress, mat, row_limit=MAX_QUERY_ROWS):
+    """Generate synapse tables batch by batch.
+
+    Queries run in chunks of `max_threads` batches such that at most that
+    many batches are held in memory at any given time.
+    """
+    chunk_size = batch_size * max(max_threads, 1)
+    with navis.config.tqdm(desc="Fetching synapses",
+                           total=len(ids),
+                           disable=not progress or len(ids) <= batch_size,
+                           leave=False) as pbar:
+        for i in range(0, len(ids), chunk_size):
+            for _, syn in _run_queries(func, ids[i : i + chunk_size], filters,
+                                       batch_size=batch_size,
+                                       max_threads=max_threads,
+                                       progress=False,
+                                       process=process,
+                                       row_limit=row_limit,
+                                       desc="Fetching synapses"):
+                syn.reset_index(drop=True, inplace=True)
+                syn.attrs["materialization"] = mat
+                yield syn
+            pbar.update(len(ids[i : i + chunk_size]))
+
+
+def _run_queries(func, ids, filters, batch_size, max_threads, progress, desc,
+                 process=None, row_limit=MAX_QUERY_ROWS):
+    """Run queries for batches of IDs in parallel.
+
+    Parameters
+    ----------
+    func :      callable
+                Query function that accepts a `filter_in_dict`.
+    ids :       np.ndarray
+                IDs to split into batches.
+    filters :   list of callables
+                Each function turns a batch of IDs into a `filter_in_dict`.
+                We run one query per filter and batch.
+    process :   callable, optional
+                If provided, is called with the list of query results and
+                the batch of IDs. Use this to process results in the
+                worker threads.
+    row_limit : int, optional
+                Max number of rows a single query can return. Batches with
+                queries that hit this limit are split and queried again.
+                Set to ``None`` for queries without a row limit.
+
+    Returns
+    -------
+    list
+                List of pandas.DataFrames or, if `process` is provided, one
+                result of `process` for each batch.
+
+    """
+    def query(batch):
+        res = []
+        for f in filters:
+            df = func(filter_in_dict=f(batch))
+            # Drop attrs (query meta data) to avoid issues when concatenating
+            df.attrs = {}
+            res.append(df)
+        n_rows = max([len(df) for df in res], default=0)
+        if process is not None:
+            res = process(res, batch)
+        return n_rows, res
+
+    def retry_if(e):
+        return isinstance(e, requests.RequestException) or is_timeout(e)
+
+    batches = run_batched(query,
+                          np.asarray(ids),
+                          batch_size=batch_size,
+                          max_threads=max_threads,
+                          # Stay comfortably below the row limit
+                          max_rows=MAX_QUERY_ROWS // 2,
+                          # Split batches that hit the row limit
+                          row_limit=row_limit,
+                          n_rows=lambda res: res[0],
+                          retry_if=retry_if,
+                          progress=progress and len(ids) > batch_size,
+                          desc=desc)
+
+    if process is not None:
+        return [res for _, _, (_, res) in batches]
+    return [df for _, _, (_, res) in batches for df in res]
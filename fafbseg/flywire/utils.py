@@ -20,13 +20,18 @@ import os
 import pytz
 import time
 import requests
+import shutil
+import threading
 import warnings
 
 from caveclient import CAVEclient
+from concurrent import futures
 from pathlib import Path
 from importlib import reload
 from zipfile import ZipFile
 from io import BytesIO
+from tqdm.auto import tqdm
+from urllib3.exceptions import ReadTimeoutError
 
 import cloudvolume as cv
 import datetime as dt
@@ -62,12 +67,15 @@ SILENCE_FIND_MAT_VERSION = False
 # Initialize without a volume
 cloud_volumes = {}
 cave_clients = {}
+id_decoders = {}
 
 # Data stuff
 fp = Path(__file__).parent
 data_path = fp.parent / 'data'
 area_ids = None
-vol_names = None
+area_codes = None
+area_names = None
+area_lock = threading.Lock()
 
 # The default dataset
 DEFAULT_DATASET = os.environ.get('FLYWIRE_DEFAULT_DATASET', 'production')
@@ -192,6 +200,9 @@ def get_neuropil_volumes(neuropils):
 def get_synapse_areas(ind):
     """Lazy-load synapse areas.
 
+    On first use, the area IDs are extracted to an uncompressed file in the
+    cache directory which is then memory-mapped.
+
     Parameters
     ----------
     ind :       (N, ) iterable
@@ -199,21 +210,47 @@ def get_synapse_areas(ind):
 
     Returns
     -------
-    areas :     (N, ) array
-                Array with neuropil name for each synapse. Unassigned synapses
-                come back as "NA".
+    areas :     (N, ) pandas.Categorical
+                Neuropil name for each synapse. Unassigned synapses come back
+                as "NA". Categories are always the full list of neuropils.
 
     """
-    global area_ids, vol_names
+    global area_ids, area_codes, area_names
+
+    with area_lock:
+        if isinstance(area_ids, type(None)):
+            with open(data_path / 'volume_name_dict.json') as f:
+                vol_names = {int(k): v for k, v in json.load(f).items()}
+
+            # Map area IDs (-1 = unassigned) to category codes via lookup table
+            ids = np.array(sorted(vol_names))
+            area_names = [vol_names[i] for i in ids] + ['NA']
+            area_codes = np.full(ids.max() + 2, len(ids), dtype=np.int8)
+            area_codes[ids + 1] = np.arange(len(ids))
+
+            area_ids = np.load(_extract_area_ids(), mmap_mode='r')
+
+    codes = area_codes[area_ids[np.asarray(ind, dtype=np.int64)].astype(np.int64) + 1]
+
+    return pd.Categorical.from_codes(codes, categories=area_names)
 
-    if isinstance(area_ids, type(None)):
-        area_ids = np.load(data_path / 'global_area_ids.npy.zip')['global_area_ids']
-        with open(data_path / 'volume_name_dict.json') as f:
-            vol_names = json.load(f)
-            vol_names = {int(k): v for k, v in vol_names.items()}
-            vol_names[-1] = 'NA'
 
-    return np.array([vol_names[i] for i in area_ids[ind]])
+def _extract_area_ids():
+    """Extract area IDs to the cache directory (if not already done)."""
+    from .cache import CACHE_ROOT
+
+    with ZipFile(data_path / 'global_area_ids.npy.zip') as zf:
+        info = zf.getinfo('global_area_ids.npy')
+        # Use the checksum in the file name to notice updates to the archive
+        fp = Path(CACHE_ROOT).expanduser() / f'global_area_ids_{info.CRC:08x}.npy'
+        if not fp.is_file():
+            fp.parent.mkdir(parents=True, exist_ok=True)
+            tmp = fp.with_suffix('.tmp')
+            with zf.open(info) as src, open(tmp, 'wb') as dst:
+                shutil.copyfileobj(src, dst, length=16 * 1024 ** 2)
+            os.replace(tmp, fp)
+
+    return fp
 
 
 @functools.lru_cache
@@ -420,6 +457,111 @@ def get_cloudvolume(dataset, **kwargs):
         return cloud_volumes[dataset]
 
 
+class ChunkedgraphIdDecoder:
+    """Vectorised decoding of graphene chunkedgraph IDs.
+
+    Chunkedgraph IDs are 64 bit integers encoding (from most to least
+    significant bits) the layer, the x/y/z position of the chunk and a
+    segment ID. The number of bits for each of those is taken from the
+    volume's graphene metadata. Use :func:`get_id_decoder` to get a
+    (cached) decoder for a given dataset.
+
+    Parameters
+    ----------
+    vol :       cloudvolume.CloudVolume
+                A graphene CloudVolume.
+
+    """
+
+    def __init__(self, vol):
+        meta = vol.mesh.meta.meta
+        self.n_bits_for_layer_id = int(meta.n_bits_for_layer_id)
+        self.graph_chunk_size = np.array(meta.graph_chunk_size, dtype=np.int64)
+        self.voxel_offset = np.array(meta.voxel_offset(0), dtype=np.int64)
+
+        # Spatial bits per layer - this is a lookup table indexed by layer
+        masks = meta.info['graph']['spatial_bit_masks']
+        self.spatial_bits = np.zeros(max(int(k) for k in masks) + 1, dtype=np.uint64)
+        for k, v in masks.items():
+            self.spatial_bits[int(k)] = int(v)
+
+    def _as_ids(self, ids):
+        return np.asarray(ids).astype(np.uint64, copy=False).reshape(-1)
+
+    def _layout(self, ids):
+        """Return (layer, spatial bits, segment ID bits) for each ID."""
+        layer = ids >> np.uint64(64 - self.n_bits_for_layer_id)
+        bits = self.spatial_bits[layer]
+        segid_bits = np.uint64(64 - self.n_bits_for_layer_id) - np.uint64(3) * bits
+        return layer, bits, segid_bits
+
+    def layer(self, ids):
+        """Decode layer of given IDs."""
+        ids = self._as_ids(ids)
+        return (ids >> np.uint64(64 - self.n_bits_for_layer_id)).astype(np.int64)
+
+    def chunk_position(self, ids):
+        """Decode chunk x/y/z position of given IDs.
+
+        Returns
+        -------
+        (N, 3) int64 array
+
+        """
+        ids = self._as_ids(ids)
+        _, bits, segid_bits = self._layout(ids)
+        mask = (np.uint64(1) << bits) - np.uint64(1)
+        return np.stack([(ids >> (segid_bits + bits * np.uint64(2))) & mask,
+                         (ids >> (segid_bits + bits)) & mask,
+                         (ids >> segid_bits) & mask],
+                        axis=1).astype(np.int64)
+
+    def segid(self, ids):
+        """Decode segment ID (i.e. the ID within its chunk) of given IDs."""
+        ids = self._as_ids(ids)
+        _, _, segid_bits = self._layout(ids)
+        return (ids & ((np.uint64(1) << segid_bits) - np.uint64(1))).astype(np.int64)
+
+    def decode(self, ids):
+        """Decode layer, chunk position and segment ID of given IDs.
+
+        Returns
+        -------
+        pandas.DataFrame
+                    With columns "layer", "x", "y", "z" and "segid".
+
+        """
+        ids = self._as_ids(ids)
+        pos = self.chunk_position(ids)
+        return pd.DataFrame({'layer': self.layer(ids),
+                             'x': pos[:, 0],
+                             'y': pos[:, 1],
+                             'z': pos[:, 2],
+                             'segid': self.segid(ids)})
+
+
+def get_id_decoder(dataset):
+    """Get (cached) chunkedgraph ID decoder for given dataset.
+
+    Parameters
+    ----------
+    dataset :   str | cloudvolume.CloudVolume
+                Dataset (e.g. "production") or a graphene CloudVolume.
+
+    Returns
+    -------
+    ChunkedgraphIdDecoder
+
+    """
+    vol = get_cloudvolume(dataset)
+    key = getattr(vol, 'path', None) or getattr(vol, 'cloudpath', None)
+    if key is None:
+        return ChunkedgraphIdDecoder(vol)
+    if key not in id_decoders:
+        id_decoders[key] = ChunkedgraphIdDecoder(vol)
+    return id_decoders[key]
+
+
 def retry(func, retries=5, cooldown=2):
     """Retry function on HTTPError.
 
@@ -453,6 +595,195 @@ def retry(func, retries=5, cooldown=2):
     return wrapper
 
 
+def is_timeout(e):
+    """Check if exception is a request time out or a gateway error."""
+    if isinstance(e, (requests.exceptions.Timeout, ReadTimeoutError)):
+        return True
+    if isinstance(e, requests.exceptions.HTTPError):
+        return getattr(e.response, 'status_code', None) in (502, 503, 504)
+    return False
+
+
+def run_batched(func, x, batch_size, max_threads=4, retries=5, cooldown=1,
+                min_batch_size=1, max_rows=None, row_limit=None, n_rows=len,
+                retry_if=None, progress=True, desc='Fetching'):
+    """Run function over batches of `x` using a bounded pool of threads.
+
+    Keeps up to `max_threads` batches in flight. Failed batches are retried
+    individually with an exponential backoff - while a batch waits for its
+    retry, its thread is free to run other batches. If a batch fails with a time
+    out, it is split in half and the batch size for all remaining batches
+    is reduced accordingly. If `max_rows` is given, the batch size is also
+    adjusted from the number of rows returned so far such that batches
+    return roughly `max_rows` rows (but never more than `batch_size` items).
+    Until the first batch has returned, batches are kept small.
+
+    If `row_limit` is given, results with that many rows are considered
+    truncated (e.g. by a server-side limit): the result is discarded and the
+    batch is split in half and re-queued. Truncated batches of a single item
+    can't be split - these are kept and a warning is issued.
+
+    Parameters
+    ----------
+    func :          callable
+                    Function that accepts a batch (i.e. a slice of `x`) and
+                    returns the result for that batch.
+    x :             np.ndarray
+                    The data to split into batches.
+    batch_size :    int
+                    The initial number of items per batch.
+    max_threads :   int
+                    Max number of batches to process in parallel.
+    retries :       int
+                    Max number of times a failed batch is retried before we
+                    give up and raise the exception.
+    cooldown :      int | float
+                    Cooldown in seconds before the first retry. Every
+                    subsequent retry will double this.
+    min_batch_size : int
+                    Time outs will not reduce the batch size below this.
+    max_rows :      int, optional
+                    Target number of rows per batch. If provided, the batch
+                    size is adapted based on the observed number of rows
+                    per item.
+    row_limit :     int, optional
+                    Results with this many (or more) rows are considered
+                    truncated and the batch is split and queried again.
+    n_rows :        callable
+                    Function to count the rows in the result of a batch.
+                    Only relevant if `max_rows` or `row_limit` are given.
+    retry_if :      callable, optional
+                    Function that accepts an exception and returns True if
+                    the batch should be retried. By default, all exceptions
+                    are retried.
+    progress :      bool
+                    Whether to show a progress bar.
+    desc :          str
+                    Description for the progress bar.
+
+    Returns
+    -------
+    list
+                    List of `(start, stop, result)` tuples, ordered by `start`
+                    such that `result` belongs to `x[start:stop]`.
+
+    """
+    batch_size = max_batch_size = max(int(batch_size), 1)
+    min_batch_size = max(min(int(min_batch_size), batch_size), 1)
+    max_threads = max(int(max_threads), 1)
+
+    # Running totals of items and rows to adapt the batch size
+    seen_items = seen_rows = 0
+
+    # Without any row counts yet, the first wave of batches only covers
+    # `batch_size` items in total
+    first_size = batch_size
+    if max_rows or row_limit:
+        first_size = max(-(-batch_size // max_threads), min_batch_size)
+
+    # Batches that need to be (re-)run go here as (start, stop, attempt,
+    # time before which they must not be run)
+    queue = []
+    # Start of the next batch that has not been scheduled yet
+    cursor = 0
+    results = {}
+    with tqdm(desc=desc,
+              total=len(x),
+              leave=False,
+              disable=not progress) as pbar:
+        with futures.ThreadPoolExecutor(max_workers=max_threads) as pool:
+            running = {}
+            try:
+                while queue or cursor < len(x) or running:
+                    # Top up the batches in flight
+                    now = time.monotonic()
+                    while len(running) < max_threads:
+                        due = [i for i, q in enumerate(queue) if q[3] <= now]
+                        if due:
+                            start, stop, attempt, _ = queue.pop(due[0])
+                        elif cursor < len(x):
+                            size = batch_size if seen_items else min(batch_size, first_size)
+                            start, stop, attempt = cursor, min(cursor + size, len(x)), 0
+                            cursor = stop
+                        else:
+                            break
+                        f = pool.submit(func, x[start:stop])
+                        running[f] = (start, stop, attempt)
+
+                    # Wait for a batch to finish or for the next retry to
+                    # become due (whichever comes first)
+                    wait = None
+                    if queue:
+                        wait = max(min(q[3] for q in queue) - time.monotonic(), 0)
+                    if not running:
+                        time.sleep(wait)
+                        continue
+                    done, _ = futures.wait(running, timeout=wait,
+                                           return_when=futures.FIRST_COMPLETED)
+                    for f in done:
+                        start, stop, attempt = running.pop(f)
+                        size = stop - start
+                        try:
+                            res = f.result()
+                        except KeyboardInterrupt:
+                            raise
+                        except Exception as e:
+                            if attempt >= retries or (retry_if and not retry_if(e)):
+                                raise
+                            timeout = is_timeout(e)
+                        else:
+                            rows = n_rows(res) if (max_rows or row_limit) else 0
+                            truncated = bool(row_limit) and rows >= row_limit
+
+                            # Truncated results are discarded and the batch
+                            # is split (this doesn't count as a failed attempt)
+                            if truncated and size > 1:
+                                half = size // 2
+                                batch_size = max(min(batch_size, half), 1)
+                                max_batch_size = min(max_batch_size, batch_size)
+                                queue.insert(0, (start + half, stop, attempt, 0))
+                                queue.insert(0, (start, start + half, attempt, 0))
+                                continue
+                            elif truncated:
+                                warnings.warn(f'Result for {x[start]} has {rows:,} '
+                                              'rows and has likely been truncated.')
+
+                            results[start] = (start, stop, res)
+                            pbar.update(size)
+
+                            if max_rows:
+                                seen_items += size
+                                seen_rows += rows
+                                if seen_rows:
+                                    rate = seen_rows / seen_items
+                                    batch_size = int(max_rows / rate)
+                                    batch_size = max(min(batch_size, max_batch_size),
+                                                     min_batch_size)
+                            else:
+                                seen_items += size
+                            continue
+
+                        # Retry after a cooldown
+                        ready = time.monotonic() + cooldown * 2 ** attempt
+
+                        # If the batch timed out, split it and shrink batch size
+                        if timeout and size > min_batch_size:
+                            half = max(size // 2, min_batch_size)
+                            batch_size = max(min(batch_size, half), min_batch_size)
+                            # Don't let the row count grow batches back
+                            max_batch_size = min(max_batch_size, batch_size)
+                            queue.append((start, start + half, attempt + 1, ready))
+                            queue.append((start + half, stop, attempt + 1, ready))
+                        else:
+                            queue.append((start, stop, attempt + 1, ready))
+            except BaseException:
+                for f in running:
+                    f.cancel()
+                raise
+
+    return [results[k] for k in sorted(results)]
+
+
 def parse_bounds(x):
     """Parse bounds.
 
@@ -15,4 +15,6 @@
 
 """Module containing low-level functions to work with the Buhmann FAFB synapses."""
 
-from .transmitters import plot_nt_predictions, collapse_nt_predictions
+from .transmitters import (plot_nt_predictions, collapse_nt_predictions,
+                           aggregate_nt_predictions, merge_nt_aggregates,
+                           collapse_nt_aggregates)
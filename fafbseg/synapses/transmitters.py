@@ -62,6 +62,12 @@ def collapse_nt_predictions(pred, single_pred=False, weighted=True, id_col=None)
                     If True, will weight predictions based on confidence: higher
                     cleft score = more weight.
 
+    See Also
+    --------
+    aggregate_nt_predictions
+                    Use this to collapse predictions for synapses that are
+                    fetched in batches.
+
     Returns
     -------
     tuple
@@ -96,21 +102,9 @@ def collapse_nt_predictions(pred, single_pred=False, weighted=True, id_col=None)
         return pd.DataFrame(None, index=trans)
 
     if id_col is not None:
-        # Collapse predictions for every unique value of id_col
-        ids = pred[id_col].unique()
-        res = {i: collapse_nt_predictions(pred[pred[id_col] == i],
-                                          single_pred=single_pred,
-                                          weighted=weighted) for i in ids}
-
-        # Combine results
-        if not single_pred:
-            # Label series and combine
-            for r in res:
-                res[r].name = r
-
-            res = pd.concat(list(res.values()), join='outer', axis=1).fillna(0)
-
-        return res
+        # Collapse predictions for every unique value of id_col in one go
+        agg = aggregate_nt_predictions(pred, id_col=id_col, weighted=weighted)
+        return collapse_nt_aggregates(agg, single_pred=single_pred)
 
     # Drop NAs (some synapses have no prediction)
     pred = pred[pred[trans].any(axis=1)]
@@ -137,6 +131,164 @@ def collapse_nt_predictions(pred, single_pred=False, weighted=True, id_col=None)
     return pred_weight
 
 
+def aggregate_nt_predictions(pred, id_col, weighted=True):
+    """Aggregate synapse neurotransmitter predictions by ID.
+
+    The aggregates from multiple (e.g. batches of) synapse tables can be
+    combined using :func:`merge_nt_aggregates` and then be turned into
+    per-ID predictions using :func:`collapse_nt_aggregates`.
+
+    Parameters
+    ----------
+    pred :          pd.DataFrame
+                    Table with synapse neurotransmitter predictions.
+    id_col :        str
+                    A column in `pred` to aggregate by - typically neuron IDs.
+    weighted :      bool
+                    If True, will weight predictions based on confidence: higher
+                    cleft score = more weight.
+
+    Returns
+    -------
+    pd.DataFrame
+                    One row per unique value in `id_col` (in order of first
+                    appearance) with the (weighted) sum of predictions and
+                    the sum of weights for each transmitter, plus the number
+                    of synapses with predictions.
+
+    Examples
+    --------
+    >>> from fafbseg import flywire
+    >>> from fafbseg.synapses import (aggregate_nt_predictions,
+    ...                               merge_nt_aggregates,
+    ...                               collapse_nt_aggregates)
+    >>> batches = flywire.fetch_synapses([720575940603231916, 720575940627022710],
+    ...                                  post=False, transmitters=True,
+    ...                                  as_generator=True)      # doctest: +SKIP
+    >>> agg = merge_nt_aggregates([aggregate_nt_predictions(b, id_col='pre')
+    ...                            for b in batches])            # doctest: +SKIP
+    >>> pred = collapse_nt_aggregates(agg, single_pred=True)    # doctest: +SKIP
+
+    """
+    codes, ids = pd.factorize(pred[id_col], sort=False)
+    values = pred[trans].values.astype(np.float64, copy=False)
+
+    # Drop NAs (some synapses have no prediction)
+    valid = pred[trans].any(axis=1).values
+    codes, values = codes[valid], values[valid]
+
+    if weighted:
+        weight_col = 'cleft_scores' if 'cleft_scores' in pred.columns else 'cleft_score'
+        weights = pred[weight_col].values[valid].astype(np.float64)
+        sums = [np.bincount(codes, weights=values[:, i] * weights, minlength=len(ids))
+                for i in range(len(trans))]
+        norms = [np.bincount(codes, weights=weights, minlength=len(ids))] * len(trans)
+    else:
+        # Like `mean()` we ignore missing values
+        isnan = np.isnan(values)
+        values = np.where(isnan, 0, values)
+        sums = [np.bincount(codes, weights=values[:, i], minlength=len(ids))
+                for i in range(len(trans))]
+        norms = [np.bincount(codes, weights=~isnan[:, i], minlength=len(ids))
+                 for i in range(len(trans))]
+
+    agg = pd.DataFrame(np.stack(sums + norms, axis=1),
+                       index=pd.Index(ids, name=id_col),
+                       columns=trans + [f'{t}_weight' for t in trans])
+    agg['n_synapses'] = np.bincount(codes, minlength=len(ids))
+    agg.attrs['weighted'] = weighted
+
+    return agg
+
+
+def merge_nt_aggregates(aggs):
+    """Merge aggregated neurotransmitter predictions.
+
+    Parameters
+    ----------
+    aggs :          iterable of pd.DataFrames
+                    Aggregates as returned by :func:`aggregate_nt_predictions`.
+
+    Returns
+    -------
+    pd.DataFrame
+                    Merged aggregate.
+
+    """
+    aggs = list(aggs)
+    if not aggs:
+        raise ValueError('No aggregates to merge.')
+
+    weighted = {a.attrs.get('weighted', True) for a in aggs}
+    if len(weighted) > 1:
+        raise ValueError('Unable to merge weighted and unweighted aggregates.')
+
+    comb = pd.concat(aggs, axis=0)
+    codes, ids = pd.factorize(comb.index, sort=False)
+
+    # Note: unlike groupby().sum(), bincount does not skip NaNs
+    merged = pd.DataFrame({c: np.bincount(codes, weights=comb[c].values,
+                                          minlength=len(ids))
+                           for c in comb.columns},
+                          index=pd.Index(ids, name=comb.index.name))
+    merged['n_synapses'] = merged.n_synapses.astype(np.int64)
+    merged.attrs['weighted'] = weighted.pop()
+
+    return merged
+
+
+def collapse_nt_aggregates(agg, single_pred=False):
+    """Turn aggregated neurotransmitter predictions into per-ID predictions.
+
+    Parameters
+    ----------
+    agg :           pd.DataFrame
+                    Aggregate as returned by :func:`aggregate_nt_predictions`
+                    or :func:`merge_nt_aggregates`.
+    single_pred :   bool
+                    If True, will return only the highest prediction per ID.
+
+    Returns
+    -------
+    dict
+                    If ``single_pred=True`` return a dictionary mapping ids to
+                    predictions - e.g.
+                    ``{"12345": ("acetylcholine", 0.89), "56789": ("gaba", 0.76)}``
+
+    pd.DataFrame
+                    If ``single_pred=False`` return a DataFrame::
+
+                                             12345    56789
+                       acetylcholine          0.89      0.2
+                       gaba                   0.02     0.76
+                       ...
+
+    """
+    if (agg.n_synapses == 0).any():
+        raise ValueError('No synapses with transmitter predictions.')
+
+    sums = agg[trans].values
+    norms = agg[[f'{t}_weight' for t in trans]].values
+    with np.errstate(divide='ignore', invalid='ignore'):
+        conf = sums / norms
+
+    if agg.attrs.get('weighted', True):
+        # No weights above 0 means predictions are 0
+        conf[~(norms > 0)] = 0
+
+    if single_pred:
+        # Get the highest predicted transmitter (ignoring NaNs)
+        isnan = np.isnan(conf)
+        top_ix = np.where(isnan, -np.inf, conf).argmax(axis=1)
+        top_ix[isnan.all(axis=1)] = len(trans) - 1
+        top = conf[np.arange(len(conf)), top_ix]
+        return {i: prediction(trans[t], p)
+                for i, t, p in zip(agg.index.values, top_ix, top)}
+
+    return pd.DataFrame(conf.T, index=trans,
+                        columns=agg.index.rename(None)).fillna(0)
+
+
 def plot_nt_predictions(pred, bins=20, id_col=None, ax=None, legend=True, **kwargs):
     """Plot neurotransmitter predictions.
 
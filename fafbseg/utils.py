@@ -14,7 +14,6 @@
 #    GNU General Public License for more details.
 """Collection of utility functions."""
 
-import collections
 import requests
 import six
 
@@ -144,7 +143,6 @@ class GSPointLoader(object):
 
         """
         self._volume = cloud_volume
-        self._chunk_map = collections.defaultdict(set)
         self._points = None
 
     def add_points(self, points):
@@ -158,56 +156,67 @@ class GSPointLoader(object):
                     to volume.scale['resolution'].
 
         """
-        points = np.asarray(points)
+        points = np.asarray(points).reshape(-1, 3)
 
         if isinstance(self._points, type(None)):
             self._points = points
         else:
-            self._points = np.concat(self._points, points)
+            self._points = np.concatenate((self._points, points))
 
-        resolution = np.array(self._volume.scale['resolution'])
-        chunk_size = np.array(self._volume.scale['chunk_sizes'])
-        chunk_starts = (points // resolution).astype(int) // chunk_size * chunk_size
-        for point, chunk_start in zip(points, chunk_starts):
-            self._chunk_map[tuple(chunk_start)].add(tuple(point))
-
-    def _load_chunk(self, chunk_start, chunk_end):
-        # (No validation that this is a valid chunk_start.)
-        return self._volume[chunk_start[0]:chunk_end[0],
-                            chunk_start[1]:chunk_end[1],
-                            chunk_start[2]:chunk_end[2]]
+    def _group_by_chunk(self):
+        """Assign points to storage chunks.
 
-    def _load_points(self, chunk_map_key):
-        chunk_start = np.array(chunk_map_key)
-        points = np.array(list(self._chunk_map[chunk_map_key]))
+        Returns
+        -------
+        voxels :    (N, 3) array
+                    Voxel coordinates of all points.
+        order :     (N, ) array
+                    Indices that sort points by chunk.
+        offsets :   (M + 1, ) array
+                    Points ``order[offsets[i]:offsets[i + 1]]`` are in chunk ``i``.
+        chunks :    (M, 3) array
+                    Start of each chunk (in voxels).
 
+        """
         resolution = np.array(self._volume.scale['resolution'])
-        indices = (points // resolution).astype(int) - chunk_start
+        chunk_size = np.array(self._volume.scale['chunk_sizes']).reshape(-1, 3)[0]
 
-        # We don't really need to load the whole chunk here:
-        # Instead, we subset the chunk to the part that contains our points
-        # This should at the very least save memory
-        mn, mx = indices.min(axis=0), indices.max(axis=0)
+        voxels = (self._points // resolution).astype(np.int64)
+        chunk_ix = voxels // chunk_size
 
-        chunk_end = chunk_start + mx + 1
-        chunk_start += mn
-        indices -= mn
+        # Turn chunk indices into a single integer so we can use a (fast) 1d
+        # unique instead of a row-wise unique
+        mn = chunk_ix.min(axis=0)
+        dims = chunk_ix.max(axis=0) - mn + 1
+        keys = np.ravel_multi_index((chunk_ix - mn).T, dims)
 
-        chunk = self._load_chunk(chunk_start, chunk_end)
-        return points, chunk[indices[:, 0], indices[:, 1], indices[:, 2]]
+        uni, inv = np.unique(keys, return_inverse=True)
+        inv = inv.ravel()
+        order = np.argsort(inv, kind='stable')
+        offsets = np.zeros(len(uni) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(inv, minlength=len(uni)))
 
-    def load_all(self, max_workers=4, return_sorted=True, progress=True):
+        chunks = (np.stack(np.unravel_index(uni, dims), axis=1) + mn) * chunk_size
+
+        return voxels, order, offsets, chunks
+
+    def load_all(self, max_workers=4, return_sorted=True, progress=True,
+                 subbox=True):
         """Load all points in current list, batching by storage chunk.
 
         Parameters
         ----------
         max_workers :   int, optional
-                        The max number of workers for parallel chunk requests.
+                        The max number of threads for parallel chunk requests.
         return_sorted : bool, optional
                         If True, will order the returned data to match the order
-                        of the points as they were added.
+                        of the points as they were added. If False, points
+                        (and data) are ordered by storage chunk.
         progress :      bool, optional
                         Whether to show progress bar.
+        subbox :        bool, optional
+                        If True, will only download the part of each chunk that
+                        actually contains points.
 
         Returns
         -------
@@ -218,31 +227,51 @@ class GSPointLoader(object):
                         data loaded from volume.
 
         """
+        if isinstance(self._points, type(None)) or not len(self._points):
+            return np.zeros((0, 3)), np.zeros(0, dtype=self._volume.dtype)
+
+        voxels, order, offsets, chunks = self._group_by_chunk()
+        chunk_size = np.array(self._volume.scale['chunk_sizes']).reshape(-1, 3)[0]
+
+        # Preallocate output - each thread fills in the data for its own points
+        data = np.zeros(len(voxels), dtype=self._volume.dtype)
+
+        def _load_chunk(i):
+            ix = order[offsets[i]:offsets[i + 1]]
+            vxl = voxels[ix]
+
+            if subbox:
+                start, end = vxl.min(axis=0), vxl.max(axis=0) + 1
+            else:
+                start, end = chunks[i], chunks[i] + chunk_size
+
+            cutout = np.asarray(self._volume[start[0]:end[0],
+                                             start[1]:end[1],
+                                             start[2]:end[2]])
+            vxl = vxl - start
+            data[ix] = cutout[vxl[:, 0], vxl[:, 1], vxl[:, 2]].reshape(len(ix), -1)[:, 0]
+
         progress_state = self._volume.progress
         self._volume.progress = False
-        with tqdm(total=len(self._chunk_map),
-                  desc='Segmentation IDs',
-                  leave=False,
-                  disable=not progress) as pbar:
-            with futures.ProcessPoolExecutor(max_workers=max_workers) as ex:
-                point_futures = [ex.submit(self._load_points, k) for k in self._chunk_map]
-                for f in futures.as_completed(point_futures):
-                    pbar.update(1)
-        self._volume.progress = progress_state
-
-        results = [f.result() for f in point_futures]
+        try:
+            with tqdm(total=len(chunks),
+                      desc='Segmentation IDs',
+                      leave=False,
+                      disable=not progress) as pbar:
+                # Threads share the volume - no need to pickle anything
+                with futures.ThreadPoolExecutor(max_workers=max_workers) as ex:
+                    point_futures = [ex.submit(_load_chunk, i) for i in range(len(chunks))]
+                    for f in futures.as_completed(point_futures):
+                        # Raise exceptions
+                        f.result()
+                        pbar.update(1)
+        finally:
+            self._volume.progress = progress_state
 
         if return_sorted:
-            points_dict = dict(zip([tuple(p) for result in results for p in result[0]],
-                                   [i for result in results for i in result[1]]))
-
-            data = np.array([points_dict[tuple(p)] for p in self._points])
-            points = self._points
-        else:
-            points = np.concatenate([result[0] for result in results])
-            data = np.concatenate([result[1] for result in results])
+            return self._points, data
 
-        return points, data.flatten()
+        return self._points[order], data[order]
 
 
 def download_cache_file(url, filename=None, force_reload=False, verbose=True):